@@ -1,9 +1,15 @@
+from .aio import asearch
+from .aio import asurvey
+from .core import iter_results
+from .core import observable_probability
+from .core import rescore
 from .core import search
 from .core import survey
 from .display import plot_CHARA
 from .display import plot_histo_survey
 from .display import plot_vision
 from .display import plot_VLTI
+from .table import SurveyTable
 from .utils import count_survey
 from .utils import load
 from .utils import save
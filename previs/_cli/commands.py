@@ -3,11 +3,16 @@ import os
 from matplotlib import pyplot as plt
 
 import previs
+from previs.cache import Cache
 
 
 def perform_search(args):
     d = previs.search(
-        args.target, min_elev=args.min_elev, check=args.check, verbose=args.verbose
+        args.target,
+        min_elev=args.min_elev,
+        check=args.check,
+        verbose=args.verbose,
+        limits_period=args.limits_period,
     )
 
     if args.save_to is not None:
@@ -34,11 +39,22 @@ def perform_search(args):
 
 
 def perform_survey(args):
-    survey = previs.survey(args.target)
-
+    output = None
     if args.save_to is not None:
         if not os.path.exists(args.save_to):
             os.mkdir(args.save_to)
+        output = os.path.join(args.save_to, "survey.jsonl")
+        if not args.resume and os.path.exists(output):
+            os.remove(output)
+
+    survey = previs.survey(
+        args.target,
+        executor=args.executor,
+        max_workers=args.max_workers,
+        limits_period=args.limits_period,
+        output=output,
+        resume=args.resume,
+    )
 
     if args.save_to is not None:
         result_file = os.path.join(args.save_to, "survey.json")
@@ -50,3 +66,23 @@ def perform_survey(args):
     if args.plot:
         plt.show()
     return 0
+
+
+def perform_cache(args):
+    cache = Cache()
+    if args.action == "stats":
+        stats = cache.stats()
+        print("Cache directory: %s" % cache.directory)
+        for service, s in sorted(stats.items()):
+            print(
+                "%s: %i entries (%i expired), %2.2f MB"
+                % (service, s["entries"], s["expired"], s["size"] / 1024**2)
+            )
+        if len(stats) == 0:
+            print("The cache is empty.")
+    elif args.action == "prune":
+        n_removed = cache.prune()
+        print("%i entries removed." % n_removed)
+    elif args.action == "clear":
+        cache.clear(args.service)
+    return 0
@@ -3,6 +3,7 @@ from argparse import ArgumentParser
 from typing import List
 from typing import Optional
 
+from previs._cli.commands import perform_cache
 from previs._cli.commands import perform_search
 from previs._cli.commands import perform_survey
 
@@ -47,6 +48,13 @@ def main(argv: Optional[List[str]] = None) -> int:
         help="If True, update MATISSE performances on the ESO website.",
     )
 
+    search_parser.add_argument(
+        "--limits_period",
+        default=None,
+        type=str,
+        help="ESO period of the MATISSE limits (e.g. P105, default: most recent stored limits).",
+    )
+
     search_parser.add_argument(
         "-p",
         "--plot",
@@ -78,12 +86,50 @@ def main(argv: Optional[List[str]] = None) -> int:
         action="store_true",
         help="Plot figures.",
     )
+    survey_parser.add_argument(
+        "--executor",
+        default="threads",
+        choices=["threads", "processes"],
+        help="Run the searches in a pool of threads or processes (default: %(default)s).",
+    )
+    survey_parser.add_argument(
+        "--max_workers",
+        default=None,
+        type=int,
+        help="Number of threads/processes used to perform the survey (default: 8 threads, or number of CPUs up to 8 processes).",
+    )
+    survey_parser.add_argument(
+        "--limits_period",
+        default=None,
+        type=str,
+        help="ESO period of the MATISSE limits (e.g. P105, default: most recent stored limits).",
+    )
     survey_parser.add_argument(
         "--save_to",
         default=None,
         type=str,
         help="If save_to is set, figures and fetched data are saved.",
     )
+    survey_parser.add_argument(
+        "--resume",
+        action="store_true",
+        help="Resume an interrupted survey saved in save_to (survey.jsonl).",
+    )
+
+    cache_parser = subparsers.add_parser(
+        "cache", help="Manage the local cache of the VO responses"
+    )
+    cache_parser.add_argument(
+        "action",
+        choices=["stats", "prune", "clear"],
+        help="Print the cache statistics, remove expired/least recently used entries or clear the cache.",
+    )
+    cache_parser.add_argument(
+        "--service",
+        default=None,
+        choices=["simbad", "sed", "gaia"],
+        help="Service to clear (default: all services).",
+    )
 
     args = parser.parse_args(argv)
 
@@ -92,6 +138,8 @@ def main(argv: Optional[List[str]] = None) -> int:
         retv = perform_search(args)
     elif args.command == "survey":
         retv = perform_survey(args)
+    elif args.command == "cache":
+        retv = perform_cache(args)
     return retv
 
 
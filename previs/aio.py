@@ -0,0 +1,323 @@
+"""
+@author: Anthony Soulain (University of Sydney)
+
+--------------------------------------------------------------------
+PREVIS: Python Request Engine for Virtual Interferometric Survey
+--------------------------------------------------------------------
+
+This file contains the asynchronous version of previs.search and
+previs.survey (previs.asearch and previs.asurvey), to be used from an
+asyncio event loop. The SED is fetched with a native asynchronous HTTP
+request. Simbad and Gaia are queried with astroquery, which is blocking,
+so these requests are run in the default executor of the event loop.
+In both cases, the number of simultaneous requests sent to each host is
+limited by a semaphore (N_NETWORK_CONCURRENCY).
+"""
+import asyncio
+import ssl
+import urllib.parse
+import weakref
+
+from astroquery.simbad import conf as simbad_conf
+from astroquery.vizier import conf as vizier_conf
+from termcolor import cprint
+
+from previs.cache import get_cache
+from previs.core import _add_gaia
+from previs.core import _add_guiding_star
+from previs.core import _add_ins
+from previs.core import _add_mag
+from previs.core import _add_simbad
+from previs.core import _init_data
+from previs.core import _need_guiding_star
+from previs.core import gaia_dr2_id
+from previs.core import get_gaia
+from previs.core import get_simbad
+from previs.core import N_NETWORK_CONCURRENCY
+from previs.core import resolve_gaia
+from previs.core import resolve_simbad
+from previs.instr import get_limits
+from previs.sed import _read_sed
+from previs.sed import _sed_url
+from previs.utils import check_servers_response
+from previs.utils import open_jsonl
+from previs.utils import write_jsonl
+
+# Maximum number of targets searched at the same time by previs.asurvey.
+N_TARGETS_IN_FLIGHT = 200
+
+HTTP_TIMEOUT = 60  # s
+
+_semaphores = weakref.WeakKeyDictionary()
+
+
+def _hostname(server):
+    """Host name of an astroquery server (or of the first mirror)."""
+    if isinstance(server, (list, tuple)):
+        server = server[0]
+    if "://" not in server:
+        server = "//" + server
+    return urllib.parse.urlsplit(server).hostname
+
+
+# Hosts queried by astroquery (the semaphores are shared with the
+# asynchronous requests sent to the same host, e.g. the SED from VizieR).
+SIMBAD_HOST = _hostname(simbad_conf.server)
+VIZIER_HOST = _hostname(vizier_conf.server)
+
+
+def _semaphore(host):
+    """Semaphore limiting the number of simultaneous requests to `host` (one
+    semaphore per host and per event loop)."""
+    loop = asyncio.get_running_loop()
+    semaphores = _semaphores.setdefault(loop, {})
+    if host not in semaphores:
+        semaphores[host] = asyncio.Semaphore(N_NETWORK_CONCURRENCY)
+    return semaphores[host]
+
+
+async def _run_blocking(host, func, *args):
+    async with _semaphore(host):
+        return await asyncio.to_thread(func, *args)
+
+
+def _dechunk(body):
+    out = bytearray()
+    i = 0
+    while True:
+        j = body.find(b"\r\n", i)
+        if j < 0:
+            raise ValueError("last chunk not received")
+        size = int(body[i:j].split(b";")[0], 16)
+        if size == 0:
+            break
+        if j + 2 + size > len(body):
+            raise ValueError("truncated chunk")
+        out += body[j + 2 : j + 2 + size]
+        i = j + 2 + size + 2
+    return bytes(out)
+
+
+async def http_get(url, max_redirect=5, timeout=HTTP_TIMEOUT):
+    """Asynchronous HTTP GET request. Return the body of the response (bytes)."""
+    for _ in range(max_redirect + 1):
+        parts = urllib.parse.urlsplit(url)
+        https = parts.scheme == "https"
+        port = parts.port or (443 if https else 80)
+        path = parts.path or "/"
+        if parts.query:
+            path += "?" + parts.query
+
+        async with _semaphore(parts.hostname):
+            reader, writer = await asyncio.wait_for(
+                asyncio.open_connection(
+                    parts.hostname,
+                    port,
+                    ssl=ssl.create_default_context() if https else None,
+                ),
+                timeout,
+            )
+            try:
+                request = (
+                    f"GET {path} HTTP/1.1\r\nHost: {parts.netloc}\r\n"
+                    "User-Agent: previs\r\nConnection: close\r\n\r\n"
+                )
+                writer.write(request.encode())
+                await writer.drain()
+                raw = await asyncio.wait_for(reader.read(), timeout)
+            finally:
+                writer.close()
+                try:
+                    await writer.wait_closed()
+                except OSError:
+                    pass  # the response is already read
+
+        header, _, body = raw.partition(b"\r\n\r\n")
+        lines = header.decode("latin-1").split("\r\n")
+        status = int(lines[0].split()[1])
+        headers = {}
+        for line in lines[1:]:
+            key, _, value = line.partition(":")
+            headers[key.strip().lower()] = value.strip()
+
+        if status in [301, 302, 303, 307, 308] and "location" in headers:
+            url = urllib.parse.urljoin(url, headers["location"])
+            continue
+        if status != 200:
+            raise OSError("HTTP error %i (%s)" % (status, url))
+        # The connection can be dropped before the end of the body.
+        if headers.get("transfer-encoding", "").lower() == "chunked":
+            try:
+                body = _dechunk(body)
+            except ValueError as exc:
+                raise OSError("Incomplete response: %s (%s)" % (exc, url)) from exc
+        elif "content-length" in headers:
+            length = int(headers["content-length"])
+            if len(body) < length:
+                raise OSError(
+                    "Incomplete response: %i/%i bytes (%s)" % (len(body), length, url)
+                )
+            body = body[:length]
+        return body
+    raise OSError("Too many redirections (%s)" % url)
+
+
+async def agetSed(coord):
+    """Asynchronous version of previs.sed.getSed (the SED is cached)."""
+    cache = get_cache()
+    if cache is not None:
+        sed = cache.get("sed", coord)
+        if sed is not None:
+            return sed
+
+    try:
+        sed = _read_sed(await http_get(_sed_url(coord)))
+    except Exception as exc:
+        cprint("SED request failed (%s): %s" % (coord, exc), "red")
+        sed = None
+
+    if cache is not None and sed is not None:
+        cache.set("sed", coord, sed)
+    return sed
+
+
+async def _asearch(star, source, min_elev, check, simbad, limits, gaia=None):
+    data = _init_data(star)
+
+    star_user = star
+    star = star.upper()
+    if simbad is None:
+        try:
+            simbad = await _run_blocking(SIMBAD_HOST, get_simbad, star)
+        except Exception as exc:
+            raise ValueError("%s not in Simbad!" % star_user) from exc
+    c = _add_simbad(data, simbad, star_user)
+
+    t_sed = asyncio.create_task(agetSed(data["Coord"]))
+    t_gaia = None
+    if gaia is None:
+        t_gaia = asyncio.create_task(
+            _run_blocking(VIZIER_HOST, get_gaia, star, gaia_dr2_id(simbad))
+        )
+
+    sed = await t_sed
+    if not _add_mag(data, sed, simbad):
+        if t_gaia is not None:
+            t_gaia.cancel()
+        return None
+
+    field = None
+    if t_gaia is not None:
+        field = await t_gaia
+        gaia = field["star"] if field is not None else None
+    _add_gaia(data, gaia)
+
+    guid = None
+    if _need_guiding_star(data):
+        if field is None:
+            field = await _run_blocking(
+                VIZIER_HOST, get_gaia, star, gaia_dr2_id(simbad)
+            )
+        if field is None:
+            return None
+        guid = field["guiding"]
+    _add_guiding_star(data, guid)
+
+    _add_ins(data, c, min_elev, source, check, limits)
+    return data
+
+
+async def asearch(
+    star, source="ESO", min_elev=30, check=False, simbad=None, limits_period=None
+):
+    """Asynchronous version of previs.search (see previs.search for the
+    parameters).
+
+    Example:
+    --------
+    >>> data = await previs.asearch("WR104")
+    """
+    if await asyncio.to_thread(check_servers_response) is None:
+        return None
+
+    limits = await asyncio.to_thread(get_limits, source, check, limits_period)
+    return await _asearch(star, source, min_elev, check, simbad, limits)
+
+
+async def asurvey(
+    list_star,
+    max_in_flight=N_TARGETS_IN_FLIGHT,
+    limits_period=None,
+    output=None,
+    resume=False,
+):
+    """Asynchronous version of previs.survey.
+
+    Parameters
+    ----------
+    `list_star` : {list}
+        List of stars,\n
+    `max_in_flight` : {int}
+        Maximum number of stars searched at the same time (default: 200),\n
+    `limits_period` : {str}
+        ESO period of the MATISSE limits (e.g.: 'P105', default: most recent),\n
+    `output` : {str}
+        JSON Lines file where the result of each star is written as soon as it is
+        found (see previs.survey),\n
+    `resume` : {bool}
+        If True, the stars already saved in `output` are not searched again.\n
+    Returns
+    -------
+    `survey`: {dict}
+        Dictionnary containing previs search for all stars.
+    """
+    if await asyncio.to_thread(check_servers_response) is None:
+        return None
+
+    if len(list_star) == 0:
+        raise ValueError("The target list is empty.")
+
+    cprint("\nStarting survey on %i stars:" % len(list_star), "cyan")
+    cprint("-------------------------", "cyan")
+
+    ofile, done = None, {}
+    if output is not None:
+        ofile, done = open_jsonl(output, resume)
+    todo = [star for star in list_star if star not in done]
+
+    async def _one(star):
+        async with in_flight:
+            try:
+                data = await _asearch(
+                    star,
+                    "ESO",
+                    30,
+                    False,
+                    records.get(star),
+                    limits,
+                    astrometry.get(star),
+                )
+            except Exception as exc:
+                cprint("%s: %s" % (star, exc), "red")
+                return False, None
+        if ofile is not None:
+            write_jsonl(ofile, star, data)
+        return True, data
+
+    try:
+        results = []
+        if len(todo) != 0:
+            records = await _run_blocking(SIMBAD_HOST, resolve_simbad, todo)
+            astrometry = await _run_blocking(VIZIER_HOST, resolve_gaia, records)
+            limits = await asyncio.to_thread(get_limits, "ESO", False, limits_period)
+            in_flight = asyncio.Semaphore(max_in_flight)
+            results = await asyncio.gather(*[_one(s) for s in todo])
+    finally:
+        if ofile is not None:
+            ofile.close()
+
+    # As in previs.survey, the stars without result (None) are kept and the
+    # failed searches are dropped.
+    out = dict(done)
+    out.update({star: data for star, (ok, data) in zip(todo, results) if ok})
+    return {star: out[star] for star in list_star if star in out}
@@ -0,0 +1,239 @@
+"""
+@author: Anthony Soulain (University of Sydney)
+
+--------------------------------------------------------------------
+PREVIS: Python Request Engine for Virtual Interferometric Survey
+--------------------------------------------------------------------
+
+This file contains the persistent cache used to store the responses of
+the Simbad, Vizier (SED) and Gaia services. Each entry is stored as a
+(compressed) pickle file under the user cache directory. Each service has
+its own time-to-live and the total size of the cache is bounded: the least
+recently used entries are evicted first.
+"""
+import hashlib
+import os
+import pickle
+import shutil
+import sys
+import tempfile
+import time
+import zlib
+from pathlib import Path
+
+from termcolor import cprint
+
+DAY = 86400.0
+
+DEFAULT_TTL = {
+    "simbad": 30 * DAY,
+    "sed": 7 * DAY,
+    "gaia": 90 * DAY,
+}
+
+DEFAULT_MAX_SIZE = 500 * 1024**2  # bytes
+
+_PRUNE_EVERY = 200  # number of writes between two automatic prunes
+
+
+def user_cache_dir():
+    """Return the user cache directory of previs (can be set with the
+    PREVIS_CACHE_DIR environment variable)."""
+    if os.environ.get("PREVIS_CACHE_DIR"):
+        return Path(os.environ["PREVIS_CACHE_DIR"])
+    if os.name == "nt":
+        base = Path(os.environ.get("LOCALAPPDATA", Path.home() / "AppData" / "Local"))
+        return base / "previs" / "Cache"
+    if sys.platform == "darwin":
+        return Path.home() / "Library" / "Caches" / "previs"
+    base = Path(os.environ.get("XDG_CACHE_HOME", Path.home() / ".cache"))
+    return base / "previs"
+
+
+class Cache:
+    """Persistent on-disk cache.
+
+    Parameters:
+    -----------
+    `directory`: {str}
+        Directory of the cache (default: `user_cache_dir()`),\n
+    `ttl`: {dict}
+        Time-to-live of the entries of each service [s] (default: `DEFAULT_TTL`),\n
+    `max_size`: {int}
+        Maximum size of the cache [bytes]. If None, the size is not bounded,\n
+    `compress`: {bool}
+        If True (default), the entries are compressed with zlib.
+    """
+
+    def __init__(
+        self, directory=None, ttl=None, max_size=DEFAULT_MAX_SIZE, compress=True
+    ):
+        self.directory = Path(directory) if directory else user_cache_dir()
+        self.ttl = dict(DEFAULT_TTL)
+        if ttl is not None:
+            self.ttl.update(ttl)
+        self.max_size = max_size
+        self.compress = compress
+        self._n_write = 0
+        self._write_failed = False
+
+    def _path(self, service, key):
+        h = hashlib.sha1(str(key).encode()).hexdigest()
+        return self.directory / service / (h + ".pkl")
+
+    def _expired(self, service, mtime, now):
+        ttl = self.ttl.get(service)
+        return ttl is not None and (now - mtime) > ttl
+
+    def get(self, service, key, default=None):
+        """Return the cached value of `key`, or `default` if the entry is
+        missing or expired."""
+        path = self._path(service, key)
+        now = time.time()
+        try:
+            st = path.stat()
+            if self._expired(service, st.st_mtime, now):
+                return default
+            with open(path, "rb") as ofile:
+                raw = ofile.read()
+            # The access time is used for the LRU eviction.
+            os.utime(path, (now, st.st_mtime))
+        except OSError:
+            return default
+
+        try:
+            if raw[:1] == b"z":
+                raw = zlib.decompress(raw[1:])
+            else:
+                raw = raw[1:]
+            return pickle.loads(raw)
+        except Exception:
+            return default
+
+    def set(self, service, key, value):
+        """Store `value` as the cached entry of `key`."""
+        path = self._path(service, key)
+        raw = pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+        if self.compress:
+            raw = b"z" + zlib.compress(raw)
+        else:
+            raw = b"p" + raw
+
+        try:
+            path.parent.mkdir(parents=True, exist_ok=True)
+            fd, tmpname = tempfile.mkstemp(dir=path.parent, suffix=".tmp")
+            with os.fdopen(fd, "wb") as ofile:
+                ofile.write(raw)
+            os.replace(tmpname, path)
+        except OSError as exc:
+            # Reported once (e.g. read-only cache directory).
+            if not self._write_failed:
+                cprint("Cache not written in %s: %s" % (self.directory, exc), "red")
+                self._write_failed = True
+            return
+
+        self._n_write += 1
+        if self.max_size is not None and self._n_write % _PRUNE_EVERY == 0:
+            self.prune()
+
+    def _entries(self):
+        entries = []
+        if not self.directory.is_dir():
+            return entries
+        for service_dir in self.directory.iterdir():
+            if not service_dir.is_dir():
+                continue
+            for path in service_dir.glob("*.pkl"):
+                try:
+                    st = path.stat()
+                except OSError:
+                    continue
+                entries.append((service_dir.name, path, st))
+        return entries
+
+    def stats(self):
+        """Return the number of entries, expired entries and size [bytes] of
+        each service."""
+        now = time.time()
+        stats = {}
+        for service, _, st in self._entries():
+            s = stats.setdefault(service, {"entries": 0, "expired": 0, "size": 0})
+            s["entries"] += 1
+            s["size"] += st.st_size
+            if self._expired(service, st.st_mtime, now):
+                s["expired"] += 1
+        return stats
+
+    def prune(self, max_size=None):
+        """Remove the expired entries, then the least recently used ones until
+        the cache is smaller than `max_size` (default: `self.max_size`).
+        Return the number of removed entries."""
+        if max_size is None:
+            max_size = self.max_size
+        now = time.time()
+        n_removed = 0
+        kept = []
+        for service, path, st in self._entries():
+            if self._expired(service, st.st_mtime, now):
+                path.unlink(missing_ok=True)
+                n_removed += 1
+            else:
+                kept.append((st.st_atime, st.st_size, path))
+
+        if max_size is not None:
+            total = sum(x[1] for x in kept)
+            for _, size, path in sorted(kept, key=lambda x: x[0]):
+                if total <= max_size:
+                    break
+                path.unlink(missing_ok=True)
+                total -= size
+                n_removed += 1
+        return n_removed
+
+    def clear(self, service=None):
+        """Remove all the entries (of one `service` if given)."""
+        if service is not None:
+            shutil.rmtree(self.directory / service, ignore_errors=True)
+        elif self.directory.is_dir():
+            for service_dir in self.directory.iterdir():
+                if service_dir.is_dir():
+                    shutil.rmtree(service_dir, ignore_errors=True)
+
+
+_cache = None
+_enabled = os.environ.get("PREVIS_CACHE", "1") != "0"
+
+
+def configure(enabled=True, **kwargs):
+    """Enable/disable the cache used by previs.search and previs.survey.
+    Additional arguments are given to `Cache` (directory, ttl, max_size,
+    compress)."""
+    global _cache, _enabled
+    _enabled = enabled
+    _cache = Cache(**kwargs) if enabled else None
+
+
+def get_cache():
+    """Return the cache used by previs (None if the cache is disabled)."""
+    global _cache
+    if not _enabled:
+        return None
+    if _cache is None:
+        _cache = Cache()
+    return _cache
+
+
+def cached(service, key, func, *args, **kwargs):
+    """Return the cached response of `service` for `key`, or call
+    `func(*args, **kwargs)` and store its result. None results (failed
+    requests) are not stored."""
+    cache = get_cache()
+    if cache is None:
+        return func(*args, **kwargs)
+
+    value = cache.get(service, key)
+    if value is None:
+        value = func(*args, **kwargs)
+        if value is not None:
+            cache.set(service, key, value)
+    return value
@@ -28,8 +28,15 @@ on one or a list of targets.
 
 --------------------------------------------------------------------
 """
+import atexit
+import os
+import pickle
+import re
+import threading
 import time
 import warnings
+from concurrent.futures import as_completed
+from concurrent.futures import ThreadPoolExecutor
 
 import astropy.coordinates as ac
 import numpy as np
@@ -39,21 +46,382 @@ from astroquery.vizier import Vizier
 from termcolor import cprint
 from uncertainties import ufloat
 
-from previs.instr import chara_limit
-from previs.instr import gravity_limit
-from previs.instr import ivis_limit
-from previs.instr import matisse_limit
-from previs.instr import pionier_limit
+from previs.cache import cached
+from previs.cache import get_cache
+from previs.instr import get_limits
+from previs.instr import instrument_limits
+from previs.instr import limits_view
+from previs.instr import limits_views
+from previs.sed import CONV_FLUX
 from previs.sed import getSed
+from previs.sed import interp_weights
 from previs.sed import sed2mag
+from previs.sed import stack_errors
+from previs.sed import stack_seds
+from previs.table import _coord_deg
 from previs.utils import check_servers_response
+from previs.utils import open_jsonl
 from previs.utils import printtime
+from previs.utils import write_jsonl
 
 warnings.filterwarnings("ignore")
 warnings.filterwarnings("ignore", module="scipy.interpolate.interp1d")
 
 
-def search(star, source="ESO", min_elev=30, check=False, verbose=False):
+SIMBAD_CHUNK_SIZE = 500
+GAIA_CHUNK_SIZE = 500
+# Minimal number of stars of a bulk request split after a failure.
+BULK_MIN_CHUNK = 50
+
+
+def _bulk(query, chunk, service, min_size=None):
+    """Send the bulk request `query(chunk)`. If it fails, the chunk is split in
+    two and each half is sent again (down to `min_size` stars), so that a
+    transient error does not lose the whole chunk. Return the list of the
+    requests which succeeded (sub-chunk, result); the stars of the requests
+    which still failed are reported."""
+    if min_size is None:
+        min_size = BULK_MIN_CHUNK
+    try:
+        return [(chunk, query(chunk))]
+    except Exception as exc:
+        if len(chunk) > min_size:
+            half = (len(chunk) + 1) // 2
+            return _bulk(query, chunk[:half], service, min_size) + _bulk(
+                query, chunk[half:], service, min_size
+            )
+        cprint(
+            "%s request failed for %i stars (%s...): %s"
+            % (service, len(chunk), chunk[0], exc),
+            "red",
+        )
+        return []
+
+
+def _custom_simbad():
+    customSimbad = Simbad()
+    customSimbad.add_votable_fields("parallax", "sp_type", "ids", "V", "B")
+    return customSimbad
+
+
+def _masked_float(col, i):
+    value = col[i]
+    if value is np.ma.masked:
+        return np.nan
+    return float(value)
+
+
+def _simbad_record(objet, i=0):
+    """Extract the fields used by previs.search from the row `i` of a Simbad
+    table (coordinates, parallax, spectral type, identifiers and B/V fluxes)."""
+    if objet["ra"][i] is np.ma.masked:
+        return None
+
+    aa = str(objet["sp_type"].data[i])
+    if "b" in aa:
+        sptype = aa.split("b")[1].split("'")[1]
+    else:
+        sptype = aa
+
+    mags = {}
+    for band in ["V", "B"]:
+        # Simbad column names changed with astroquery 0.4.8 (FLUX_V -> V).
+        colname = band if band in objet.colnames else "FLUX_%s" % band
+        try:
+            mags[band] = _masked_float(objet[colname], i)
+        except Exception:
+            mags[band] = np.nan
+
+    return {
+        "ra": objet["ra"][i],
+        "dec": objet["dec"][i],
+        "plx": float(objet["plx_value"].data[i]),
+        "e_plx": float(objet["plx_err"].data[i]),
+        "sp_type": sptype,
+        "ids": str(objet["ids"][i]),
+        "V": mags["V"],
+        "B": mags["B"],
+    }
+
+
+def _query_simbad(star):
+    objet = _custom_simbad().query_object(star)
+    return _simbad_record(objet)
+
+
+def get_simbad(star):
+    """Query Simbad for one star and return its record (see `resolve_simbad`)."""
+    return cached("simbad", star.upper(), _query_simbad, star)
+
+
+def resolve_simbad(list_star, chunk_size=SIMBAD_CHUNK_SIZE):
+    """Resolve a list of stars with Simbad using bulk requests.
+
+    Parameters
+    ----------
+    `list_star` : {list}
+        List of star names,\n
+    `chunk_size` : {int}
+        Number of stars resolved per Simbad request (default: 500).
+
+    Returns
+    -------
+    `records`: {dict}
+        Simbad record of each star (None if the star is not in Simbad). The
+        stars whose request failed are not included (they are reported). The
+        records can be given to previs.search with the `simbad` argument.
+    """
+    cache = get_cache()
+    records = {}
+    if cache is not None:
+        for star in list_star:
+            record = cache.get("simbad", star.upper())
+            if record is not None:
+                records[star] = record
+    to_resolve = [star for star in list_star if star not in records]
+
+    customSimbad = _custom_simbad()
+
+    def _query(chunk):
+        return customSimbad.query_objects([star.upper() for star in chunk])
+
+    for i in range(0, len(to_resolve), chunk_size):
+        for chunk, objet in _bulk(_query, to_resolve[i : i + chunk_size], "Simbad"):
+            if objet is not None:
+                for j in range(len(objet)):
+                    k = int(objet["object_number_id"][j]) - 1
+                    if chunk[k] not in records:
+                        records[chunk[k]] = _simbad_record(objet, j)
+                        if cache is not None and records[chunk[k]] is not None:
+                            cache.set("simbad", chunk[k].upper(), records[chunk[k]])
+            for star in chunk:
+                records.setdefault(star, None)
+    return records
+
+
+# Gaia DR2 keys stored in data["Gaia_dr2"] and corresponding Vizier columns.
+GAIA_COLUMNS = {
+    "RA": "RA_ICRS",
+    "e_RA": "e_RA_ICRS",
+    "DEC": "DE_ICRS",
+    "e_DEC": "e_DE_ICRS",
+    "Plx": "Plx",
+    "e_Plx": "e_Plx",
+    "pmRA": "pmRA",
+    "e_pmRA": "e_pmRA",
+    "pmDE": "pmDE",
+    "e_pmDE": "e_pmDE",
+    "Teff": "Teff",
+}
+
+
+def _gaia_record(tab, i=0):
+    record = {"Gmag": float(np.ma.getdata(tab["Gmag"])[i])}
+    for key, col in GAIA_COLUMNS.items():
+        record[key] = float(np.ma.getdata(tab[col])[i])
+    return record
+
+
+def _r_arcsec(col):
+    """Distance to the target (Vizier `_r` column) in arcsec."""
+    r = np.ma.filled(np.ma.asarray(col, dtype=float), np.inf)
+    unit = col.unit if col.unit is not None else u.arcmin
+    return (r * u.Unit(unit)).to_value(u.arcsec)
+
+
+def _guiding_star_lists(tab):
+    """Stars usable as guiding star at the VLTI: lists of [ra, dec, Gmag] of the
+    stars with G <= 12.5 and 12.5 < G <= 15."""
+    Gmag = np.ma.filled(np.ma.asarray(tab["Gmag"], dtype=float), np.nan)
+    ra = np.ma.getdata(tab["RA_ICRS"]).astype(float)
+    dec = np.ma.getdata(tab["DE_ICRS"]).astype(float)
+
+    with np.errstate(invalid="ignore"):
+        cond1 = Gmag <= 12.5
+        cond2 = (Gmag <= 15) & (Gmag > 12.5)
+
+    guid1 = np.array([ra[cond1], dec[cond1], Gmag[cond1]]).T.tolist()
+    guid2 = np.array([ra[cond2], dec[cond2], Gmag[cond2]]).T.tolist()
+    return [guid1, guid2]
+
+
+def gaia_dr2_id(simbad):
+    """Return the Gaia DR2 source_id (str) from the identifiers of a Simbad
+    record (None if the star has no Gaia DR2 identifier)."""
+    if simbad is None:
+        return None
+    match = re.search(r"Gaia DR2 (\d+)", simbad.get("ids") or "")
+    return match.group(1) if match else None
+
+
+def _source_ids(tab):
+    return [str(x) for x in np.ma.getdata(tab["Source"])]
+
+
+def _gaia_field(tab, source_id=None):
+    """Split a Gaia DR2 cone (57 arcsec) into the astrometry of the target and
+    the guiding star candidates. The target is identified by its Gaia DR2
+    `source_id` if known, else it is the nearest source within 2 arcsec."""
+    if tab is None or len(tab) == 0:
+        return {"star": {}, "guiding": [[], []]}
+
+    if source_id is not None and source_id in _source_ids(tab):
+        star = _gaia_record(tab, _source_ids(tab).index(source_id))
+    else:
+        r = _r_arcsec(tab["_r"])
+        i = int(np.argmin(r))
+        star = _gaia_record(tab, i) if r[i] <= 2 else {}
+    return {"star": star, "guiding": _guiding_star_lists(tab)}
+
+
+def _query_gaia(star, source_id):
+    v = Vizier(
+        columns=["_r", "Source", "Gmag"] + list(GAIA_COLUMNS.values()), row_limit=-1
+    )
+    try:
+        res = v.query_region(star, radius="57s", catalog="I/345/gaia2")
+    except Exception as exc:
+        cprint("Gaia DR2 request failed (%s): %s" % (star, exc), "red")
+        return None
+    tab = res["I/345/gaia2"] if "I/345/gaia2" in res.keys() else None
+    return _gaia_field(tab, source_id)
+
+
+def _query_gaia_ids(source_ids):
+    """Get the Gaia DR2 informations of a list of sources (source_id)."""
+    v = Vizier(columns=["Source", "Gmag"] + list(GAIA_COLUMNS.values()), row_limit=-1)
+    res = v.query_constraints(catalog="I/345/gaia2", Source="=," + ",".join(source_ids))
+    found = {}
+    if "I/345/gaia2" in res.keys():
+        tab = res["I/345/gaia2"]
+        for j, source_id in enumerate(_source_ids(tab)):
+            found[source_id] = _gaia_record(tab, j)
+    return found
+
+
+def get_gaia(star, source_id=None):
+    """Query Gaia DR2 within 57 arcsec around the star. One request gives the
+    astrometry of the star and the stars usable as guiding star at the VLTI. If
+    the Gaia DR2 `source_id` of the star is known (see `gaia_dr2_id`), it is used
+    to identify the star in the field.
+
+    Returns:
+    --------
+    `gaia`: {dict}
+        'star': Gaia DR2 informations of the star (empty dict if the star is not
+        in Gaia DR2), 'guiding': lists [ra, dec, Gmag] of the stars with G <= 12.5
+        and 12.5 < G <= 15. None if the request failed.
+    """
+    return cached(
+        "gaia", "I/345/gaia2 57s %s" % star.upper(), _query_gaia, star, source_id
+    )
+
+
+def _simbad_skycoord(list_simbad):
+    """Celestial coordinates of a list of Simbad records."""
+    ra = [simbad["ra"] for simbad in list_simbad]
+    dec = [simbad["dec"] for simbad in list_simbad]
+    if isinstance(ra[0], str):
+        return ac.SkyCoord(ra, dec, unit=(u.hourangle, u.deg))
+    return ac.SkyCoord(np.array(ra, float), np.array(dec, float), unit=u.deg)
+
+
+def resolve_gaia(records, chunk_size=GAIA_CHUNK_SIZE):
+    """Get the Gaia DR2 informations of a list of stars using bulk requests. The
+    stars with a Gaia DR2 identifier in Simbad are fetched by source_id, the
+    others are cross-matched by position (2 arcsec, multi-position Vizier
+    queries).
+
+    Parameters
+    ----------
+    `records` : {dict}
+        Simbad records of the stars (from `resolve_simbad`),\n
+    `chunk_size` : {int}
+        Number of stars sent per Vizier request (default: 500).
+
+    Returns
+    -------
+    `astrometry`: {dict}
+        Gaia DR2 informations of each star (empty dict if the star is not in
+        Gaia DR2, None if unknown). They can be given to previs.search with the
+        `gaia` argument.
+    """
+    cache = get_cache()
+    astrometry = {star: None for star in records}
+    by_id, to_resolve = [], []
+    for star, simbad in records.items():
+        if simbad is None:
+            continue
+        if cache is not None:
+            astrometry[star] = cache.get("gaia", "I/345/gaia2 2s %s" % star.upper())
+        if astrometry[star] is None:
+            source_id = gaia_dr2_id(simbad)
+            if source_id is not None:
+                by_id.append((star, source_id))
+            else:
+                to_resolve.append(star)
+
+    # Indexed lookup by source_id, positional cross-match if not found.
+    source_ids = dict(by_id)
+
+    def _query_ids(chunk):
+        return _query_gaia_ids([source_ids[star] for star in chunk])
+
+    for i in range(0, len(by_id), chunk_size):
+        chunk = [star for star, _ in by_id[i : i + chunk_size]]
+        found = {}
+        for _, result in _bulk(_query_ids, chunk, "Gaia DR2 (source_id)"):
+            found.update(result)
+        # The stars not found (or whose request failed) are cross-matched.
+        for star in chunk:
+            source_id = source_ids[star]
+            if source_id in found:
+                astrometry[star] = found[source_id]
+                if cache is not None:
+                    cache.set(
+                        "gaia", "I/345/gaia2 2s %s" % star.upper(), found[source_id]
+                    )
+            else:
+                to_resolve.append(star)
+
+    v = Vizier(columns=["_r", "Gmag"] + list(GAIA_COLUMNS.values()), row_limit=-1)
+
+    def _crossmatch(chunk):
+        coords = _simbad_skycoord([records[x] for x in chunk])
+        return v.query_region(coords, radius=2 * u.arcsec, catalog="I/345/gaia2")
+
+    # The stars whose cross-match failed stay unknown (None): previs.search
+    # queries Gaia for each of them.
+    results = []
+    for i in range(0, len(to_resolve), chunk_size):
+        results += _bulk(_crossmatch, to_resolve[i : i + chunk_size], "Gaia DR2")
+    for chunk, res in results:
+        found = {}
+        if "I/345/gaia2" in res.keys():
+            tab = res["I/345/gaia2"]
+            r = _r_arcsec(tab["_r"])
+            q = np.ma.getdata(tab["_q"]).astype(int) - 1
+            for j in np.argsort(r)[::-1]:
+                found[q[j]] = j  # nearest source of each position
+            found = {k: _gaia_record(tab, j) for k, j in found.items()}
+
+        for k, star in enumerate(chunk):
+            astrometry[star] = found.get(k, {})
+            if cache is not None:
+                cache.set("gaia", "I/345/gaia2 2s %s" % star.upper(), astrometry[star])
+    return astrometry
+
+
+def search(
+    star,
+    source="ESO",
+    min_elev=30,
+    check=False,
+    verbose=False,
+    simbad=None,
+    gaia=None,
+    limits_period=None,
+):
     """Perform a large search to get informations about a star or a list of stars (observability, magnitude, distance, sed, etc.)
 
     Parameters
@@ -68,8 +436,16 @@ def search(star, source="ESO", min_elev=30, check=False, verbose=False):
         saved limiting magnitudes as in Jan. 2020 (P105). The informations are stored in data/eso_limits_matisse.json,\n
     `verbose`: {bool}
         Print some informations about the ongoing process (default: False). The verbose ability is not properly
-        compatible with the progress bar print (not very fancy).
-
+        compatible with the progress bar print (not very fancy),\n
+    `simbad`: {dict}, (optional)
+        Simbad record of the star already resolved with `resolve_simbad`. If None (default),
+        Simbad is queried,\n
+    `gaia`: {dict}, (optional)
+        Gaia DR2 informations of the star already fetched with `resolve_gaia`. If None
+        (default), Gaia DR2 is queried,\n
+    `limits_period`: {str}, (optional)
+        ESO period of the MATISSE limits (e.g.: 'P105'). If given, the limits stored for
+        this period are used (see `previs.instr.stored_periods`).
 
     Returns
     -------
@@ -89,76 +465,84 @@ def search(star, source="ESO", min_elev=30, check=False, verbose=False):
     """
     if check_servers_response() is None:
         return None
+    limits = get_limits(source, check, limits_period)
+    return _search(
+        star, source, min_elev, check, verbose, simbad, limits=limits, gaia=gaia
+    )
 
-    start_time = time.time()
+
+_stage_executor = None
+_stage_pid = None
+_stage_lock = threading.Lock()
+
+
+def _reset_stage_lock():
+    # The lock may be held by another thread when a worker process is forked.
+    global _stage_lock
+    _stage_lock = threading.Lock()
+
+
+os.register_at_fork(after_in_child=_reset_stage_lock)
+
+
+def _get_stage_executor():
+    """Threads used to send the requests of one search at the same time (one
+    executor per process, created by the first survey thread which needs it)."""
+    global _stage_executor, _stage_pid
+    with _stage_lock:
+        if _stage_executor is None or _stage_pid != os.getpid():
+            _stage_executor = ThreadPoolExecutor(
+                max_workers=2 * N_NETWORK_CONCURRENCY, thread_name_prefix="previs"
+            )
+            _stage_pid = os.getpid()
+        return _stage_executor
+
+
+def _init_data(star):
     if type(star) != str:
         raise NameError("Input need to be a target name (str).")
-
-    star_user = star
-    star = star.upper()
-    if verbose:
-        cprint("\n%s: search started (could take up to 30 seconds)..." % star, "cyan")
     data = {"Simbad": False}
     data["Ins"] = None
-    data["Name"] = star
-    # --------------------------------------
-    #       Coordinates of the target
-    # --------------------------------------
-    coord = {}
-    customSimbad = Simbad()
-    customSimbad.add_votable_fields("parallax", "sp_type", "ids", "V", "B")
+    data["Name"] = star.upper()
+    return data
+
+
+def _add_simbad(data, simbad, star_user):
+    """Add the Simbad informations (coordinates, distance, spectral type) and
+    return the celestial coordinates of the star."""
+    if simbad is None:
+        raise ValueError("%s not in Simbad!" % star_user)
 
     try:
-        objet = customSimbad.query_object(star)
-        coord[star] = np.array([objet["ra"][0], objet["dec"][0]])
-        coordo = str(coord[star][0]) + " " + str(coord[star][1])
+        coordo = str(simbad["ra"]) + " " + str(simbad["dec"])
         c = ac.SkyCoord(coordo, unit=(u.hourangle, u.deg))
         data["Coord"] = coordo
 
-        plx = ufloat(objet["plx_value"].data[0], objet["plx_err"].data[0])
+        plx = ufloat(simbad["plx"], simbad["e_plx"])
         d = 1 / plx
         data["Distance"] = {"d": d.nominal_value, "e_d": d.std_dev}
         data["Simbad"] = True
-        aa = str(objet["sp_type"].data[0])
-        if "b" in aa:
-            sptype = aa.split("b")[1].split("'")[1]
-        else:
-            sptype = aa
-        data["Sp_type"] = sptype
+        data["Sp_type"] = simbad["sp_type"]
     except Exception as exc:
         raise ValueError("%s not in Simbad!" % star_user) from exc
-    # --------------------------------------
-    #                 SED
-    # --------------------------------------
-    if verbose:
-        print("Get SED from Vizier database...")
-    sed = getSed(coordo)
-    data["SED"] = sed
+    return c
 
-    # --------------------------------------
-    #       Magnitude of the target
-    # --------------------------------------
+
+def _add_mag(data, sed, simbad):
+    """Add the SED and the magnitudes extracted from the SED. Return False if
+    the SED is not available."""
+    data["SED"] = sed
     l_bands = ["B", "V", "R", "J", "H", "K", "L", "M", "N"]
 
     try:
         with np.errstate(divide="ignore"):
             magB, magV, magR, magJ, magH, magK, magL, magM, magN = sed2mag(sed, l_bands)
     except TypeError:
-        return None
+        return False
 
     if np.isnan(magV):
-        try:
-            magV = objet["FLUX_V"][0]
-            if magV is np.ma.masked:
-                magV = np.nan
-        except Exception:
-            pass
-    try:
-        magB = objet["FLUX_B"][0]
-        if magB is np.ma.masked:
-            magB = np.nan
-    except Exception:
-        magB = np.nan
+        magV = simbad["V"]
+    magB = simbad["B"]
 
     data["Mag"] = {
         "magB": float(magB),
@@ -171,51 +555,14 @@ def search(star, source="ESO", min_elev=30, check=False, verbose=False):
         "magN": float(magN),
         "magJ": float(magJ),
     }
+    return True
 
-    if verbose:
-        t1 = printtime("Check SED: done", start_time)
-    # --------------------------------------
-    #                GAIA DR2
-    # --------------------------------------
-    columns = [
-        "_r",
-        "RA_ICRS",
-        "DE_ICRS",
-        "e_RA_ICRS",
-        "e_DE_ICRS",
-        "Gmag",
-        "Plx",
-        "e_Plx",
-        "pmRA",
-        "e_pmRA",
-        "pmDE",
-        "e_pmDE",
-        "Teff",
-    ]
-    v = Vizier(columns=columns)
+
+def _add_gaia(data, gaia):
     data["Gaia_dr2"] = {}
-    try:
-        res = v.query_region(star, radius="2s", catalog="I/345/gaia2")
-        data["Mag"]["magG"] = float(np.ma.getdata(res["I/345/gaia2"]["Gmag"])[0])
-        data["Gaia_dr2"]["RA"] = float(np.ma.getdata(res["I/345/gaia2"]["RA_ICRS"])[0])
-        data["Gaia_dr2"]["e_RA"] = float(
-            np.ma.getdata(res["I/345/gaia2"]["e_RA_ICRS"])[0]
-        )
-        data["Gaia_dr2"]["DEC"] = float(np.ma.getdata(res["I/345/gaia2"]["DE_ICRS"])[0])
-        data["Gaia_dr2"]["e_DEC"] = float(
-            np.ma.getdata(res["I/345/gaia2"]["e_DE_ICRS"])[0]
-        )
-        data["Gaia_dr2"]["Plx"] = float(np.ma.getdata(res["I/345/gaia2"]["Plx"])[0])
-        data["Gaia_dr2"]["e_Plx"] = float(np.ma.getdata(res["I/345/gaia2"]["e_Plx"])[0])
-        data["Gaia_dr2"]["pmRA"] = float(np.ma.getdata(res["I/345/gaia2"]["pmRA"])[0])
-        data["Gaia_dr2"]["e_pmRA"] = float(
-            np.ma.getdata(res["I/345/gaia2"]["e_pmRA"])[0]
-        )
-        data["Gaia_dr2"]["pmDE"] = float(np.ma.getdata(res["I/345/gaia2"]["pmDE"])[0])
-        data["Gaia_dr2"]["e_pmDE"] = float(
-            np.ma.getdata(res["I/345/gaia2"]["e_pmDE"])[0]
-        )
-        data["Gaia_dr2"]["Teff"] = float(np.ma.getdata(res["I/345/gaia2"]["Teff"])[0])
+    if gaia:
+        data["Mag"]["magG"] = gaia["Gmag"]
+        data["Gaia_dr2"].update({k: gaia[k] for k in GAIA_COLUMNS})
 
         plx = ufloat(data["Gaia_dr2"]["Plx"], data["Gaia_dr2"]["e_Plx"])
 
@@ -223,7 +570,7 @@ def search(star, source="ESO", min_elev=30, check=False, verbose=False):
         data["Gaia_dr2"]["check"] = True
         data["Gaia_dr2"]["Dkpc"] = Dkpc.nominal_value
         data["Gaia_dr2"]["e_Dkpc"] = Dkpc.std_dev
-    except Exception:
+    else:
         data["Gaia_dr2"]["check"] = False
         data["Gaia_dr2"]["Dkpc"] = np.nan
         data["Gaia_dr2"]["e_Dkpc"] = np.nan
@@ -232,114 +579,506 @@ def search(star, source="ESO", min_elev=30, check=False, verbose=False):
         data["Gaia_dr2"]["pmRA"] = np.nan
         data["Gaia_dr2"]["pmDE"] = np.nan
         data["Mag"]["magG"] = np.nan
-    if verbose:
-        t2 = printtime("Check Gaia: done", t1)
-    # --------------------------------------
-    #             Guiding star
-    # --------------------------------------
-    data["Guiding_star"] = {}
-    v = Vizier(columns=["*", "+<Gmag>"])
 
+
+def _need_guiding_star(data):
+    """The star is too faint (or too bright) in G (or R) to be used as guiding
+    star at the VLTI."""
     cond_guid_1 = np.isnan(data["Mag"]["magG"]) and (np.isnan(data["Mag"]["magR"]))
     cond_guid_2 = (data["Mag"]["magG"] >= 12.5) or (data["Mag"]["magG"] <= -3)
     cond_guid_3 = np.isnan(data["Mag"]["magG"]) and (
         (data["Mag"]["magR"] >= 12.5) or (data["Mag"]["magR"] <= -3)
     )
+    return cond_guid_1 or cond_guid_2 or cond_guid_3
 
-    if cond_guid_1 or cond_guid_2 or cond_guid_3:
-        res = v.query_region(star, radius="57s", catalog="I/337/gaia")
 
-        try:
-            Gmag = np.ma.getdata(res["I/337/gaia"]["<Gmag>"])
-        except TypeError:
-            return None
+def _add_guiding_star(data, guid):
+    data["Guiding_star"] = {}
+    if guid is not None:
+        data["Guiding_star"]["VLTI"] = guid
+    else:
+        data["Guiding_star"]["VLTI"] = "Science star"
 
-        cond1 = Gmag <= 12.5
-        cond2 = (Gmag <= 15) & (Gmag > 12.5)
+    magV, magR = data["Mag"]["magV"], data["Mag"]["magR"]
+    data["Guiding_star"]["CHARA"] = bool(np.min([magV, magR]) <= 10)
 
-        gmag1 = np.ma.getdata(res["I/337/gaia"]["<Gmag>"][cond1])
-        ra1 = np.ma.getdata(res["I/337/gaia"]["RA_ICRS"][cond1])
-        dec1 = np.ma.getdata(res["I/337/gaia"]["DE_ICRS"][cond1])
 
-        gmag2 = np.ma.getdata(res["I/337/gaia"]["<Gmag>"][cond2])
-        ra2 = np.ma.getdata(res["I/337/gaia"]["RA_ICRS"][cond2])
-        dec2 = np.ma.getdata(res["I/337/gaia"]["DE_ICRS"][cond2])
+def _observability(dec, min_elev):
+    """Observability from the sites (VLTI and CHARA) of stars with declination
+    `dec` [deg] (arrays of bool)."""
+    L_paranal = -24.63  # Lattitude deg
+    L_chara = 34.2236
+    dec = np.atleast_1d(np.asarray(dec, dtype=float))
+    return {
+        "VLTI": dec <= ((90 - min_elev) - abs(L_paranal)),
+        "CHARA": dec >= (L_chara - (90 - min_elev)),
+    }
 
-        guid1, guid2 = [], []
 
-        for i in range(len(ra1)):
-            guid1.append([float(ra1[i]), float(dec1[i]), float(gmag1[i])])
-        for i in range(len(ra2)):
-            guid2.append([float(ra2[i]), float(dec2[i]), float(gmag2[i])])
+def _add_ins(data, c, min_elev, source, check, limits):
+    """Add the observability from the sites and with each instrument."""
+    # --------------------------------------
+    #             Observability
+    # --------------------------------------
+    data["Observability"] = limits_view(_observability(c.dec.deg, min_elev), 0)
+    # --------------------------------------
+    #       Limit interferometers
+    # --------------------------------------
+    ins = instrument_limits(data["Mag"], source=source, check=check, limits=limits)
+    data["Ins"] = limits_view(ins, 0)
 
-        data["Guiding_star"]["VLTI"] = [guid1, guid2]
-    else:
-        data["Guiding_star"]["VLTI"] = "Science star"
 
-    data["Guiding_star"]["CHARA"] = bool(np.min([magV, magR]) <= 10)
+def _search(star, source, min_elev, check, verbose, simbad, limits=None, gaia=None):
+    start_time = time.time()
+    data = _init_data(star)
 
+    star_user = star
+    star = star.upper()
     if verbose:
-        t3 = printtime("Check guiding star: done,", t2)
+        cprint("\n%s: search started (could take up to 30 seconds)..." % star, "cyan")
     # --------------------------------------
-    #             Observability
+    #       Coordinates of the target
     # --------------------------------------
-    L_paranal = -24.63  # Lattitude deg
-    L_chara = 34.2236
-    Obs = {"VLTI": False, "CHARA": False}
+    if simbad is None:
+        try:
+            simbad = get_simbad(star)
+        except Exception as exc:
+            raise ValueError("%s not in Simbad!" % star_user) from exc
+    c = _add_simbad(data, simbad, star_user)
+    # --------------------------------------
+    #         SED, Gaia DR2 and guiding star
+    # --------------------------------------
+    # The SED and Gaia requests only depend on the Simbad informations, so
+    # they are sent at the same time. If the Gaia astrometry is already known
+    # (bulk request of previs.survey), Gaia is only queried if a guiding star
+    # is needed.
+    if verbose:
+        print("Get SED from Vizier database...")
+    ex = _get_stage_executor()
+    f_sed = ex.submit(cached, "sed", data["Coord"], getSed, data["Coord"])
+    source_id = gaia_dr2_id(simbad)
+    f_gaia = ex.submit(get_gaia, star, source_id) if gaia is None else None
+
+    sed = f_sed.result()
+    if not _add_mag(data, sed, simbad):
+        return None
 
-    if c.dec.deg <= ((90 - min_elev) - abs(L_paranal)):
-        Obs["VLTI"] = True
-    if c.dec.deg >= (L_chara - (90 - min_elev)):
-        Obs["CHARA"] = True
+    if verbose:
+        t1 = printtime("Check SED: done", start_time)
+
+    field = None
+    if f_gaia is not None:
+        field = f_gaia.result()
+        gaia = field["star"] if field is not None else None
+    _add_gaia(data, gaia)
 
-    data["Observability"] = Obs
+    if verbose:
+        t2 = printtime("Check Gaia: done", t1)
+
+    guid = None
+    if _need_guiding_star(data):
+        if field is None:
+            field = get_gaia(star, source_id)
+        if field is None:
+            return None
+        guid = field["guiding"]
+    _add_guiding_star(data, guid)
+
+    if verbose:
+        t3 = printtime("Check guiding star: done,", t2)
     # --------------------------------------
-    #       Limit interferometers
+    #   Observability and instruments
     # --------------------------------------
-    tmp = {}
-    tmp["PIONIER"] = pionier_limit(magH)
-    tmp["CHARA"] = chara_limit(magK, magH, magR, magV)
-    tmp["MATISSE"] = matisse_limit(magL, magM, magN, magK, source=source, check=check)
-    tmp["GRAVITY"] = gravity_limit(magV, magK)
-    tmp["VISION"] = ivis_limit(magR)
-    data["Ins"] = tmp
-    data["Name"] = star
+    _add_ins(data, c, min_elev, source, check, limits)
     if verbose:
         printtime("Check Instruments: done", t3)
         cprint("Done (%2.2f s)." % (time.time() - start_time), "cyan")
     return data
 
 
-def f(out, star):
-    out[star] = search(star, check=False, verbose=False)
-    return out
+# Maximum number of simultaneous requests sent to the VO services.
+N_NETWORK_CONCURRENCY = 8
+
+
+def default_workers():
+    """Default number of survey workers (bounded by the number of CPUs and the
+    network concurrency)."""
+    return max(1, min(os.cpu_count() or 1, N_NETWORK_CONCURRENCY))
+
+
+_pool = None
+_pool_size = None
+_pool_limits = None
+_worker_limits = None
+
+
+def _init_worker(limits):
+    """Initialize a survey worker: the MATISSE limits are loaded once for all
+    the stars processed by the worker."""
+    global _worker_limits
+    _worker_limits = limits
+
+
+def _survey_task(star, simbad, gaia, limits):
+    try:
+        data = _search(
+            star,
+            source="ESO",
+            min_elev=30,
+            check=False,
+            verbose=False,
+            simbad=simbad,
+            limits=limits,
+            gaia=gaia,
+        )
+    except Exception as exc:
+        return star, None, str(exc)
+    return star, data, None
+
+
+def _survey_worker(args):
+    """Search one star in a worker process. The result is sent back to the
+    main process already pickled (with the standard pickle, much faster
+    than the dill pickler used by multiprocess for nested dictionnaries)."""
+    star, simbad, gaia = args
+    result = _survey_task(star, simbad, gaia, _worker_limits)
+    return pickle.dumps(result, protocol=pickle.HIGHEST_PROTOCOL)
+
 
+def get_pool(max_workers=None, limits=None):
+    """Return the pool of survey workers. The pool is created at the first call
+    and reused by the following surveys (a new pool is created if
+    `max_workers` or the MATISSE `limits` change)."""
+    global _pool, _pool_size, _pool_limits
+    if max_workers is None:
+        max_workers = default_workers()
+    if limits is None:
+        limits = get_limits(check=False)
 
-def survey(list_star):
+    if _pool is not None and (_pool_size != max_workers or _pool_limits != limits):
+        close_pool()
+
+    if _pool is None:
+        from multiprocess import Pool
+
+        _pool = Pool(
+            processes=max_workers, initializer=_init_worker, initargs=(limits,)
+        )
+        _pool_size, _pool_limits = max_workers, limits
+    return _pool
+
+
+def close_pool(terminate=False):
+    """Close the pool of survey workers (if `terminate`, the tasks not completed
+    are stopped)."""
+    global _pool, _pool_size, _pool_limits
+    if _pool is not None:
+        if terminate:
+            _pool.terminate()
+        else:
+            _pool.close()
+        _pool.join()
+        _pool, _pool_size, _pool_limits = None, None, None
+
+
+atexit.register(close_pool)
+
+
+def _run_survey(tasks, executor, max_workers, limits):
+    """Perform the search of each star with the selected executor and yield the
+    results (star, data, error) as soon as they are available."""
+    if executor == "threads":
+        if max_workers is None:
+            max_workers = N_NETWORK_CONCURRENCY
+        ex = ThreadPoolExecutor(max_workers=max_workers)
+        try:
+            futures = [ex.submit(_survey_task, *task, limits) for task in tasks]
+            for future in as_completed(futures):
+                yield future.result()
+        finally:
+            # The searches not started are cancelled if the loop is stopped.
+            ex.shutdown(wait=False, cancel_futures=True)
+    elif executor == "processes":
+        pool = get_pool(max_workers, limits)
+        completed = False
+        try:
+            for raw in pool.imap_unordered(_survey_worker, tasks):
+                yield pickle.loads(raw)
+            completed = True
+        finally:
+            # The tasks already sent to the pool can not be cancelled: if the
+            # loop is stopped, the pool is terminated (and recreated by the
+            # next survey) so that the remaining searches are not performed.
+            if not completed:
+                close_pool(terminate=True)
+    else:
+        raise ValueError("executor must be 'threads' or 'processes'.")
+
+
+def _iter_survey(list_star, executor, max_workers, limits_period, output, resume):
+    cprint("\nStarting survey on %i stars:" % len(list_star), "cyan")
+    cprint("-------------------------", "cyan")
+
+    ofile, done = None, {}
+    if output is not None:
+        ofile, done = open_jsonl(output, resume)
+    todo = [star for star in list_star if star not in done]
+    if len(todo) != len(list_star):
+        cprint("%i stars already saved in %s." % (len(done), output), "cyan")
+
+    try:
+        for star in list_star:
+            if star in done:
+                yield star, done[star]
+        if len(todo) == 0:
+            return
+        limits = get_limits(check=False, period=limits_period)
+        records = resolve_simbad(todo)
+        astrometry = resolve_gaia(records)
+        tasks = [(star, records.get(star), astrometry.get(star)) for star in todo]
+        for star, data, error in _run_survey(tasks, executor, max_workers, limits):
+            if error is not None:
+                cprint("%s: %s" % (star, error), "red")
+                continue
+            if ofile is not None:
+                write_jsonl(ofile, star, data)
+            yield star, data
+    finally:
+        if ofile is not None:
+            ofile.close()
+
+
+def iter_results(
+    list_star,
+    executor="threads",
+    max_workers=None,
+    limits_period=None,
+    output=None,
+    resume=False,
+):
+    """Perform previs search on a list of stars and yield the results (star,
+    data) as soon as each search is completed (see previs.survey for the
+    parameters). data is None if the search gave no result (e.g. no SED
+    found). The stars already saved in `output` (if `resume`) are yielded
+    first. The loop can be stopped at any time: the remaining searches are
+    cancelled (with executor='processes', the pool of workers is terminated,
+    see `close_pool`).
+
+    Example:
+    --------
+    >>> for star, data in previs.iter_results(["Altair", "Vega", "WR104"]):
+    ...     if data is not None:
+    ...         print(star, data["Mag"]["magK"])
+    """
+    if executor not in ["threads", "processes"]:
+        raise ValueError("executor must be 'threads' or 'processes'.")
+
+    if check_servers_response() is None:
+        return iter(())
+
+    if len(list_star) == 0:
+        raise ValueError("The target list is empty.")
+
+    return _iter_survey(list_star, executor, max_workers, limits_period, output, resume)
+
+
+def survey(
+    list_star,
+    executor="threads",
+    max_workers=None,
+    limits_period=None,
+    output=None,
+    resume=False,
+):
     """Perform previs search on a list of stars.
     Parameters
     ----------
     `list_star` : {list}
-        List of stars.\n
+        List of stars,\n
+    `executor` : {str}
+        If 'threads' (default), the searches are performed by a pool of threads
+        (the requests to the VO are I/O-bound). If 'processes', a pool of processes
+        is used instead. The processes are kept alive and reused by the next
+        surveys (see `close_pool`),\n
+    `max_workers` : {int}
+        Number of threads or processes used to perform the search (default:
+        N_NETWORK_CONCURRENCY threads, or number of CPUs processes up to
+        N_NETWORK_CONCURRENCY),\n
+    `limits_period` : {str}
+        ESO period of the MATISSE limits (e.g.: 'P105'). If None (default), the most
+        recent stored limits are used,\n
+    `output` : {str}
+        JSON Lines file where the result of each star is written as soon as it is
+        found (one star per line, see previs.load),\n
+    `resume` : {bool}
+        If True, the stars already saved in `output` are not searched again (to
+        restart an interrupted survey). The stars saved without result are
+        searched again.\n
     Returns
     -------
     `survey`: {dict}
         Dictionnary containing previs search for all stars.
     """
+    if executor not in ["threads", "processes"]:
+        raise ValueError("executor must be 'threads' or 'processes'.")
+
     if check_servers_response() is None:
         return None
 
     if len(list_star) == 0:
         raise ValueError("The target list is empty.")
 
-    cprint("\nStarting survey on %i stars:" % len(list_star), "cyan")
-    cprint("-------------------------", "cyan")
+    results = _iter_survey(
+        list_star, executor, max_workers, limits_period, output, resume
+    )
+    out = dict(results)
+    return {star: out[star] for star in list_star if star in out}
+
+
+def rescore(survey, source="ESO", min_elev=30, limits_period=None):
+    """Recompute the observability of the stars of a survey (`Ins` and
+    `Observability`) from the saved magnitudes and coordinates, without
+    querying the VO (e.g. with new ESO limits or another minimal elevation).
+
+    Parameters
+    ----------
+    `survey` : {dict}
+        Results of previs.survey (or loaded with previs.load),\n
+    `source`: {str}
+        Limiting magnitudes of MATISSE ('ESO' (default) or estimated performances),\n
+    `min_elev`: {float}
+        Minimal elevation of the stars to be observed on site (default: 30 deg),\n
+    `limits_period` : {str}
+        ESO period of the MATISSE limits (e.g.: 'P105'). If None (default), the most
+        recent stored limits are used.\n
+    Returns
+    -------
+    `survey`: {dict}
+        New dictionnary of the survey with the updated observability (the other
+        informations are shared with the input survey).
+    """
+    # The stars without result (None) are kept unchanged.
+    stars = [star for star in survey if survey[star] is not None]
+    if len(stars) == 0:
+        return dict(survey)
+
+    limits = get_limits(source, False, limits_period)
+    keys = ["magB", "magV", "magR", "magJ", "magH", "magK", "magL", "magM", "magN"]
+    mag = {k: [survey[star]["Mag"].get(k, np.nan) for star in stars] for k in keys}
+    dec = [_coord_deg(survey[star]["Coord"])[1] for star in stars]
+
+    ins = limits_views(instrument_limits(mag, limits=limits))
+    obs = limits_views(_observability(dec, min_elev))
+
+    out = dict(survey)
+    for i, star in enumerate(stars):
+        data = dict(survey[star])
+        data["Observability"] = obs[i]
+        data["Ins"] = ins[i]
+        out[star] = data
+    return out
+
+
+def _mean_samples(ins, n_samples):
+    """Fraction of the samples where each mode is observable (the fields
+    which are not boolean, e.g. GRAVITY V_cond, are skipped)."""
+    out = {}
+    for k, v in ins.items():
+        if isinstance(v, dict):
+            out[k] = _mean_samples(v, n_samples)
+        elif v.dtype == bool:
+            out[k] = v.reshape(n_samples, -1).mean(axis=0)
+    return out
+
 
-    from multiprocess import Process, Manager
+def observable_probability(
+    survey,
+    n_samples=500,
+    source="ESO",
+    limits_period=None,
+    seed=None,
+    chunk=1000,
+):
+    """Probability for each star of a survey to be observable with each
+    instrument mode, given the uncertainties of its magnitudes. The errors of
+    the SED fluxes ('Err') are propagated to the magnitudes interpolated from
+    the SED, keeping the correlations between bands interpolated from the same
+    points. The magnitudes extrapolated by previs.fit.fill_missing_mags use
+    their fitted errors. The other magnitudes (e.g.: magB from Simbad, or
+    points of the SED without error) are considered exact.
 
-    manager = Manager()
-    d = manager.dict()
-    job = [Process(target=f, args=(d, list_star[i])) for i in range(len(list_star))]
-    _ = [p.start() for p in job]
-    _ = [p.join() for p in job]
-    return d
+    Parameters
+    ----------
+    `survey` : {dict}
+        Results of previs.survey (or loaded with previs.load),\n
+    `n_samples` : {int}
+        Number of Monte Carlo samples of the magnitudes of each star,\n
+    `source`: {str}
+        Limiting magnitudes of MATISSE ('ESO' (default) or estimated performances),\n
+    `limits_period` : {str}
+        ESO period of the MATISSE limits (e.g.: 'P105', default: most recent),\n
+    `seed` : {int}
+        Seed of the random generator (for reproducible results),\n
+    `chunk` : {int}
+        Number of stars sampled at the same time.\n
+    Returns
+    -------
+    `survey`: {dict}
+        New dictionnary of the survey with data['P_ins'] (same structure as
+        data['Ins'], probability of each instrument mode) and data['Mag_err']
+        (standard deviation of the sampled magnitudes).
+    """
+    # The stars without result (None) are kept unchanged.
+    stars = [star for star in survey if survey[star] is not None]
+    if len(stars) == 0:
+        return dict(survey)
+
+    rng = np.random.default_rng(seed)
+    limits = get_limits(source, False, limits_period)
+    bands = ["B", "V", "R", "J", "H", "K", "L", "M", "N"]
+    keys = ["mag" + band for band in bands]
+    wl_band = [CONV_FLUX[band]["wl"] for band in bands]
+
+    p_ins, mag_err = [], []
+    for i0 in range(0, len(stars), chunk):
+        sub = [survey[star] for star in stars[i0 : i0 + chunk]]
+        mag = np.array([[d["Mag"].get(k, np.nan) for k in keys] for d in sub])
+        e_fit = np.array(
+            [[d.get("Mag_fit", {}).get("e_" + k, 0.0) for k in keys] for d in sub]
+        )
+        seds = [d.get("SED") for d in sub]
+        wl, flux, offsets = stack_seds(seds)
+        err = stack_errors(seds)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            sigma = np.nan_to_num(err / (flux * np.log(10)), nan=0.0, posinf=0.0)
+        sigma = np.abs(sigma)
+
+        noise = rng.standard_normal((n_samples,) + mag.shape)
+        delta = noise * e_fit
+        if len(wl) != 0:
+            lo, hi, t, outside = interp_weights(wl, offsets, wl_band)
+            points = np.concatenate([lo.ravel(), hi.ravel()])
+            used, inv = np.unique(points, return_inverse=True)
+            inv_lo, inv_hi = np.split(inv, 2)
+            inv_lo, inv_hi = inv_lo.reshape(lo.shape), inv_hi.reshape(hi.shape)
+            eps = rng.standard_normal((n_samples, len(used))) * sigma[used]
+            delta_sed = -2.5 * ((1 - t) * eps[:, inv_lo] + t * eps[:, inv_hi])
+            from_sed = ~outside
+            from_sed[:, 0] = False  # magB is taken from Simbad
+            delta = np.where(from_sed, delta_sed, delta)
+
+        samples = (mag + delta).reshape(-1, len(keys))
+        ins = instrument_limits(
+            {k: samples[:, j] for j, k in enumerate(keys)}, source, False, limits
+        )
+        p_ins += limits_views(_mean_samples(ins, n_samples))
+        std = np.nan_to_num(np.std(mag + delta, axis=0))
+        mag_err += [dict(zip(keys, row)) for row in std.tolist()]
+
+    out = dict(survey)
+    for i, star in enumerate(stars):
+        data = dict(survey[star])
+        data["P_ins"] = p_ins[i]
+        data["Mag_err"] = mag_err[i]
+        out[star] = data
+    return out
@@ -0,0 +1,168 @@
+"""
+@author: Anthony Soulain (University of Sydney)
+
+--------------------------------------------------------------------
+PREVIS: Python Request Engine for Virtual Interferometric Survey
+--------------------------------------------------------------------
+
+This file contains the registry of the photometric filters used to compute
+synthetic magnitudes from the SED. The transmission curves are resampled
+once on a common wavelength grid and stored as a sparse matrix of weights
+(one row per filter), so that the flux of a star in all the filters is a
+single matrix-vector product.
+
+The built-in filters are approximated by top-hat transmissions (central
+wavelength and width [µm], zero point [Jy]). Tabulated transmission curves
+can be added with register_filter.
+"""
+import numpy as np
+from scipy import sparse
+
+from previs.sed import CONV_FLUX
+from previs.sed import interp_log_flux
+from previs.sed import stack_seds
+
+# Common wavelength grid of the filters [µm] (resolution ~0.15%).
+WL_GRID = np.geomspace(0.3, 30, 3000)
+
+# Widths of the Johnson bands [µm] (Bessell 1990, Bessell & Brett 1988).
+_JOHNSON_WIDTH = {
+    "B": 0.098,
+    "V": 0.089,
+    "R": 0.138,
+    "I": 0.149,
+    "J": 0.213,
+    "H": 0.307,
+    "K": 0.390,
+    "L": 0.472,
+    "M": 0.460,
+    "N": 5.000,
+    "Q": 7.600,
+}
+
+_FILTERS = {}
+_matrices = {}
+
+
+def register_filter(name, wl, transmission, F0):
+    """
+    Add a filter to the registry (or replace it).
+
+    Parameters:
+    -----------
+    `name`: {str}
+        Name of the filter (e.g.: 'WISE_W1'),\n
+    `wl`: {array}
+        Wavelengths of the transmission curve [µm],\n
+    `transmission`: {array}
+        Transmission of the filter (any normalisation),\n
+    `F0`: {float}
+        Flux density of magnitude 0 [Jy].
+    """
+    wl = np.asarray(wl, dtype=float)
+    order = np.argsort(wl)
+    trans = np.interp(WL_GRID, wl[order], np.asarray(transmission)[order], 0, 0)
+    if not np.any(trans > 0):
+        raise ValueError("The filter %s is outside the wavelength grid." % name)
+    _FILTERS[name] = {"T": trans, "F0": float(F0)}
+    _matrices.clear()
+
+
+def register_tophat(name, wl0, width, F0):
+    """Add a filter with a top-hat transmission (central wavelength `wl0` and
+    `width` [µm], zero point `F0` [Jy])."""
+    lo, hi = wl0 - width / 2.0, wl0 + width / 2.0
+    eps = 1e-9
+    wl = [lo - eps, lo, hi, hi + eps]
+    register_filter(name, wl, [0, 1, 1, 0], F0)
+
+
+def filter_names():
+    """Names of the registered filters."""
+    return list(_FILTERS)
+
+
+def filter_matrix(filters=None):
+    """
+    Weights of the filters on the wavelength grid WL_GRID.
+
+    Returns:
+    --------
+    `W`: {scipy.sparse.csr_matrix}
+        Matrix (number of filters, len(WL_GRID)) so that W @ flux is the mean
+        flux density of the star in each filter (flux sampled on WL_GRID),\n
+    `F0`: {array}
+        Zero points of the filters [Jy].
+    """
+    names = tuple(filter_names() if filters is None else filters)
+    if names not in _matrices:
+        dwl = np.gradient(WL_GRID)
+        rows = []
+        for name in names:
+            weight = _FILTERS[name]["T"] * dwl
+            rows.append(weight / weight.sum())
+        F0 = np.array([_FILTERS[name]["F0"] for name in names])
+        _matrices[names] = (sparse.csr_matrix(np.array(rows)), F0)
+    return _matrices[names]
+
+
+def synthetic_mags(wl, flux, offsets, filters=None, chunk=1000):
+    """
+    Synthetic magnitudes of many stars in the registered filters.
+
+    Parameters:
+    -----------
+    `wl`, `flux`, `offsets`: {array}
+        SED of the stars (flat arrays, see previs.sed.stack_seds),\n
+    `filters`: {list}
+        Names of the filters (default: all the registered filters),\n
+    `chunk`: {int}
+        Number of stars resampled on the grid at the same time.
+
+    Returns:
+    --------
+    `mag`: {array}
+        Magnitudes (shape: (number of stars, number of filters)). NaN if the
+        SED does not cover the whole filter.
+    """
+    W, F0 = filter_matrix(filters)
+    wl, flux = np.asarray(wl, dtype=float), np.asarray(flux, dtype=float)
+    offsets = np.asarray(offsets, dtype=np.int64)
+    n_star = len(offsets) - 1
+    mag = np.full((n_star, len(F0)), np.nan)
+    for i in range(0, n_star, chunk):
+        off = offsets[i : i + chunk + 1]
+        sub = slice(off[0], off[-1])
+        logf = interp_log_flux(wl[sub], flux[sub], off - off[0], WL_GRID)
+        # The sparse product only uses the grid points inside each filter.
+        f_band = (W @ (10**logf).T).T
+        with np.errstate(divide="ignore", invalid="ignore"):
+            mag[i : i + chunk] = -2.5 * np.log10(f_band / F0)
+    return mag
+
+
+def sed2synmag(sed, filters=None):
+    """Synthetic magnitudes of one star (SED from previs.sed.getSed) in the
+    registered `filters` (default: all)."""
+    mag = synthetic_mags(*stack_seds([sed]), filters)[0]
+    names = filter_names() if filters is None else filters
+    return dict(zip(names, mag.tolist()))
+
+
+for _band, _width in _JOHNSON_WIDTH.items():
+    register_tophat(_band, CONV_FLUX[_band]["wl"], _width, CONV_FLUX[_band]["F0"])
+# Gaia DR2 G band (Evans et al. 2018)
+register_tophat("Gaia_G", 0.673, 0.440, 3228.75)
+# 2MASS (Cohen et al. 2003)
+register_tophat("2MASS_J", 1.235, 0.162, 1594.0)
+register_tophat("2MASS_H", 1.662, 0.251, 1024.0)
+register_tophat("2MASS_Ks", 2.159, 0.262, 666.7)
+# WISE (Wright et al. 2010)
+register_tophat("WISE_W1", 3.353, 0.663, 309.54)
+register_tophat("WISE_W2", 4.603, 1.042, 171.79)
+register_tophat("WISE_W3", 11.56, 5.507, 31.67)
+register_tophat("WISE_W4", 22.09, 4.101, 8.363)
+# Spectral windows of MATISSE (zero points of the Johnson L, M and N bands)
+register_tophat("MATISSE_L", 3.5, 1.4, CONV_FLUX["L"]["F0"])
+register_tophat("MATISSE_M", 4.75, 0.5, CONV_FLUX["M"]["F0"])
+register_tophat("MATISSE_N", 10.5, 5.0, CONV_FLUX["N"]["F0"])
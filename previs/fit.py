@@ -0,0 +1,255 @@
+"""
+@author: Anthony Soulain (University of Sydney)
+
+--------------------------------------------------------------------
+PREVIS: Python Request Engine for Virtual Interferometric Survey
+--------------------------------------------------------------------
+
+This file contains the blackbody fit of the SED, used to extrapolate the
+magnitudes not covered by the SED (often in L, M and N). All the stars are
+fitted at once by a grid search over the temperature (the scale factor is
+fitted analytically). The fit can be refined with emcee (one star per worker
+process of a pool).
+"""
+import numpy as np
+from scipy import sparse
+from scipy.constants import c as c_light
+from scipy.constants import h as h_planck
+from scipy.constants import k as k_boltzmann
+
+from previs.sed import CONV_FLUX
+from previs.sed import stack_errors
+from previs.sed import stack_seds
+
+# Temperatures of the grid search [K].
+T_GRID = np.geomspace(1500, 60000, 150)
+
+# Minimal relative error on the fluxes of the SED (5%).
+MIN_REL_ERR = 0.05
+
+_LN10 = np.log(10)
+
+# Number of wavelengths where the models are computed at the same time.
+_CHUNK = 10000
+
+
+def log_blackbody(wl, T):
+    """log10 of the flux density of a blackbody [Jy/sr] at the wavelength
+    `wl` [µm] for the temperature `T` [K] (arrays are broadcast)."""
+    nu = c_light / (np.asarray(wl, dtype=float) * 1e-6)
+    x = h_planck * nu / (k_boltzmann * np.asarray(T, dtype=float))
+    # log10(exp(x) - 1) without overflow.
+    with np.errstate(over="ignore"):
+        log_expm1 = np.where(x > 50, x / _LN10, np.log10(np.expm1(np.minimum(x, 50))))
+    return np.log10(2 * h_planck / c_light**2) + 3 * np.log10(nu) - log_expm1 + 26
+
+
+def _points(wl, flux, err, offsets):
+    """Valid points of the SED: star index, wavelength, log10(flux) and
+    weight (1 / error**2 in log10)."""
+    wl, flux = np.asarray(wl, dtype=float), np.asarray(flux, dtype=float)
+    err = np.asarray(err, dtype=float)
+    star = np.repeat(np.arange(len(offsets) - 1), np.diff(offsets))
+    with np.errstate(invalid="ignore"):
+        rel = np.where(err > 0, err / flux, 0)
+        ok = (flux > 0) & (wl > 0) & np.isfinite(flux)
+    rel = np.maximum(np.nan_to_num(rel), MIN_REL_ERR)
+    sigma = rel / _LN10
+    return star[ok], wl[ok], np.log10(flux[ok]), 1 / sigma[ok] ** 2
+
+
+def fit_blackbody(wl, flux, err, offsets, bands=("L", "M", "N")):
+    """
+    Fit a blackbody to many SED at once (grid search on the temperature).
+
+    Parameters:
+    -----------
+    `wl`, `flux`, `err`: {array}
+        Wavelengths [µm], fluxes and errors [Jy] of all the SED (flat arrays),\n
+    `offsets`: {array}
+        Start of the SED of each star (see previs.sed.stack_seds),\n
+    `bands`: {list}
+        Bands where the magnitudes of the model are computed.
+
+    Returns:
+    --------
+    `fit`: {dict}
+        Best temperature 'T' [K], log10 of the scale factor 'logA' (solid angle
+        [sr]), reduced chi2 'chi2_red', and the magnitudes 'mag' and their
+        errors 'e_mag' in each band (arrays, shape: (number of stars, number of
+        bands) for the magnitudes). The errors are marginalised over the
+        temperature grid (inflated by the reduced chi2 for poor fits). NaN if
+        the SED has less than 3 valid points.
+    """
+    n_star = len(offsets) - 1
+    star, x, y, w = _points(wl, flux, err, offsets)
+    n_point = np.bincount(star, minlength=n_star)
+    sum_w = np.bincount(star, weights=w, minlength=n_star)
+
+    wl_band = np.array([CONV_FLUX[band]["wl"] for band in bands])
+    log_F0 = np.log10([CONV_FLUX[band]["F0"] for band in bands])
+
+    # chi2(T) and the best scale factor only depend on weighted sums of the
+    # model over the points of each star. The SED of different stars share
+    # most of their wavelengths (same catalogs), so these sums are sparse
+    # products between (star, wavelength) weights and the model grid.
+    x_unique, x_index = np.unique(x, return_inverse=True)
+    shape = (n_star, len(x_unique))
+    M_w = sparse.csc_matrix((w, (star, x_index)), shape=shape)
+    M_wy = sparse.csc_matrix((w * y, (star, x_index)), shape=shape)
+    S_y = np.bincount(star, weights=w * y, minlength=n_star)[:, None]
+    S_yy = np.bincount(star, weights=w * y**2, minlength=n_star)[:, None]
+    S_w = sum_w[:, None]
+    S_b, S_bb, S_yb = (np.zeros((n_star, len(T_GRID))) for _ in range(3))
+    for i in range(0, len(x_unique), _CHUNK):
+        sub = slice(i, i + _CHUNK)
+        B = log_blackbody(x_unique[sub, None], T_GRID[None, :])
+        S_b += M_w[:, sub] @ B
+        S_bb += M_w[:, sub] @ B**2
+        S_yb += M_wy[:, sub] @ B
+
+    with np.errstate(invalid="ignore", divide="ignore"):
+        logA = ((S_y - S_b) / S_w).T
+        chi2 = (S_yy - 2 * S_yb + S_bb - (S_y - S_b) ** 2 / S_w).T
+        chi2 = np.maximum(chi2, 0)
+
+        best = np.argmin(np.where(np.isnan(chi2), np.inf, chi2), axis=0)
+        cols = np.arange(n_star)
+        chi2_min = chi2[best, cols]
+        chi2_red = chi2_min / (n_point - 2)
+        scale = np.maximum(chi2_red, 1)
+
+        # Magnitudes of the model for each temperature, weighted by the
+        # likelihood of the temperature.
+        p = np.exp(-(chi2 - chi2_min) / (2 * scale))
+        p /= p.sum(axis=0)
+        log_bb = log_blackbody(wl_band[None, :], T_GRID[:, None])
+        mags = -2.5 * (logA[:, :, None] + log_bb[:, None, :] - log_F0)
+        mag = np.einsum("ts,tsb->sb", p, mags)
+        var = np.einsum("ts,tsb->sb", p, (mags - mag) ** 2)
+        var += (2.5**2 * scale / sum_w)[:, None]
+
+    bad = n_point < 3
+    out = {
+        "T": T_GRID[best],
+        "logA": logA[best, cols],
+        "chi2_red": chi2_red,
+        "mag": mag,
+        "e_mag": np.sqrt(var),
+    }
+    for key in out:
+        out[key] = out[key].astype(float)
+        out[key][bad] = np.nan
+    return out
+
+
+def _log_prob(theta, x, y, w):
+    logT, logA = theta
+    if not np.log10(T_GRID[0]) - 0.5 < logT < np.log10(T_GRID[-1]) + 0.5:
+        return -np.inf
+    r = y - logA - log_blackbody(x, 10**logT)
+    return -0.5 * np.sum(w * r**2)
+
+
+def _emcee_star(args):
+    """Refine the fit of one star with emcee. Return the median and standard
+    deviation of the temperature and of the magnitudes in each band."""
+    import emcee
+
+    x, y, w, T0, logA0, scale, wl_band, log_F0, n_step, seed = args
+    rng = np.random.default_rng(seed)
+    n_walker = 16
+    p0 = np.array([np.log10(T0), logA0]) + 1e-3 * rng.standard_normal((n_walker, 2))
+    sampler = emcee.EnsembleSampler(n_walker, 2, _log_prob, args=(x, y, w / scale))
+    sampler.random_state = np.random.RandomState(seed).get_state()
+    sampler.run_mcmc(p0, n_step)
+    chain = sampler.get_chain(discard=n_step // 2, flat=True)
+    T = 10 ** chain[:, 0]
+    log_bb = log_blackbody(wl_band[None, :], T[:, None])
+    mags = -2.5 * (chain[:, 1][:, None] + log_bb - log_F0)
+    return np.median(T), np.median(mags, axis=0), np.std(mags, axis=0)
+
+
+def refine_emcee(
+    wl, flux, err, offsets, fit, bands=("L", "M", "N"), n_step=1000, max_workers=None
+):
+    """
+    Refine the blackbody fit (see fit_blackbody) with emcee. The stars are
+    processed in parallel by a pool of `max_workers` processes (default: number
+    of CPUs). The temperature 'T', 'mag' and 'e_mag' of `fit` are replaced by
+    the median and standard deviation of the posterior.
+    """
+    from multiprocess import Pool
+
+    star, x, y, w = _points(wl, flux, err, offsets)
+    wl_band = np.array([CONV_FLUX[band]["wl"] for band in bands])
+    log_F0 = np.log10([CONV_FLUX[band]["F0"] for band in bands])
+    index = np.flatnonzero(np.isfinite(fit["T"]))
+    tasks = []
+    for i in index:
+        sel = star == i
+        scale = max(fit["chi2_red"][i], 1)
+        tasks.append(
+            (x[sel], y[sel], w[sel], fit["T"][i], fit["logA"][i], scale)
+            + (wl_band, log_F0, n_step, int(i))
+        )
+
+    out = {key: np.array(value, copy=True) for key, value in fit.items()}
+    with Pool(processes=max_workers) as pool:
+        results = pool.map(_emcee_star, tasks)
+    for i, (T, mag, e_mag) in zip(index, results):
+        out["T"][i], out["mag"][i], out["e_mag"][i] = T, mag, e_mag
+    return out
+
+
+def fill_missing_mags(survey, bands=("L", "M", "N"), refine=False, max_workers=None):
+    """
+    Extrapolate the magnitudes not given by the SED with a blackbody fit.
+
+    Parameters:
+    -----------
+    `survey`: {dict}
+        Results of previs.survey (or previs.load),\n
+    `bands`: {list}
+        Bands to fill if the magnitude is NaN (default: L, M, N),\n
+    `refine`: {bool}
+        If True, the grid search is refined with emcee (slower),\n
+    `max_workers`: {int}
+        Number of processes used by emcee (default: number of CPUs).
+
+    Returns:
+    --------
+    `survey`: {dict}
+        New dictionnary of the survey: the missing magnitudes are replaced by
+        the model, and data['Mag_fit'] gives the fit ('T', 'chi2_red', and the
+        magnitudes of the model 'magL', 'e_magL', etc.). Use previs.rescore to
+        update the observability with the new magnitudes.
+    """
+    stars = [
+        star
+        for star in survey
+        if survey[star] is not None and survey[star].get("SED") is not None
+    ]
+    seds = [survey[star]["SED"] for star in stars]
+    wl, flux, offsets = stack_seds(seds)
+    err = stack_errors(seds)
+
+    fit = fit_blackbody(wl, flux, err, offsets, bands)
+    if refine:
+        fit = refine_emcee(wl, flux, err, offsets, fit, bands, max_workers=max_workers)
+
+    out = dict(survey)
+    for i, star in enumerate(stars):
+        data = dict(survey[star])
+        mag = dict(data["Mag"])
+        model = {"T": float(fit["T"][i]), "chi2_red": float(fit["chi2_red"][i])}
+        for j, band in enumerate(bands):
+            key = "mag" + band
+            model[key] = float(fit["mag"][i, j])
+            model["e_" + key] = float(fit["e_mag"][i, j])
+            if np.isnan(mag.get(key, np.nan)):
+                mag[key] = model[key]
+        data["Mag"] = mag
+        data["Mag_fit"] = model
+        out[star] = data
+    return out
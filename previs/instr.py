@@ -11,14 +11,24 @@ from the ESO website or the CHARA website. In the case of MATISSE,
 the limiting magnitude can be extracted automaticaly from the actual
 performances (P106, 2020) or estimated performances (2017). Some mode
 of MATISSE are not yet commissioned (UT with GRA4MAT), so only estimated performances are used.
+The limits checked on the ESO website are stored for each ESO period in
+a user directory (see `limits_store_dir`).
 """
+import datetime
+import io
 import json
+import os
+import sys
+import tempfile
+import urllib.error
+import urllib.request
 from pathlib import Path
 
 import numpy as np
 import pandas as pd
+from termcolor import cprint
 
-from previs.utils import connect
+from previs.sed import CONV_FLUX
 
 store_directory = Path(__file__).parent / "data"
 
@@ -42,121 +52,227 @@ def JyToMag(f, band):
             Johnson magnitudes.
     """
 
-    conv_flux = {
-        "B": {"wl": 0.44, "F0": 4260},
-        # Allen's astrophysical quantities
-        "V": {"wl": 0.5556, "F0": 3540},
-        "R": {"wl": 0.64, "F0": 3080},
-        "I": {"wl": 0.79, "F0": 2550},
-        "J": {"wl": 1.215, "F0": 1630},
-        "H": {"wl": 1.654, "F0": 1050},
-        "K": {"wl": 2.179, "F0": 655},
-        "L": {"wl": 3.547, "F0": 276},
-        "M": {"wl": 4.769, "F0": 160},
-        # 10.2, 42.7 Johnson N (https://www.gemini.edu/?q=node/11119)
-        "N": {"wl": 10.2, "F0": 42.7},
-        "Q": {"wl": 20.13, "F0": 9.7},
-    }
-
     F = np.array(f).astype(float)
-    out = -2.5 * np.log10(F / conv_flux[band]["F0"])
+    out = -2.5 * np.log10(F / CONV_FLUX[band]["F0"])
     return list(out)
 
 
-def limit_ESO_matisse_web(check):
+ESO_MATISSE_URL = (
+    "http://www.eso.org/sci/facilities/paranal/instruments/matisse/inst.html"
+)
+
+# Period of the limits shipped with previs (data/eso_limits_matisse.json).
+PACKAGED_PERIOD = "P105"
+
+
+def limits_store_dir():
+    """Return the directory of the stored ESO limits (can be set with the
+    PREVIS_LIMITS_DIR environment variable)."""
+    if os.environ.get("PREVIS_LIMITS_DIR"):
+        return Path(os.environ["PREVIS_LIMITS_DIR"])
+    if os.name == "nt":
+        base = Path(os.environ.get("LOCALAPPDATA", Path.home() / "AppData" / "Local"))
+        return base / "previs" / "limits"
+    if sys.platform == "darwin":
+        return Path.home() / "Library" / "Application Support" / "previs" / "limits"
+    base = Path(os.environ.get("XDG_DATA_HOME", Path.home() / ".local" / "share"))
+    return base / "previs" / "limits"
+
+
+def eso_period(date=None):
+    """Return the ESO period (e.g.: 'P105') of a date (default: today). The
+    periods are semesters (April/October) up to P111, then one year long
+    (starting in October)."""
+    if date is None:
+        date = datetime.date.today()
+    n = 2 * (date.year - 2020) + 105 + (date.month >= 10) - (date.month < 4)
+    if n > 111:
+        n = 112 + 2 * ((n - 112) // 2)
+    return "P%i" % n
+
+
+def _snapshot_path(period):
+    return limits_store_dir() / ("eso_limits_matisse_%s.json" % period)
+
+
+def _write_snapshot(snapshot):
+    """Write a snapshot of the ESO limits in the store (atomic write)."""
+    path = _snapshot_path(snapshot["period"])
+    try:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        fd, tmpname = tempfile.mkstemp(dir=path.parent, suffix=".tmp")
+        with os.fdopen(fd, "w") as ofile:
+            json.dump(snapshot, ofile, indent="  ")
+        os.replace(tmpname, path)
+    except OSError as exc:
+        cprint("MATISSE limits not stored in %s: %s" % (path, exc), "red")
+
+
+def stored_periods():
+    """Return the ESO periods with stored MATISSE limits (sorted)."""
+    periods = {PACKAGED_PERIOD}
+    if limits_store_dir().is_dir():
+        for path in limits_store_dir().glob("eso_limits_matisse_P*.json"):
+            periods.add(path.stem.split("_")[-1])
+    return sorted(periods, key=lambda x: int(x[1:]))
+
+
+def load_snapshot(period=None):
+    """Return the stored snapshot of the ESO limits of `period` (default: the
+    most recent one). A snapshot is a dictionnary with keys 'period', 'limits',
+    'etag' and 'last_modified'."""
+    if period is None:
+        period = stored_periods()[-1]
+    path = _snapshot_path(period)
+    if path.is_file():
+        with open(path) as ofile:
+            return json.load(ofile)
+    if period == PACKAGED_PERIOD:
+        with open(store_directory / "eso_limits_matisse.json") as ofile:
+            limits_data = json.load(ofile)
+        return {
+            "period": period,
+            "limits": limits_data,
+            "etag": None,
+            "last_modified": None,
+        }
+    raise ValueError(
+        "No MATISSE limits stored for %s (available: %s)."
+        % (period, ", ".join(stored_periods()))
+    )
+
+
+def _parse_eso_matisse(html):
+    """Extract the MATISSE limits from the ESO instrument description page."""
+    tables = pd.read_html(io.StringIO(html))  # Returns list of all tables on page
+    limit_MATISSE_abs = tables[4]  # Select table of interest
+    limit_MATISSE_rel = tables[5]
+    limit_MATISSE_gra4mat = tables[6]
+
+    list_limit_abs = np.array(limit_MATISSE_abs)
+    list_limit_rel = np.array(limit_MATISSE_rel)
+    list_limit_gra4mat = np.array(limit_MATISSE_gra4mat)
+
+    at_lim_good = [x.split("Jy")[0] for x in list_limit_abs[:, 1]]
+    ut_lim_good = [x.split("Jy")[0] for x in list_limit_abs[:, 3]]
+
+    at_lim_good_rel = [x.split("Jy")[0] for x in list_limit_rel[:, 1]]
+    ut_lim_good_rel = [x.split("Jy")[0] for x in list_limit_rel[:, 3]]
+
+    at_L_gra4mat = [x.split("Jy")[0] for x in list_limit_gra4mat[1:, 1]]
+    at_M_gra4mat = [x.split("Jy")[0] for x in list_limit_gra4mat[1:, 3]]
+
+    at_noft_L = JyToMag([at_lim_good[0], at_lim_good[2], at_lim_good_rel[3]], "L")
+    at_noft_M = JyToMag([at_lim_good[1], at_lim_good_rel[2]], "M")
+    at_noft_N = JyToMag([at_lim_good[4], at_lim_good_rel[4]], "N")
+
+    ut_noft_L = JyToMag([ut_lim_good[0], ut_lim_good_rel[1], ut_lim_good_rel[3]], "L")
+    ut_noft_M = JyToMag([ut_lim_good[1], ut_lim_good_rel[2]], "M")
+    ut_noft_N = JyToMag([ut_lim_good[4], ut_lim_good_rel[4]], "N")
+
+    at_ft_L = JyToMag([at_L_gra4mat[0], at_L_gra4mat[1], at_L_gra4mat[2]], "L")
+    at_ft_M = JyToMag([at_M_gra4mat[0], at_M_gra4mat[1]], "M")
+    at_ft_N = []  # not commisionned (see estimated performance)
+
+    return {
+        "at": {
+            "noft": {"L": at_noft_L, "M": at_noft_M, "N": at_noft_N},
+            "ft": {"L": at_ft_L, "M": at_ft_M, "N": at_ft_N},
+        },
+        "ut": {
+            "noft": {"L": ut_noft_L, "M": ut_noft_M, "N": ut_noft_N},
+            "ft": {"L": [], "M": [], "N": []},
+        },
+    }
+
+
+def refresh_eso_limits(url=ESO_MATISSE_URL, period=None):
+    """Check the MATISSE limits on the ESO website and store them as the
+    snapshot of `period` (default: current ESO period). The page is requested
+    with the ETag/Last-Modified of the last snapshot (conditional request), so
+    it is only downloaded and parsed if it has changed.
+
+    Returns
+    -------
+    `snapshot`: {dict}
+        Snapshot of the ESO limits (see `load_snapshot`).
+    """
+    if period is None:
+        period = eso_period()
+    last = load_snapshot()
+
+    request = urllib.request.Request(url)
+    if last.get("etag"):
+        request.add_header("If-None-Match", last["etag"])
+    if last.get("last_modified"):
+        request.add_header("If-Modified-Since", last["last_modified"])
+
+    try:
+        with urllib.request.urlopen(request, timeout=60) as response:
+            html = response.read().decode(
+                response.headers.get_content_charset() or "utf-8", "replace"
+            )
+            headers = response.headers
+    except urllib.error.HTTPError as exc:
+        if exc.code != 304:
+            print(
+                "-> ESO website not available: %s limits are used instead."
+                % last["period"]
+            )
+            return last
+        # Not modified since the last snapshot.
+        if last["period"] != period:
+            last = dict(last, period=period)
+            _write_snapshot(last)
+        return last
+    except Exception:
+        print(
+            "-> ESO website not available: %s limits are used instead." % last["period"]
+        )
+        return last
+
+    try:
+        limits_data = _parse_eso_matisse(html)
+    except Exception:
+        print(
+            "-> The structure of the ESO website has changed: %s limits are used instead."
+            % last["period"]
+        )
+        return last
+
+    snapshot = {
+        "period": period,
+        "limits": limits_data,
+        "etag": headers.get("ETag"),
+        "last_modified": headers.get("Last-Modified"),
+    }
+    _write_snapshot(snapshot)
+    return snapshot
+
+
+def limit_ESO_matisse_web(check, period=None):
     """Extract limiting flux (Jy) from ESO MATISSE instrument descriptions and
     return magnitude (optimal 10% seeing conditions).
 
     Parameters
     ----------
     `check`: {bool}
-        choose whether to request data from web (True) or use on disk data (False).
+        choose whether to request data from web (True) or use on disk data (False),\n
+    `period`: {str}
+        ESO period of the limits (e.g.: 'P105'). If given, the stored limits of
+        this period are used (no request).
 
     Returns
     -------
     `limits_data`: {dict}
         Limiting magnitudes of MATISSE.
     """
-
-    url = "http://www.eso.org/sci/facilities/paranal/instruments/matisse/inst.html"
-    stored_data_filepath = store_directory / "eso_limits_matisse.json"
-    new_data_filepath = store_directory / "eso_limits_matisse_new.json"
-
-    if Path(stored_data_filepath).is_file() and not check:
-        with open(stored_data_filepath) as ofile:
-            limits_data = json.load(ofile)
-    else:
+    if period is not None:
+        return load_snapshot(period)["limits"]
+    if check:
         print("Check MATISSE limits from ESO web site...")
-        response_server = connect(url)
-        if response_server:
-            tables = pd.read_html(url)  # Returns list of all tables on page
-            try:
-                limit_MATISSE_abs = tables[4]  # Select table of interest
-                limit_MATISSE_rel = tables[5]
-                limit_MATISSE_gra4mat = tables[6]
-
-                list_limit_abs = np.array(limit_MATISSE_abs)
-                list_limit_rel = np.array(limit_MATISSE_rel)
-                list_limit_gra4mat = np.array(limit_MATISSE_gra4mat)
-
-                at_lim_good = [x.split("Jy")[0] for x in list_limit_abs[:, 1]]
-                ut_lim_good = [x.split("Jy")[0] for x in list_limit_abs[:, 3]]
-
-                at_lim_good_rel = [x.split("Jy")[0] for x in list_limit_rel[:, 1]]
-                ut_lim_good_rel = [x.split("Jy")[0] for x in list_limit_rel[:, 3]]
-
-                at_L_gra4mat = [x.split("Jy")[0] for x in list_limit_gra4mat[1:, 1]]
-                at_M_gra4mat = [x.split("Jy")[0] for x in list_limit_gra4mat[1:, 3]]
-
-                at_noft_L = JyToMag(
-                    [at_lim_good[0], at_lim_good[2], at_lim_good_rel[3]], "L"
-                )
-                at_noft_M = JyToMag([at_lim_good[1], at_lim_good_rel[2]], "M")
-                at_noft_N = JyToMag([at_lim_good[4], at_lim_good_rel[4]], "N")
-
-                ut_noft_L = JyToMag(
-                    [ut_lim_good[0], ut_lim_good_rel[1], ut_lim_good_rel[3]], "L"
-                )
-                ut_noft_M = JyToMag([ut_lim_good[1], ut_lim_good_rel[2]], "M")
-                ut_noft_N = JyToMag([ut_lim_good[4], ut_lim_good_rel[4]], "N")
-
-                at_ft_L = JyToMag(
-                    [at_L_gra4mat[0], at_L_gra4mat[1], at_L_gra4mat[2]], "L"
-                )
-                at_ft_M = JyToMag([at_M_gra4mat[0], at_M_gra4mat[1]], "M")
-                at_ft_N = []  # not commisionned (see estimated performance)
-
-                limits_data = {
-                    "at": {
-                        "noft": {"L": at_noft_L, "M": at_noft_M, "N": at_noft_N},
-                        "ft": {"L": at_ft_L, "M": at_ft_M, "N": at_ft_N},
-                    },
-                    "ut": {
-                        "noft": {"L": ut_noft_L, "M": ut_noft_M, "N": ut_noft_N},
-                        "ft": {"L": [], "M": [], "N": []},
-                    },
-                }
-
-                with open(new_data_filepath, mode="w") as ofile:
-                    json.dump(limits_data, ofile, indent="  ")
-            except Exception:
-                print(
-                    "-> The structure of the ESO website has changed: (%s) is used instead."
-                    % stored_data_filepath
-                )
-                if Path(stored_data_filepath).is_file():
-                    with open(stored_data_filepath) as ofile:
-                        limits_data = json.load(ofile)
-        else:
-            print(
-                "-> ESO website not available: (%s) is used instead."
-                % stored_data_filepath
-            )
-            if Path(stored_data_filepath).is_file():
-                with open(stored_data_filepath) as ofile:
-                    limits_data = json.load(ofile)
-
-    return limits_data
+        return refresh_eso_limits()["limits"]
+    return load_snapshot()["limits"]
 
 
 def limit_commissioning_matisse():
@@ -187,44 +303,149 @@ def limit_commissioning_matisse():
     return dic_consortium
 
 
+def _ladder(mag, lim):
+    """Number of observable modes for each star, `lim` being the limiting
+    magnitudes of the modes sorted from the least to the most demanding (e.g.:
+    LR, MR, HR). A mode is observable if the star is brighter than its limit or
+    the limit of any more demanding mode (as the mode ladders are cumulative)."""
+    thresholds = np.maximum.accumulate(np.asarray(lim, dtype=float)[::-1])
+    return len(thresholds) - np.searchsorted(thresholds, mag, side="left")
+
+
+def _modes(n_ok, modes):
+    return {mode: n_ok > k for k, mode in enumerate(modes)}
+
+
+def _gravity_limits(magV, magK):
+    # Observability (UT MR, UT HR, AT MR, AT HR) in each K magnitude range:
+    # < -4, [-4, -1], ]-1, 1], ]1, 4], ]4, 8], ]8, 9], > 9.
+    edges_K = [np.nextafter(-4, -np.inf), -1, 1, 4, 8, 9]
+    table_K = np.array(
+        [
+            [0, 0, 0, 0, 1, 1, 0],
+            [0, 0, 0, 1, 1, 1, 0],
+            [0, 0, 1, 1, 1, 0, 0],
+            [0, 1, 1, 1, 1, 0, 0],
+        ],
+        dtype=bool,
+    )
+    i_K = np.searchsorted(edges_K, magK, side="left")
+    i_V = np.searchsorted([11, 16], magV, side="left")
+    return {
+        "UT": {"K": {"MR": table_K[0, i_K], "HR": table_K[1, i_K]}},
+        "AT": {"K": {"MR": table_K[2, i_K], "HR": table_K[3, i_K]}},
+        "V_cond": np.array(["AT", "UT", "TooFaint"])[i_V],
+    }
+
+
+_limits_registry = {}
+
+
+def _validate_limits(limits_data):
+    """Check the structure of a table of limiting magnitudes and convert it to
+    tuples of floats (the tables of the registry are shared)."""
+    out = {}
+    for tel in ["at", "ut"]:
+        out[tel] = {}
+        for ft in ["ft", "noft"]:
+            out[tel][ft] = {}
+            for band in ["L", "M", "N"]:
+                try:
+                    lim = tuple(float(x) for x in limits_data[tel][ft][band])
+                except (KeyError, TypeError, ValueError) as exc:
+                    raise ValueError(
+                        "Wrong MATISSE limits (%s, %s, %s)." % (tel, ft, band)
+                    ) from exc
+                out[tel][ft][band] = lim
+    return out
+
+
+def get_limits(source="ESO", check=False, period=None):
+    """
+    Return the limiting magnitudes of MATISSE. The tables are loaded and validated
+    once per process and memoized by (source, period).
+
+    Parameters:
+    -----------
+    `source`: {str}
+        If source = 'ESO' (default), the ESO limits are used (see
+        `limit_ESO_matisse_web`). Otherwise, the estimated limits are used
+        (`limit_commissioning_matisse`),\n
+    `check`: {bool}
+        If True, check the ESO website. The website is requested only once,
+        the next calls use the memoized limits,\n
+    `period`: {str}
+        ESO period of the limits (e.g.: 'P105', see `stored_periods`). If None
+        (default), the most recent stored limits are used.
+    """
+    source = "ESO" if source == "ESO" else "commissioning"
+    key = (source, period)
+    if key in _limits_registry:
+        limits_data, checked = _limits_registry[key]
+        if checked or not check or source != "ESO":
+            return limits_data
+
+    if source == "ESO":
+        limits_data = limit_ESO_matisse_web(check=check, period=period)
+        limits_data = _validate_limits(limits_data)
+    else:
+        limits_data = _validate_limits(limit_commissioning_matisse())
+    _limits_registry[key] = (limits_data, check)
+    return limits_data
+
+
+def clear_limits():
+    """Forget the memoized limiting magnitudes (see `get_limits`)."""
+    _limits_registry.clear()
+
+
 def gravity_limit(magV, magK):
     """
     Return observability with GRAVITY instrument.
     """
-    dic = {
-        "UT": {"K": {"MR": False, "HR": False}},
-        "AT": {"K": {"MR": False, "HR": False}},
-    }
-    if magV <= 11:
-        dic["V_cond"] = "AT"
-    elif (magV > 11) & (magV <= 16):
-        dic["V_cond"] = "UT"
-    else:
-        dic["V_cond"] = "TooFaint"
-
-    if (magK >= -4.0) & (magK <= -1):
-        dic["UT"]["K"] = {"MR": False, "HR": False}
-        dic["AT"]["K"] = {"MR": False, "HR": True}
-    elif (magK > -1) & (magK <= 1):
-        dic["UT"]["K"] = {"MR": False, "HR": False}
-        dic["AT"]["K"] = {"MR": True, "HR": True}
-    elif (magK > 1) & (magK <= 4):
-        dic["UT"]["K"] = {"MR": False, "HR": True}
-        dic["AT"]["K"] = {"MR": True, "HR": True}
-    elif (magK > 4) & (magK <= 8):
-        dic["UT"]["K"] = {"MR": True, "HR": True}
-        dic["AT"]["K"] = {"MR": True, "HR": True}
-    elif (magK > 8) & (magK <= 9):
-        dic["UT"]["K"] = {"MR": True, "HR": True}
-        dic["AT"]["K"] = {"MR": False, "HR": False}
-    else:
-        dic["UT"]["K"] = {"MR": False, "HR": False}
-        dic["AT"]["K"] = {"MR": False, "HR": False}
+    return limits_view(_gravity_limits([magV], [magK]), 0)
+
 
+def _matisse_limits(magL, magM, magN, magK, dic_limit):
+    dic_matisse = get_limits("commissioning")
+
+    def _lim(tel, ft, band):
+        # Not commisionned yet: use estimated sensitivity.
+        lim = dic_limit[tel][ft][band]
+        return lim if len(lim) != 0 else dic_matisse[tel][ft][band]
+
+    dic = {}
+    for tel in ["AT", "UT"]:
+        dic[tel] = {}
+        for ft in ["ft", "noft"]:
+            lim_L = _lim(tel.lower(), ft, "L")
+            if (tel, ft) == ("UT", "ft"):
+                lim_L = dic_matisse["ut"]["ft"]["L"]
+            dic[tel][ft] = {
+                "L": _modes(_ladder(magL, lim_L[:3]), ["LR", "MR", "HR"]),
+                "M": _modes(
+                    _ladder(magM, _lim(tel.lower(), ft, "M")[:2]), ["LR", "HR"]
+                ),
+                "N": _modes(
+                    _ladder(magN, _lim(tel.lower(), ft, "N")[:2]), ["LR", "HR"]
+                ),
+            }
+    # Only one mode is given for the UT with fringe tracker (M band).
+    ok = _ladder(magM, _lim("ut", "ft", "M")[:1]) > 0
+    dic["UT"]["ft"]["M"] = {"LR": ok, "HR": ok.copy()}
+
+    # Frange tracker K band limit
+    dic["limK"] = _modes(_ladder(magK, [10.0, 7.5]), ["UT", "AT"])
     return dic
 
 
-def matisse_limit(magL, magM, magN, magK, source="ESO", check=False):
+def _limits_data(source, check, limits):
+    if limits is not None:
+        return limits
+    return get_limits(source, check)
+
+
+def matisse_limit(magL, magM, magN, magK, source="ESO", check=False, limits=None):
     """
     Return observability with MATISSE instrument with different configurations (Spectral
     resolution, UTs or ATs, Fringe tracking, etc...).
@@ -238,264 +459,101 @@ def matisse_limit(magL, magM, magN, magK, source="ESO", check=False):
         is checked to extract these limits. Otherwise, the estimated limits are used,\n
     `check`: {bool}
         If True, check the actual MATISSE performances on the ESO website (default=False).
-        Otherwise, the data/eso_limits_matisse.json are used (perfomance in P105/2020).
+        Otherwise, the data/eso_limits_matisse.json are used (perfomance in P105/2020),\n
+    `limits`: {dict}
+        Limiting magnitudes already loaded (see `get_limits`). If given, `source`
+        and `check` are ignored.
     """
-    dic = {}
-    dic["AT"] = {
-        "ft": {"L": {"LR": False}, "M": {"LR": False}, "N": {"LR": False}},
-        "noft": {
-            "L": {"LR": False, "MR": False, "HR": False},
-            "M": {"LR": False, "HR": False},
-            "N": {"LR": False, "HR": False},
-        },
-    }
-    dic["UT"] = {
-        "ft": {"L": {"LR": False}, "M": {"LR": False}, "N": {"LR": False}},
-        "noft": {
-            "L": {"LR": False, "MR": False, "HR": False},
-            "M": {"LR": False, "HR": False},
-            "N": {"LR": False, "HR": False},
-        },
-    }
-    dic["limK"] = {"UT": False, "AT": False}
-
-    if source == "ESO":
-        dic_limit = limit_ESO_matisse_web(check=check)
-    else:
-        dic_limit = limit_commissioning_matisse()
-
-    dic_matisse = limit_commissioning_matisse()
+    dic_limit = _limits_data(source, check, limits)
+    return limits_view(_matisse_limits([magL], [magM], [magN], [magK], dic_limit), 0)
 
-    # Frange tracker K band limit
-    if magK <= 7.5:
-        dic["limK"]["UT"] = True
-        dic["limK"]["AT"] = True
-    elif (magK > 7.5) & (magK <= 10.0):
-        dic["limK"]["UT"] = True
-        dic["limK"]["AT"] = False
-    else:
-        dic["limK"]["UT"] = False
-        dic["limK"]["AT"] = False
-
-    # --------------------------------------------------------------------
-    # UT, ft
-    lim = dic_matisse["ut"]["ft"]["L"]
-    if magL <= lim[2]:
-        dic["UT"]["ft"]["L"]["LR"] = True
-        dic["UT"]["ft"]["L"]["MR"] = True
-        dic["UT"]["ft"]["L"]["HR"] = True
-    elif (magL > lim[2]) & (magL <= lim[1]):
-        dic["UT"]["ft"]["L"]["LR"] = True
-        dic["UT"]["ft"]["L"]["MR"] = True
-        dic["UT"]["ft"]["L"]["HR"] = False
-    elif (magL > lim[1]) & (magL <= lim[0]):
-        dic["UT"]["ft"]["L"]["LR"] = True
-        dic["UT"]["ft"]["L"]["MR"] = False
-        dic["UT"]["ft"]["L"]["HR"] = False
-    else:
-        dic["UT"]["ft"]["L"]["LR"] = False
-        dic["UT"]["ft"]["L"]["MR"] = False
-        dic["UT"]["ft"]["L"]["HR"] = False
-
-    lim = dic_limit["ut"]["ft"]["M"]
-    if len(lim) == 0:
-        # print('Not commisionned yet (M): use estimated sensitivity.')
-        lim = limit_commissioning_matisse()["ut"]["ft"]["M"]
-
-    if magM <= lim[0]:
-        dic["UT"]["ft"]["M"]["LR"] = True
-        dic["UT"]["ft"]["M"]["HR"] = True
-    else:
-        dic["UT"]["ft"]["M"]["LR"] = False
-        dic["UT"]["ft"]["M"]["HR"] = False
-
-    lim = dic_limit["ut"]["ft"]["N"]
-    if len(lim) == 0:
-        lim = limit_commissioning_matisse()["ut"]["ft"]["N"]
-    if magN <= lim[1]:
-        dic["UT"]["ft"]["N"]["LR"] = True
-        dic["UT"]["ft"]["N"]["HR"] = True
-    elif (magN > lim[1]) & (magN <= lim[0]):
-        dic["UT"]["ft"]["N"]["LR"] = True
-        dic["UT"]["ft"]["N"]["HR"] = False
-    else:
-        dic["UT"]["ft"]["N"]["LR"] = False
-        dic["UT"]["ft"]["N"]["HR"] = False
-
-    # --------------------------------------------------------------------
-    # UT, noft
-    lim = dic_limit["ut"]["noft"]["L"]
-    if magL <= lim[2]:
-        dic["UT"]["noft"]["L"]["LR"] = True
-        dic["UT"]["noft"]["L"]["MR"] = True
-        dic["UT"]["noft"]["L"]["HR"] = True
-    elif (magL > lim[2]) & (magL <= lim[1]):
-        dic["UT"]["noft"]["L"]["LR"] = True
-        dic["UT"]["noft"]["L"]["MR"] = True
-        dic["UT"]["noft"]["L"]["HR"] = False
-    elif (magL > lim[1]) & (magL <= lim[0]):
-        dic["UT"]["noft"]["L"]["LR"] = True
-        dic["UT"]["noft"]["L"]["MR"] = False
-        dic["UT"]["noft"]["L"]["HR"] = False
-    else:
-        dic["UT"]["noft"]["L"]["LR"] = False
-        dic["UT"]["noft"]["L"]["MR"] = False
-        dic["UT"]["noft"]["L"]["HR"] = False
-
-    lim = dic_limit["ut"]["noft"]["M"]
-    if magM <= lim[1]:
-        dic["UT"]["noft"]["M"]["LR"] = True
-        dic["UT"]["noft"]["M"]["HR"] = True
-    elif (magM > lim[1]) & (magM <= lim[0]):
-        dic["UT"]["noft"]["M"]["LR"] = True
-        dic["UT"]["noft"]["M"]["HR"] = False
-    else:
-        dic["UT"]["noft"]["M"]["LR"] = False
-        dic["UT"]["noft"]["M"]["HR"] = False
-
-    lim = dic_limit["ut"]["noft"]["N"]
-    if magN <= lim[1]:
-        dic["UT"]["noft"]["N"]["LR"] = True
-        dic["UT"]["noft"]["N"]["HR"] = True
-    elif (magN > lim[1]) & (magN <= lim[0]):
-        dic["UT"]["noft"]["N"]["LR"] = True
-        dic["UT"]["noft"]["N"]["HR"] = False
-    else:
-        dic["UT"]["noft"]["N"]["LR"] = False
-        dic["UT"]["noft"]["N"]["HR"] = False
-
-    # AT, ft
-    lim = dic_limit["at"]["ft"]["L"]
-    if magL <= lim[2]:
-        dic["AT"]["ft"]["L"]["LR"] = True
-        dic["AT"]["ft"]["L"]["MR"] = True
-        dic["AT"]["ft"]["L"]["HR"] = True
-    elif (magL > lim[2]) & (magL <= lim[1]):
-        dic["AT"]["ft"]["L"]["LR"] = True
-        dic["AT"]["ft"]["L"]["MR"] = True
-        dic["AT"]["ft"]["L"]["HR"] = False
-    elif (magL > lim[1]) & (magL <= lim[0]):
-        dic["AT"]["ft"]["L"]["LR"] = True
-        dic["AT"]["ft"]["L"]["MR"] = False
-        dic["AT"]["ft"]["L"]["HR"] = False
-    else:
-        dic["AT"]["ft"]["L"]["LR"] = False
-        dic["AT"]["ft"]["L"]["MR"] = False
-        dic["AT"]["ft"]["L"]["HR"] = False
-
-    lim = dic_limit["at"]["ft"]["M"]
-    if magM <= lim[1]:
-        dic["AT"]["ft"]["M"]["LR"] = True
-        dic["AT"]["ft"]["M"]["HR"] = True
-    elif (magM > lim[1]) & (magM <= lim[0]):
-        dic["AT"]["ft"]["M"]["LR"] = True
-        dic["AT"]["ft"]["M"]["HR"] = False
-    else:
-        dic["AT"]["ft"]["M"]["LR"] = False
-        dic["AT"]["ft"]["M"]["HR"] = False
-
-    lim = dic_limit["at"]["ft"]["N"]
-    if len(lim) == 0:
-        lim = limit_commissioning_matisse()["at"]["ft"]["N"]
-    if magN <= lim[1]:
-        dic["AT"]["ft"]["N"]["LR"] = True
-        dic["AT"]["ft"]["N"]["HR"] = True
-    elif (magN > lim[1]) & (magN <= lim[0]):
-        dic["AT"]["ft"]["N"]["LR"] = True
-        dic["AT"]["ft"]["N"]["HR"] = False
-    else:
-        dic["AT"]["ft"]["N"]["LR"] = False
-        dic["AT"]["ft"]["N"]["HR"] = False
-
-    # AT, noft
-    lim = dic_limit["at"]["noft"]["L"]
-    if magL <= lim[2]:
-        dic["AT"]["noft"]["L"]["LR"] = True
-        dic["AT"]["noft"]["L"]["MR"] = True
-        dic["AT"]["noft"]["L"]["HR"] = True
-    elif (magL > lim[2]) & (magL <= lim[1]):
-        dic["AT"]["noft"]["L"]["LR"] = True
-        dic["AT"]["noft"]["L"]["MR"] = True
-        dic["AT"]["noft"]["L"]["HR"] = False
-    elif (magL > lim[1]) & (magL <= lim[0]):
-        dic["AT"]["noft"]["L"]["LR"] = True
-        dic["AT"]["noft"]["L"]["MR"] = False
-        dic["AT"]["noft"]["L"]["HR"] = False
-    else:
-        dic["AT"]["noft"]["L"]["LR"] = False
-        dic["AT"]["noft"]["L"]["MR"] = False
-        dic["AT"]["noft"]["L"]["HR"] = False
-
-    lim = dic_limit["at"]["noft"]["M"]
-    if magM <= lim[1]:
-        dic["AT"]["noft"]["M"]["LR"] = True
-        dic["AT"]["noft"]["M"]["HR"] = True
-    elif (magM > lim[1]) & (magM <= lim[0]):
-        dic["AT"]["noft"]["M"]["LR"] = True
-        dic["AT"]["noft"]["M"]["HR"] = False
-    else:
-        dic["AT"]["noft"]["M"]["LR"] = False
-        dic["AT"]["noft"]["M"]["HR"] = False
-
-    lim = dic_limit["at"]["noft"]["N"]
-    if magN <= lim[1]:
-        dic["AT"]["noft"]["N"]["LR"] = True
-        dic["AT"]["noft"]["N"]["HR"] = True
-    elif (magN > lim[1]) & (magN <= lim[0]):
-        dic["AT"]["noft"]["N"]["LR"] = True
-        dic["AT"]["noft"]["N"]["HR"] = False
-    else:
-        dic["AT"]["noft"]["N"]["LR"] = False
-        dic["AT"]["noft"]["N"]["HR"] = False
 
-    return dic
+def _pionier_limits(magH):
+    magH = np.asarray(magH, dtype=float)
+    return {"H": (magH >= -1.0) & (magH <= 9.0)}
 
 
 def pionier_limit(magH):
     """Return observability with PIONIER instrument."""
-    dic = {}
-    if (magH >= -1.0) & (magH <= 9.0):
-        dic["H"] = True
-    else:
-        dic["H"] = False
-    return dic
+    return limits_view(_pionier_limits([magH]), 0)
+
+
+def _chara_limits(magK, magH, magR, magV):
+    magK, magH, magR, magV = (
+        np.asarray(x, dtype=float) for x in [magK, magH, magR, magV]
+    )
+    return {
+        "PAVO": {"R": magR <= 7.0},
+        "CLASSIC": {"K": magK <= 6.5, "H": magH <= 7, "V": magV <= 10},
+        "CLIMB": {"K": magK <= 6.0},
+        "MIRC": {"H": magH <= 6.5, "K": magK <= 3},
+        "MYSTIC": {"K": magK <= 6.5},
+        "VEGA": {"LR": magV <= 7.2, "MR": magV <= 5.8, "HR": magV <= 4.2},
+        "SPICA": {"imaging": magV <= 6.0, "diam": magV <= 8},
+        "Guiding": np.minimum(magV, magR) <= 10,
+    }
 
 
 def chara_limit(magK, magH, magR, magV):
     """Return observability of the different instruments of CHARA."""
-    dic = {
-        "PAVO": {"R": False},
-        "CLASSIC": {"K": False, "H": False, "V": False},
-        "CLIMB": {"K": False},
-        "MIRC": {"H": False, "K": False},
-        "MYSTIC": {"K": False},
-        "VEGA": {"LR": False, "MR": False, "HR": False},
-        "SPICA": {"imaging": False, "diam": False},
-    }
-
-    dic["Guiding"] = np.min([magV, magR]) <= 10
-    dic["CLASSIC"].update({"K": magK <= 6.5, "H": magH <= 7, "V": magV <= 10})
+    return limits_view(_chara_limits([magK], [magH], [magR], [magV]), 0)
 
-    dic["CLIMB"].update({"K": magK <= 6.0})
 
-    dic["PAVO"].update({"R": magR <= 7.0})
+def _ivis_limits(magR):
+    magR = np.asarray(magR, dtype=float)
+    return {"imaging": magR <= 8.0, "diam": magR <= 10.0}
 
-    dic["MIRC"].update({"H": magH <= 6.5, "K": magK <= 3})
 
-    dic["MYSTIC"].update({"K": magK <= 6.5})
-
-    dic["SPICA"].update({"imaging": magV <= 6.0, "diam": magV <= 8})
+def ivis_limit(magR):
+    return limits_view(_ivis_limits([magR]), 0)
 
-    dic["VEGA"].update({"HR": magV <= 4.2, "MR": magV <= 5.8, "LR": magV <= 7.2})
 
-    return dic
+def instrument_limits(mag, source="ESO", check=False, limits=None):
+    """
+    Compute the observability with all the VLTI and CHARA instruments for
+    several stars at once.
 
+    Parameters:
+    -----------
+    `mag`: {dict}
+        Magnitudes of the stars (keys: 'magV', 'magR', 'magH', 'magK', 'magL',
+        'magM', 'magN'; values: arrays of the same length),\n
+    `source`, `check`, `limits`:
+        Limiting magnitudes of MATISSE (see `matisse_limit`).
 
-def ivis_limit(magR):
-    dic = {"imaging": False, "diam": False}
-    if magR <= 8.0:
-        dic["imaging"] = True
-        dic["diam"] = True
-    elif (magR > 8.0) & (magR <= 10.0):
-        dic["diam"] = True
-    return dic
+    Returns:
+    --------
+    `ins`: {dict}
+        Observability with each instrument (same structure as data['Ins'] of
+        previs.search), the values being boolean arrays (one value per star).
+        Use `limits_view` to get the dictionnary of one star.
+    """
+    m = {k: np.atleast_1d(np.asarray(v, dtype=float)) for k, v in mag.items()}
+    dic_limit = _limits_data(source, check, limits)
+    ins = {}
+    ins["PIONIER"] = _pionier_limits(m["magH"])
+    ins["CHARA"] = _chara_limits(m["magK"], m["magH"], m["magR"], m["magV"])
+    ins["MATISSE"] = _matisse_limits(
+        m["magL"], m["magM"], m["magN"], m["magK"], dic_limit
+    )
+    ins["GRAVITY"] = _gravity_limits(m["magV"], m["magK"])
+    ins["VISION"] = _ivis_limits(m["magR"])
+    return ins
+
+
+def limits_view(ins, i):
+    """Return the observability of the star `i` from the output of
+    `instrument_limits` (nested dictionnary of bool)."""
+    if isinstance(ins, dict):
+        return {k: limits_view(v, i) for k, v in ins.items()}
+    return ins[i].item()
+
+
+def limits_views(ins):
+    """Return the observability of all the stars from the output of
+    `instrument_limits` (list of nested dictionnaries, see `limits_view`)."""
+    if isinstance(ins, dict):
+        keys = list(ins)
+        columns = [limits_views(ins[k]) for k in keys]
+        return [dict(zip(keys, row)) for row in zip(*columns)]
+    return ins.tolist()
@@ -3,18 +3,19 @@ Created on Thur Mar 26 14:49:19 2020
 
 @author: asoulain
 """
+import base64
+import io
 import json
-import tempfile
+import struct
 import urllib.parse
 import urllib.request
 import warnings
+import xml.etree.ElementTree as ET
 from pathlib import Path
 
-import astropy.io.votable as vo
 import numpy as np
 from astroquery.vizier import Vizier
 from scipy.constants import c as c_light
-from scipy.interpolate import interp1d
 
 warnings.filterwarnings("ignore", module="astropy.io.votable.tree")
 warnings.filterwarnings("ignore", module="astropy.io.votable.xmlutil")
@@ -22,6 +23,32 @@ warnings.filterwarnings("ignore", module="scipy.interpolate.interp1d")
 
 store_directory = Path(__file__).parent / "data"
 
+# Columns of the Vizier SED service used by previs.
+SED_COLUMNS = ["_tabname", "sed_freq", "sed_flux", "sed_eflux"]
+
+# Size [bytes] and numpy type of the VOTable datatypes (binary serialization).
+_VOTABLE_SIZE = {
+    "boolean": 1,
+    "unsignedByte": 1,
+    "short": 2,
+    "int": 4,
+    "long": 8,
+    "char": 1,
+    "unicodeChar": 2,
+    "float": 4,
+    "double": 8,
+    "floatComplex": 8,
+    "doubleComplex": 16,
+}
+_VOTABLE_DTYPE = {
+    "unsignedByte": np.uint8,
+    "short": np.int16,
+    "int": np.int32,
+    "long": np.int64,
+    "float": np.float32,
+    "double": np.float64,
+}
+
 
 def getSed(coord):
     r"""
@@ -40,64 +67,310 @@ def getSed(coord):
         'References' (references/publications)):
     """
     try:
-        coord_ = coord.replace(" ", "+").replace("+-", "-")
-        f = f"http://vizier.u-strasbg.fr/viz-bin/sed?-c={coord_}&-c.rs=1"
-        # f = f"http://vizier.u-strasbg.fr/vizier/sed/?submitSimbad=Photometry&-c={coord_}&-c.r=1&-c.u=arcsec&show_settings=1"
-        response = urllib.request.urlopen(f)
-        with tempfile.TemporaryFile() as tmpfile:
-            tmpfile.write(response.read())
-            tab = np.ma.getdata(vo.parse_single_table(tmpfile).array)
-
-        catalogs = [x for x in tab["_tabname"]]
-        # references = getVizierRef(catalogs)
-
-        cond = tab["sed_flux"] >= 0
-        freq = tab["sed_freq"][cond]
-        wl = c_light / (freq * 1e9) * 1e6
-        flux = tab["sed_flux"][cond].astype(float)
-        err = tab["sed_eflux"][cond].astype(float)
-
-        data = {
-            "Flux": list(flux),
-            "Err": list(err),
-            "wl": list(wl),
-            "References": [],  # list(references),
-            "Catalogs": list(catalogs),
-        }
+        # The VOTable is parsed while it is downloaded.
+        with urllib.request.urlopen(_sed_url(coord)) as response:
+            data = _read_sed(response)
     except (urllib.request.HTTPError, Exception):
         # todo: logme
         data = None
     return data
 
 
-def sed2mag(sed, bands):
-    """
-    Extract magnitude from interpolated SED.
+def _sed_url(coord):
+    coord_ = coord.replace(" ", "+").replace("+-", "-")
+    return f"http://vizier.u-strasbg.fr/viz-bin/sed?-c={coord_}&-c.rs=1"
+    # return f"http://vizier.u-strasbg.fr/vizier/sed/?submitSimbad=Photometry&-c={coord_}&-c.r=1&-c.u=arcsec&show_settings=1"
+
+
+def _tag(elem):
+    return elem.tag.rsplit("}", 1)[-1]
+
+
+def _arraysize(arraysize):
+    """Return the number of elements of a field and if it is variable."""
+    if arraysize is None:
+        return 1, False
+    if arraysize.endswith("*"):
+        return 0, True
+    return int(np.prod([int(x) for x in arraysize.split("x")])), False
+
+
+def _column(values, datatype):
+    """Convert the values of a column to a typed numpy array."""
+    if datatype in _VOTABLE_DTYPE:
+        if len(values) > 0 and isinstance(values[0], str):
+            empty = "nan" if datatype in ["float", "double"] else "0"
+            values = [x.strip() or empty for x in values]
+        return np.array(values, dtype=_VOTABLE_DTYPE[datatype])
+    return np.array(values, dtype=str)
+
+
+def _decode(chunk, datatype, null):
+    if datatype == "char":
+        return chunk.decode("latin-1").rstrip("\0")
+    if datatype == "unicodeChar":
+        return chunk.decode("utf-16-be").rstrip("\0")
+    if datatype not in _VOTABLE_DTYPE:
+        raise ValueError("Unsupported VOTable datatype (%s)." % datatype)
+    if null and datatype in ["float", "double"]:
+        return np.nan
+    dtype = np.dtype(_VOTABLE_DTYPE[datatype]).newbyteorder(">")
+    return np.frombuffer(chunk[: dtype.itemsize], dtype)[0]
+
+
+def _read_binary(raw, fields, columns, binary2=False):
+    """Decode the rows of a BINARY (or BINARY2) stream. Only the fields in
+    `columns` are decoded, the others are skipped."""
+    values = {name: [] for name, _, _ in fields if name in columns}
+    n_mask = (len(fields) + 7) // 8 if binary2 else 0
+    pos = 0
+    while pos < len(raw):
+        mask = raw[pos : pos + n_mask]
+        pos += n_mask
+        for i, (name, datatype, arraysize) in enumerate(fields):
+            count, variable = _arraysize(arraysize)
+            if variable:
+                count = struct.unpack_from(">I", raw, pos)[0]
+                pos += 4
+            if datatype == "bit":
+                size = (count + 7) // 8
+            else:
+                size = _VOTABLE_SIZE[datatype] * count
+            if name in values:
+                null = binary2 and bool(mask[i // 8] >> (7 - i % 8) & 1)
+                values[name].append(_decode(raw[pos : pos + size], datatype, null))
+            pos += size
+    return values
+
+
+def parse_votable(source, columns):
+    """Read the first table of a VOTable and return only the required columns as
+    typed numpy arrays. The file is read as a stream (the rows are decoded on the
+    fly and dropped). The TABLEDATA, BINARY and BINARY2 serializations are
+    supported.
+
+    Parameters:
+    -----------
+    `source`: {bytes or file-like}
+        Content of the VOTable,\n
+    `columns`: {list}
+        Names of the columns to extract.
+
+    Returns:
+    --------
+    `tab`: {dict}
+        Dictionnary of numpy arrays (keys: columns names).
     """
-    conv_flux = {
-        "B": {"wl": 0.44, "F0": 4260},
-        "V": {"wl": 0.5556, "F0": 3540},  # Allen's astrophysical quantities
-        "R": {"wl": 0.64, "F0": 3080},
-        "I": {"wl": 0.79, "F0": 2550},
-        "J": {"wl": 1.215, "F0": 1630},
-        "H": {"wl": 1.654, "F0": 1050},
-        "K": {"wl": 2.179, "F0": 655},
-        "L": {"wl": 3.547, "F0": 276},
-        "M": {"wl": 4.769, "F0": 160},
-        # 10.2, 42.7 Johnson N (https://www.gemini.edu/?q=node/11119)
-        "N": {"wl": 10.2, "F0": 42.7},
-        "Q": {"wl": 20.13, "F0": 9.7},
+    if isinstance(source, (bytes, bytearray)):
+        source = io.BytesIO(source)
+
+    fields, index, values, stream = [], None, None, None
+    for _, elem in ET.iterparse(source, events=("end",)):
+        tag = _tag(elem)
+        if tag == "FIELD":
+            fields.append(
+                (elem.get("name"), elem.get("datatype"), elem.get("arraysize"))
+            )
+        elif tag == "TR":
+            if index is None:
+                index = [(i, f[0]) for i, f in enumerate(fields) if f[0] in columns]
+                values = {name: [] for _, name in index}
+            cells = [td.text or "" for td in elem]
+            for i, name in index:
+                values[name].append(cells[i])
+            elem.clear()
+        elif tag == "STREAM":
+            if elem.get("href") is not None:
+                raise ValueError("Remote VOTable streams are not supported.")
+            stream = base64.b64decode(elem.text or "")
+            elem.clear()
+        elif tag in ["BINARY", "BINARY2"]:
+            values = _read_binary(stream, fields, columns, binary2=tag == "BINARY2")
+        elif tag == "FITS":
+            raise ValueError("FITS serialization is not supported.")
+        elif tag == "TABLE":
+            break
+
+    datatypes = {name: datatype for name, datatype, _ in fields}
+    missing = [name for name in columns if name not in datatypes]
+    if len(missing) != 0:
+        raise ValueError("Missing columns in the VOTable: %s." % missing)
+    if values is None:
+        values = {name: [] for name in columns}
+    return {name: _column(values[name], datatypes[name]) for name in columns}
+
+
+def _read_sed(raw):
+    """Build the SED dictionnary from the VOTable (bytes or file-like, e.g. the
+    HTTP response) returned by the Vizier SED service."""
+    tab = parse_votable(raw, SED_COLUMNS)
+
+    catalogs = [x for x in tab["_tabname"]]
+    # references = getVizierRef(catalogs)
+
+    cond = tab["sed_flux"] >= 0
+    freq = tab["sed_freq"][cond]
+    wl = c_light / (freq * 1e9) * 1e6
+    flux = tab["sed_flux"][cond].astype(float)
+    err = tab["sed_eflux"][cond].astype(float)
+
+    data = {
+        "Flux": list(flux),
+        "Err": list(err),
+        "wl": list(wl),
+        "References": [],  # list(references),
+        "Catalogs": list(catalogs),
     }
+    return data
+
+
+# Central wavelengths [µm] and zero points [Jy] of the photometric bands.
+CONV_FLUX = {
+    "B": {"wl": 0.44, "F0": 4260},
+    "V": {"wl": 0.5556, "F0": 3540},  # Allen's astrophysical quantities
+    "R": {"wl": 0.64, "F0": 3080},
+    "I": {"wl": 0.79, "F0": 2550},
+    "J": {"wl": 1.215, "F0": 1630},
+    "H": {"wl": 1.654, "F0": 1050},
+    "K": {"wl": 2.179, "F0": 655},
+    "L": {"wl": 3.547, "F0": 276},
+    "M": {"wl": 4.769, "F0": 160},
+    # 10.2, 42.7 Johnson N (https://www.gemini.edu/?q=node/11119)
+    "N": {"wl": 10.2, "F0": 42.7},
+    "Q": {"wl": 20.13, "F0": 9.7},
+}
+
+
+def stack_seds(seds):
+    """Concatenate a list of SED (see getSed) into flat arrays: wavelengths,
+    fluxes and offsets (the SED of the star i is wl[offsets[i]:offsets[i+1]]).
+    The missing SED (None) are empty."""
+    seds = [sed if sed is not None else {"wl": [], "Flux": []} for sed in seds]
+    counts = [len(sed["wl"]) for sed in seds]
+    offsets = np.concatenate([[0], np.cumsum(counts)]).astype(np.int64)
+    wl = np.concatenate([np.asarray(sed["wl"], dtype=float) for sed in seds] + [[]])
+    flux = np.concatenate([np.asarray(sed["Flux"], dtype=float) for sed in seds] + [[]])
+    return wl, flux, offsets
+
+
+def seds2mag(wl, flux, offsets, bands):
+    """
+    Extract the magnitudes of many stars from their SED at once (linear
+    interpolation of log10(Flux) at the central wavelength of each band).
+
+    Parameters:
+    -----------
+    `wl`, `flux`: {array}
+        Wavelengths [µm] and fluxes [Jy] of all the SED (flat arrays),\n
+    `offsets`: {array}
+        Start of the SED of each star in `wl` and `flux` (length: number of
+        stars + 1, see stack_seds),\n
+    `bands`: {list}
+        Photometric bands (e.g.: ['K', 'L']).
+
+    Returns:
+    --------
+    `mag`: {array}
+        Magnitudes (shape: (number of stars, number of bands)). NaN outside
+        the wavelength range of the SED.
+    """
+    wl_band = np.array([CONV_FLUX[band]["wl"] for band in bands])
+    F0 = np.array([CONV_FLUX[band]["F0"] for band in bands])
+    logf_band = interp_log_flux(wl, flux, offsets, wl_band)
+    with np.errstate(divide="ignore"):
+        return -2.5 * np.log10(10**logf_band / F0)
 
+
+def _bracket(wl, offsets, wl_new):
+    """Sort the SED star by star and find the points around each new
+    wavelength. Return the sort order, the sorted wavelengths, the positions
+    (in the sorted arrays) of the last point at or before each wavelength (lo)
+    and of the next point (hi), and the mask of the wavelengths outside each
+    SED (shape of lo, hi and mask: (number of stars, len(wl_new)))."""
+    n_star = len(offsets) - 1
+    counts = np.diff(offsets)
+
+    # The wavelengths of all the SED and the new ones are ranked once, so that
+    # all the SED are sorted (star by star) and searched with integer keys.
+    unique, codes = np.unique(np.concatenate([wl, wl_new]), return_inverse=True)
+    star = np.repeat(np.arange(n_star), counts)
+    keys = star * len(unique) + codes[: len(wl)]
+    order = np.argsort(keys, kind="stable")
+    keys, x = keys[order], wl[order]
+
+    start, n = offsets[:-1][:, None], counts[:, None]
+    last = np.maximum(start + n - 1, 0)
+    query = np.arange(n_star)[:, None] * len(unique) + codes[len(wl) :][None, :]
+    lo = np.clip(np.searchsorted(keys, query, side="right") - 1, start, last)
+    hi = np.minimum(lo + 1, last)
+    # A SED with one point is only defined at its wavelength (as interp1d).
+    outside = (n < 1) | (wl_new < x[np.minimum(start, last)]) | (wl_new > x[last])
+    return order, x, lo, hi, outside
+
+
+def interp_log_flux(wl, flux, offsets, wl_new):
+    """Linear interpolation of log10(Flux) of many SED (see seds2mag) at the
+    wavelengths `wl_new` (same for all stars). Return an array of shape
+    (number of stars, len(wl_new)), NaN outside the range of each SED."""
+    wl = np.asarray(wl, dtype=float)
+    wl_new = np.asarray(wl_new, dtype=float)
+    offsets = np.asarray(offsets, dtype=np.int64)
     with np.errstate(divide="ignore"):
-        f_sed = interp1d(sed["wl"], np.log10(sed["Flux"]), bounds_error=False)
-
-    l_m = np.full(len(bands), np.nan)
-    for i, band in enumerate(bands):
-        F = 10 ** (f_sed(conv_flux[band]["wl"]))
-        F0 = conv_flux[band]["F0"]
-        l_m[i] = -2.5 * np.log10(F / F0)
-    return list(l_m)
+        logf = np.log10(np.asarray(flux, dtype=float))
+    if len(wl) == 0:
+        return np.full((len(offsets) - 1, len(wl_new)), np.nan)
+
+    # Same interpolation as numpy.interp for each star (last point at or
+    # before each wavelength, exact values used at the points of the SED).
+    order, x, lo, hi, outside = _bracket(wl, offsets, wl_new)
+    y = logf[order]
+    with np.errstate(divide="ignore", invalid="ignore"):
+        slope = (y[hi] - y[lo]) / (x[hi] - x[lo])
+        logf_new = slope * (wl_new - x[lo]) + y[lo]
+        retry = np.isnan(logf_new)
+        logf_new[retry] = (slope * (wl_new - x[hi]) + y[hi])[retry]
+    flat = np.isnan(logf_new) & (y[lo] == y[hi])
+    exact = (x[lo] == wl_new) | flat
+    logf_new[exact] = y[lo][exact]
+    logf_new[outside] = np.nan
+    return logf_new
+
+
+def interp_weights(wl, offsets, wl_new):
+    """Weights of the linear interpolation of many SED (see interp_log_flux):
+    the value at `wl_new` is (1 - t) * value[lo] + t * value[hi], with `lo`
+    and `hi` indices in the flat arrays of the SED. Return lo, hi, t and the
+    mask of the wavelengths outside each SED."""
+    wl = np.asarray(wl, dtype=float)
+    wl_new = np.asarray(wl_new, dtype=float)
+    offsets = np.asarray(offsets, dtype=np.int64)
+    order, x, lo, hi, outside = _bracket(wl, offsets, wl_new)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        t = (wl_new - x[lo]) / (x[hi] - x[lo])
+    t[(x[lo] == wl_new) | ~np.isfinite(t)] = 0
+    return order[lo], order[hi], t, outside
+
+
+def stack_errors(seds):
+    """Errors of the fluxes of a list of SED, concatenated as in stack_seds
+    (NaN if not given)."""
+    errs = []
+    for sed in seds:
+        if sed is None:
+            continue
+        err = sed.get("Err", None)
+        if err is None:
+            err = np.full(len(sed["wl"]), np.nan)
+        errs.append(np.asarray(err, dtype=float))
+    return np.concatenate(errs + [[]]).astype(float)
+
+
+def sed2mag(sed, bands):
+    """
+    Extract magnitude from interpolated SED.
+    """
+    offsets = [0, len(sed["wl"])]
+    return list(seds2mag(sed["wl"], sed["Flux"], offsets, bands)[0])
 
 
 def find_author_vizier(cat):
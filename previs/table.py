@@ -0,0 +1,677 @@
+"""
+@author: Anthony Soulain (University of Sydney)
+
+--------------------------------------------------------------------
+PREVIS: Python Request Engine for Virtual Interferometric Survey
+--------------------------------------------------------------------
+
+This file contains the columnar representation of the survey results
+(SurveyTable). Each field of the nested dictionnaries of previs.search
+is stored as one numpy column (e.g.: 'Mag.magK', 'Gaia_dr2.Plx'), and the
+observability with each instrument mode (e.g.: 'Ins.MATISSE.AT.ft.L.LR')
+is stored as a packed boolean column (one bit per star).
+
+The table can be saved in a binary file (SurveyTable.write, suffix .pvs):
+a JSON header followed by the raw columns (aligned on 64 bytes). The file
+is memory-mapped by SurveyTable.read, so that only the columns used are
+actually read from the disk.
+"""
+import json
+import mmap
+import numbers
+import re
+
+import numpy as np
+
+
+def _flatten(dic, prefix=""):
+    for key, value in dic.items():
+        name = prefix + key
+        if isinstance(value, dict) and len(value) != 0:
+            yield from _flatten(value, name + ".")
+        else:
+            yield name, value
+
+
+def _kind(values):
+    """Type of a column: 'bool', 'int', 'float', 'str' or 'object'."""
+    if len(values) == 0:
+        return "object"
+    if all(isinstance(x, (bool, np.bool_)) for x in values):
+        return "bool"
+    if all(
+        isinstance(x, numbers.Real) and not isinstance(x, (bool, np.bool_))
+        for x in values
+    ):
+        if all(isinstance(x, numbers.Integral) for x in values):
+            return "int"
+        return "float"
+    if all(isinstance(x, str) for x in values):
+        return "str"
+    return "object"
+
+
+_FILL = {"bool": False, "int": 0, "float": np.nan, "str": "", "object": None}
+_DTYPE = {"bool": bool, "int": np.int64, "float": float, "str": str, "object": object}
+
+
+def _coord_deg(coord):
+    """Right ascension and declination [deg] of the coordinates saved by
+    previs.search (format: 'hh mm ss +dd mm ss' or 'ra dec' in degrees)."""
+    parts = coord.split()
+    if len(parts) == 2:
+        return float(parts[0]), float(parts[1])
+    h, m, sec = (float(x) for x in parts[0:3])
+    ra = 15 * (h + m / 60.0 + sec / 3600.0)
+    d, m, sec = (float(x) for x in parts[3:6])
+    sign = -1 if parts[3].startswith("-") else 1
+    return ra, sign * (abs(d) + m / 60.0 + sec / 3600.0)
+
+
+_TOKENS = re.compile(
+    r"\s*(?:(?P<num>[-+]?(?:\d+\.?\d*|\.\d+)(?:[eE][-+]?\d+)?)"
+    r"|(?P<str>'[^']*'|\"[^\"]*\")"
+    r"|(?P<op><=|>=|==|!=|<|>|\(|\)|&|\||~)"
+    r"|(?P<name>[A-Za-z_][\w.]*))"
+)
+_KEYWORDS = {"and": "&", "or": "|", "not": "~"}
+
+
+def _tokenize(expr):
+    tokens, pos = [], 0
+    expr = expr.strip()
+    while pos < len(expr):
+        match = _TOKENS.match(expr, pos)
+        if match is None or match.end() == pos:
+            raise ValueError("Invalid query near: %s" % expr[pos:])
+        kind = match.lastgroup
+        value = match.group(kind)
+        if kind == "name" and value.lower() in _KEYWORDS:
+            kind, value = "op", _KEYWORDS[value.lower()]
+        tokens.append((kind, value))
+        pos = match.end()
+    return tokens
+
+
+class _Query:
+    """Recursive descent parser of the query expressions (see
+    `SurveyTable.query`)."""
+
+    def __init__(self, table, expr):
+        self.table = table
+        self.tokens = _tokenize(expr)
+        self.pos = 0
+
+    def _peek(self):
+        return self.tokens[self.pos] if self.pos < len(self.tokens) else (None, None)
+
+    def _next(self):
+        token = self._peek()
+        self.pos += 1
+        return token
+
+    def parse(self):
+        mask = self._or()
+        if self.pos != len(self.tokens):
+            raise ValueError("Unexpected token in query: %s" % self._peek()[1])
+        return mask
+
+    def _or(self):
+        mask = self._and()
+        while self._peek() == ("op", "|"):
+            self._next()
+            mask = mask | self._and()
+        return mask
+
+    def _and(self):
+        mask = self._not()
+        while self._peek() == ("op", "&"):
+            self._next()
+            mask = mask & self._not()
+        return mask
+
+    def _not(self):
+        if self._peek() == ("op", "~"):
+            self._next()
+            return ~self._not()
+        if self._peek() == ("op", "("):
+            self._next()
+            mask = self._or()
+            if self._next() != ("op", ")"):
+                raise ValueError("Missing ')' in query.")
+            return mask
+        return self._comparison()
+
+    def _comparison(self):
+        kind, name = self._next()
+        if kind != "name":
+            raise ValueError("Field name expected in query, got: %s" % name)
+        name = self.table.resolve(name)
+        kind, op = self._peek()
+        if op not in ["<", "<=", ">", ">=", "==", "!="]:
+            return self.table.flag(name)
+        self._next()
+        kind, value = self._next()
+        if kind == "num":
+            value = float(value)
+        elif kind == "str":
+            value = value[1:-1]
+        else:
+            raise ValueError("Value expected in query after %s %s" % (name, op))
+        return self.table.compare(name, op, value)
+
+
+def _set(dic, name, value):
+    keys = name.split(".")
+    for key in keys[:-1]:
+        dic = dic.setdefault(key, {})
+    dic[keys[-1]] = value
+
+
+BINARY_SUFFIX = ".pvs"
+_MAGIC = b"PREVIS\x00\x01"
+_ALIGN = 64
+
+
+def _is_number(value):
+    return isinstance(value, numbers.Real) and not isinstance(value, bool)
+
+
+def _ragged(col, missing):
+    """Values of an object column as arrays of numbers (None if the values
+    are not all lists of numbers)."""
+    arrays = []
+    for i, value in enumerate(col):
+        if value is None and missing is not None and missing[i]:
+            arrays.append(np.zeros(0))
+            continue
+        # Nested lists (e.g. the guiding stars) can have different lengths,
+        # so the type of the items is checked before the conversion.
+        if not isinstance(value, list) or not all(map(_is_number, value)):
+            return None
+        arrays.append(np.array(value, dtype=float))
+    return arrays
+
+
+def _item(value):
+    if isinstance(value, np.generic):
+        return value.item()
+    raise TypeError("%s is not JSON serializable." % type(value).__name__)
+
+
+def _encode(col, missing):
+    """Binary blocks of an object column: ragged lists of numbers (flat
+    values + offsets) or JSON encoded values."""
+    arrays = _ragged(col, missing)
+    if arrays is not None:
+        offsets = np.cumsum([0] + [len(x) for x in arrays], dtype=np.int64)
+        flat = np.concatenate(arrays + [np.zeros(0)]).astype(float)
+        return "ragged", [flat, offsets]
+    raw = [json.dumps(value, default=_item).encode() for value in col]
+    offsets = np.cumsum([0] + [len(x) for x in raw], dtype=np.int64)
+    return "json", [np.frombuffer(b"".join(raw), dtype=np.uint8), offsets]
+
+
+def _decode(kind, blocks, missing):
+    data, offsets = blocks
+    bounds = zip(offsets[:-1].tolist(), offsets[1:].tolist())
+    col = np.empty(len(offsets) - 1, dtype=object)
+    if kind == "ragged":
+        col[:] = [data[a:b].tolist() for a, b in bounds]
+        if missing is not None:
+            col[missing] = None
+    else:
+        raw = data.tobytes()
+        col[:] = [json.loads(raw[a:b]) for a, b in bounds]
+    return col
+
+
+class _Lazy:
+    """Object column of a binary file, decoded when first used."""
+
+    def __init__(self, kind, blocks, missing):
+        self.kind = kind
+        self.blocks = blocks
+        self.missing = missing
+
+    def load(self):
+        return _decode(self.kind, self.blocks, self.missing)
+
+
+class _Columns(dict):
+    """Dictionnary of the columns, where the object columns read from a
+    binary file are decoded on first access."""
+
+    def __getitem__(self, name):
+        col = dict.__getitem__(self, name)
+        if isinstance(col, _Lazy):
+            col = col.load()
+            dict.__setitem__(self, name, col)
+        return col
+
+    def get(self, name, default=None):
+        return self[name] if name in self else default
+
+    def items(self):
+        return [(name, self[name]) for name in self]
+
+    def values(self):
+        return [self[name] for name in self]
+
+
+def _iter_blocks(header):
+    """Blocks of the binary file, in the order they are written."""
+    yield header["stars"]
+    yield header["bits"]
+    if "valid" in header:
+        yield header["valid"]
+    yield from header["missing"].values()
+    for _, _, infos in header["columns"]:
+        yield from infos
+
+
+class SurveyTable:
+    """Columnar representation of a survey (see `SurveyTable.from_dict`).
+
+    Parameters:
+    -----------
+    `stars`: {list}
+        Names of the stars (keys of the survey dictionnary),\n
+    `columns`: {dict}
+        Columns of the table (numpy arrays, one value per star),\n
+    `modes`: {list}
+        Names of the instrument modes (e.g.: 'Ins.PIONIER.H'),\n
+    `bits`: {array}
+        Packed observability of each mode (uint8, shape: (len(modes), n_bytes)),\n
+    `missing`: {dict}
+        Boolean masks of the columns not given for all the stars,\n
+    `valid`: {array}
+        Boolean mask of the stars with a result (False if the search returned
+        None, default: all the stars).
+    """
+
+    def __init__(self, stars, columns, modes=None, bits=None, missing=None, valid=None):
+        self.stars = list(stars)
+        self.columns = _Columns(columns)
+        self.modes = list(modes) if modes is not None else []
+        n_bytes = (len(self.stars) + 7) // 8
+        if bits is None:
+            bits = np.zeros((len(self.modes), n_bytes), dtype=np.uint8)
+        self.bits = bits
+        self.missing = dict(missing) if missing is not None else {}
+        if valid is None:
+            valid = np.ones(len(self.stars), dtype=bool)
+        self.valid = valid
+        self._index = {star: i for i, star in enumerate(self.stars)}
+        self._modes_index = {mode: i for i, mode in enumerate(self.modes)}
+        self._derived = {}
+        self._sorted = {}
+
+    @classmethod
+    def from_dict(cls, survey):
+        """Build the table from the results of previs.survey (or previs.load).
+        The stars without result (None) are kept as rows where all the fields
+        are missing (see `valid`)."""
+        stars = list(survey)
+        n_star = len(stars)
+        valid = np.array([survey[star] is not None for star in stars], dtype=bool)
+        n_valid = int(np.sum(valid))
+        values = {}
+        for i in np.flatnonzero(valid).tolist():
+            for name, value in _flatten(survey[stars[i]]):
+                values.setdefault(name, {})[i] = value
+
+        columns, modes, rows, missing = {}, [], [], {}
+        for name, col in values.items():
+            kind = _kind(list(col.values()))
+            if len(col) == n_valid and kind == "bool" and name.startswith("Ins."):
+                modes.append(name)
+                row = [col.get(i, False) for i in range(n_star)]
+                rows.append(np.array(row, dtype=bool))
+                continue
+
+            if kind == "object":
+                array = np.empty(n_star, dtype=object)
+                for i, value in col.items():
+                    array[i] = value
+            else:
+                filled = [col.get(i, _FILL[kind]) for i in range(n_star)]
+                array = np.array(filled, dtype=_DTYPE[kind])
+            columns[name] = array
+            if len(col) != n_star:
+                present = np.zeros(n_star, dtype=bool)
+                present[list(col)] = True
+                missing[name] = ~present
+
+        if len(rows) != 0:
+            bits = np.packbits(np.array(rows), axis=1)
+        else:
+            bits = None
+        return cls(stars, columns, modes=modes, bits=bits, missing=missing, valid=valid)
+
+    def to_dict(self):
+        """Convert the table to the dictionnary format of previs.survey."""
+        names = list(self.columns) + self.modes
+        lists = [self.columns[name].tolist() for name in self.columns]
+        lists += [self.mode(name).tolist() for name in self.modes]
+        missing = [self.missing.get(name) for name in names]
+
+        survey = {}
+        for i, star in enumerate(self.stars):
+            if not self.valid[i]:
+                survey[star] = None
+                continue
+            data = {}
+            for name, values, mask in zip(names, lists, missing):
+                if mask is None or not mask[i]:
+                    _set(data, name, values[i])
+            survey[star] = data
+        return survey
+
+    def write(self, filename):
+        """Save the table in a binary file (see `SurveyTable.read`)."""
+        blocks = []
+
+        def _block(array):
+            array = np.ascontiguousarray(array)
+            blocks.append(array)
+            return {"dtype": array.dtype.str, "shape": list(array.shape)}
+
+        header = {
+            "stars": _block(np.array(self.stars, dtype=str)),
+            "modes": self.modes,
+            "bits": _block(self.bits),
+            "valid": _block(self.valid),
+            "missing": {name: _block(m) for name, m in self.missing.items()},
+            "columns": [],
+        }
+        for name, col in self.columns.items():
+            if col.dtype == object:
+                kind, arrays = _encode(col, self.missing.get(name))
+                header["columns"].append([name, kind, [_block(x) for x in arrays]])
+            else:
+                header["columns"].append([name, "array", [_block(col)]])
+
+        offset = 0
+        for info, array in zip(_iter_blocks(header), blocks):
+            offset += -offset % _ALIGN
+            info["offset"] = offset
+            offset += array.nbytes
+
+        raw = json.dumps(header).encode()
+        start = len(_MAGIC) + 8 + len(raw)
+        start += -start % _ALIGN
+        with open(filename, "wb") as ofile:
+            ofile.write(_MAGIC + len(raw).to_bytes(8, "little") + raw)
+            ofile.write(b"\x00" * (start - ofile.tell()))
+            for info, array in zip(_iter_blocks(header), blocks):
+                ofile.write(b"\x00" * (start + info["offset"] - ofile.tell()))
+                ofile.write(array.tobytes())
+
+    @classmethod
+    def read(cls, filename, memmap=True):
+        """
+        Read a table saved by `SurveyTable.write`.
+
+        Parameters:
+        -----------
+        `filename`: {str}
+            Name of the binary file (.pvs),\n
+        `memmap`: {bool}
+            If True (default), the file is memory-mapped: the columns are read
+            from the disk when they are used (the arrays are read-only).
+        """
+        with open(filename, "rb") as ofile:
+            if ofile.read(len(_MAGIC)) != _MAGIC:
+                raise ValueError("%s is not a previs binary file." % filename)
+            if memmap:
+                buffer = mmap.mmap(ofile.fileno(), 0, access=mmap.ACCESS_READ)
+            else:
+                ofile.seek(0)
+                buffer = ofile.read()
+
+        size = int.from_bytes(buffer[len(_MAGIC) : len(_MAGIC) + 8], "little")
+        start = len(_MAGIC) + 8
+        header = json.loads(bytes(buffer[start : start + size]))
+        start += size
+        start += -start % _ALIGN
+
+        def _array(info):
+            dtype = np.dtype(info["dtype"])
+            count = int(np.prod(info["shape"]))
+            array = np.frombuffer(
+                buffer, dtype=dtype, count=count, offset=start + info["offset"]
+            )
+            return array.reshape(info["shape"])
+
+        missing = {name: _array(x) for name, x in header["missing"].items()}
+        valid = _array(header["valid"]) if "valid" in header else None
+        columns = _Columns()
+        for name, kind, infos in header["columns"]:
+            arrays = [_array(x) for x in infos]
+            if kind == "array":
+                columns[name] = arrays[0]
+            else:
+                columns[name] = _Lazy(kind, arrays, missing.get(name))
+        return cls(
+            _array(header["stars"]).tolist(),
+            columns,
+            modes=header["modes"],
+            bits=_array(header["bits"]),
+            missing=missing,
+            valid=valid,
+        )
+
+    def __len__(self):
+        return len(self.stars)
+
+    def __contains__(self, name):
+        return name in self.columns or name in self._modes_index
+
+    def __getitem__(self, name):
+        """Return a column (array) or the observability of an instrument mode
+        (boolean array)."""
+        if name in self._modes_index:
+            return self.mode(name)
+        if name in self.columns:
+            return self.columns[name]
+        return self._derived_column(name)
+
+    def _derived_column(self, name):
+        """Columns computed from the saved fields: 'ra' and 'dec' [deg], and
+        'Guiding_star.offaxis' (off-axis guiding star available at the VLTI)."""
+        if name not in self._derived:
+            if name in ["ra", "dec"] and "Coord" in self.columns:
+                coords = [
+                    _coord_deg(x) if isinstance(x, str) else (np.nan, np.nan)
+                    for x in self.columns["Coord"]
+                ]
+                coords = np.array(coords, dtype=float).reshape(-1, 2)
+                self._derived["ra"], self._derived["dec"] = coords[:, 0], coords[:, 1]
+            elif name == "Guiding_star.offaxis" and "Guiding_star.VLTI" in self.columns:
+                self._derived[name] = np.array(
+                    [
+                        isinstance(x, list) and (len(x[0]) > 0 or len(x[1]) > 0)
+                        for x in self.columns["Guiding_star.VLTI"]
+                    ],
+                    dtype=bool,
+                )
+            else:
+                raise KeyError(name)
+        return self._derived[name]
+
+    def resolve(self, name):
+        """Return the full name of a column from its name or the end of its
+        name (e.g.: 'magL' -> 'Mag.magL', 'MIRC.H' -> 'Ins.CHARA.MIRC.H')."""
+        names = self.colnames + ["ra", "dec", "Guiding_star.offaxis"]
+        if name in names:
+            return name
+        found = [x for x in names if x.endswith("." + name)]
+        if len(found) == 1:
+            return found[0]
+        if len(found) == 0:
+            raise ValueError("Unknown field in query: %s" % name)
+        raise ValueError("Ambiguous field in query: %s (%s)" % (name, found))
+
+    def _valid(self, name):
+        if name in self.missing:
+            return ~self.missing[name]
+        return np.ones(len(self.stars), dtype=bool)
+
+    def flag(self, name):
+        """Boolean column `name` (False where the field is missing)."""
+        col = self[name]
+        if col.dtype != bool:
+            raise ValueError("%s is not a boolean field." % name)
+        return col & self._valid(name)
+
+    def sorted_index(self, name):
+        """Sorted index of a numerical column: order of the stars and number of
+        valid (not NaN) values. The index is computed once."""
+        if name not in self._sorted:
+            col = self[name].astype(float)
+            col = np.where(self._valid(name), col, np.nan)
+            order = np.argsort(col, kind="stable")
+            n_valid = int(np.sum(~np.isnan(col)))
+            self._sorted[name] = (order, col[order], n_valid)
+        return self._sorted[name]
+
+    def compare(self, name, op, value):
+        """Boolean mask of the stars verifying `name op value` (e.g.: 'Mag.magL',
+        '<', 2). The numerical columns are compared using their sorted index."""
+        col = self[name]
+        if isinstance(value, str) or col.dtype.kind not in "biuf":
+            if op not in ["==", "!="]:
+                raise ValueError("Only == and != can be used with %s." % name)
+            mask = col == value
+            return (mask if op == "==" else ~mask) & self._valid(name)
+
+        order, values, n_valid = self.sorted_index(name)
+        values = values[:n_valid]
+        left = np.searchsorted(values, value, side="left")
+        right = np.searchsorted(values, value, side="right")
+        bounds = {
+            "<": (0, left),
+            "<=": (0, right),
+            ">": (right, n_valid),
+            ">=": (left, n_valid),
+            "==": (left, right),
+        }
+        mask = np.zeros(len(self.stars), dtype=bool)
+        if op == "!=":
+            mask[order[:left]] = True
+            mask[order[right:n_valid]] = True
+        else:
+            start, stop = bounds[op]
+            mask[order[start:stop]] = True
+        return mask
+
+    def mask(self, expr):
+        """Boolean mask of the stars verifying the query `expr` (see
+        `SurveyTable.query`)."""
+        return _Query(self, expr).parse()
+
+    def query(self, expr=None, order_by=None, k=None, descending=False):
+        """
+        Select the stars of the survey with a query expression.
+
+        Parameters:
+        -----------
+        `expr`: {str}
+            Query (e.g.: "MIRC.H and VEGA.LR", "magL < 2 and offaxis",
+            "dec < -40"). The fields are the columns (or the end of their names),
+            the instrument modes and 'ra', 'dec' [deg] and 'offaxis' (off-axis
+            guiding star at the VLTI). The conditions are combined with 'and',
+            'or', 'not' and parenthesis. If None, all the stars are selected (the
+            stars without result are never selected),\n
+        `order_by`: {str}
+            Sort the selected stars by this field (e.g.: 'magK'),\n
+        `k`: {int}
+            Number of stars returned (top-k stars if `order_by` is given),\n
+        `descending`: {bool}
+            If True, sort in descending order (default: False).
+
+        Returns:
+        --------
+        `table`: {SurveyTable}
+            Table of the selected stars.
+        """
+        if expr is None:
+            mask = np.ones(len(self.stars), dtype=bool)
+        else:
+            mask = self.mask(expr)
+        mask = mask & self.valid
+
+        if order_by is None:
+            index = np.flatnonzero(mask)
+        else:
+            order, _, n_valid = self.sorted_index(self.resolve(order_by))
+            if descending:
+                order = np.concatenate([order[:n_valid][::-1], order[n_valid:]])
+            index = order[mask[order]]
+        if k is not None:
+            index = index[:k]
+        return self.take(index)
+
+    @property
+    def colnames(self):
+        return list(self.columns) + self.modes
+
+    def mode(self, name):
+        """Return the observability with the instrument mode `name` (e.g.:
+        'Ins.MATISSE.AT.ft.L.LR') as a boolean array."""
+        row = self.bits[self._modes_index[name]]
+        return np.unpackbits(row, count=len(self.stars)).astype(bool)
+
+    def row(self, star):
+        """Return the dictionnary of one star (name or index)."""
+        i = star if isinstance(star, numbers.Integral) else self._index[star]
+        sub = self.take([i])
+        return sub.to_dict()[self.stars[i]]
+
+    def take(self, index):
+        """Return a new table with the stars selected by `index` (indices or
+        boolean mask)."""
+        index = np.arange(len(self.stars))[index]
+        stars = [self.stars[i] for i in index]
+        columns = {name: col[index] for name, col in self.columns.items()}
+        missing = {name: mask[index] for name, mask in self.missing.items()}
+        if len(self.modes) != 0:
+            unpacked = np.unpackbits(self.bits, axis=1, count=len(self.stars))
+            bits = np.packbits(unpacked[:, index], axis=1)
+        else:
+            bits = None
+        return SurveyTable(
+            stars,
+            columns,
+            modes=self.modes,
+            bits=bits,
+            missing=missing,
+            valid=self.valid[index],
+        )
+
+    def to_pandas(self):
+        """Return the scalar columns and the instrument modes as a
+        pandas.DataFrame (index: names of the stars, the stars without result
+        are not included)."""
+        import pandas as pd
+
+        if not np.all(self.valid):
+            return self.take(self.valid).to_pandas()
+
+        data = {
+            name: col
+            for name, col in dict.items(self.columns)
+            if not isinstance(col, _Lazy)
+            and col.dtype != object
+            and not np.any(self.missing.get(name, False))
+        }
+        data.update({name: self.mode(name) for name in self.modes})
+        return pd.DataFrame(data, index=self.stars)
+
+    def __repr__(self):
+        return "SurveyTable(%i stars, %i columns, %i modes)" % (
+            len(self.stars),
+            len(self.columns),
+            len(self.modes),
+        )
@@ -45,3 +45,9 @@ def test_survey():
     ret = main(["survey", "--target", "WR104", "WR118"])
     assert plt.gcf().number == 1
     assert ret == 0
+
+
+def test_cache(tmpdir, monkeypatch):
+    monkeypatch.setenv("PREVIS_CACHE_DIR", str(tmpdir))
+    for action in ["stats", "prune", "clear"]:
+        assert main(["cache", action]) == 0
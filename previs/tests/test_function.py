@@ -1,6 +1,7 @@
 import json
 from pathlib import Path
 
+import numpy as np
 import pytest
 from numpy import bool_
 
@@ -8,6 +9,7 @@ from previs import load
 from previs import save
 from previs import search
 from previs import survey
+from previs.sed import stack_seds
 from previs.utils import sanitize_booleans
 
 TEST_DIR = Path(__file__).parent
@@ -76,3 +78,756 @@ def test_survey():
     true_magL = -2.13
     assert len(d) == len(test_list_target)
     assert magL == pytest.approx(true_magL, 0.01)
+
+
+def test_simbad_record():
+    from astropy.table import MaskedColumn
+    from astropy.table import Table
+
+    from previs.core import _simbad_record
+
+    objet = Table(
+        {
+            "ra": MaskedColumn([297.69, 0.0], mask=[False, True]),
+            "dec": MaskedColumn([8.87, 0.0], mask=[False, True]),
+            "plx_value": [194.95, 0.0],
+            "plx_err": [0.57, 0.0],
+            "sp_type": ["A7Vn", ""],
+            "ids": ["HD 187642|Gaia DR2 4298361114750843008", ""],
+            "V": MaskedColumn([0.76, 0.0], mask=[False, True]),
+            "B": MaskedColumn([0.0, 0.0], mask=[True, True]),
+        }
+    )
+    record = _simbad_record(objet, 0)
+    assert record["sp_type"] == "A7Vn"
+    assert record["V"] == pytest.approx(0.76)
+    assert np.isnan(record["B"])
+    assert _simbad_record(objet, 1) is None
+
+
+def test_resolve_simbad_failure(monkeypatch):
+    from astropy.table import Table
+
+    import previs.core
+    from previs.core import resolve_simbad
+
+    sent = []
+
+    class FakeSimbad:
+        def query_objects(self, names):
+            sent.append(len(names))
+            if "BAD" in names:
+                raise ConnectionError("timeout")
+            return Table(
+                {
+                    "object_number_id": np.arange(1, len(names) + 1),
+                    "ra": [1.0] * len(names),
+                    "dec": [2.0] * len(names),
+                    "plx_value": [1.0] * len(names),
+                    "plx_err": [0.1] * len(names),
+                    "sp_type": ["A0V"] * len(names),
+                    "ids": [""] * len(names),
+                    "V": [1.0] * len(names),
+                    "B": [1.0] * len(names),
+                }
+            )
+
+    monkeypatch.setattr(previs.core, "_custom_simbad", FakeSimbad)
+    monkeypatch.setattr(previs.core, "get_cache", lambda: None)
+    monkeypatch.setattr(previs.core, "BULK_MIN_CHUNK", 2)
+    stars = ["S%i" % i for i in range(7)] + ["BAD"]
+    records = resolve_simbad(stars, chunk_size=8)
+    # The failed chunk is split: only the stars sent with BAD are lost, and
+    # they are not returned as missing from Simbad (None).
+    assert sent == [8, 4, 4, 2, 2]
+    assert sorted(records) == stars[:6]
+    assert all(records[star]["ra"] == 1.0 for star in stars[:6])
+
+
+def test_cache(tmpdir):
+    from previs.cache import Cache
+
+    cache = Cache(tmpdir, ttl={"sed": 1000}, max_size=None)
+    assert cache.get("sed", "0 0") is None
+    cache.set("sed", "0 0", {"Flux": [1.0]})
+    assert cache.get("sed", "0 0") == {"Flux": [1.0]}
+    assert cache.stats()["sed"]["entries"] == 1
+
+    cache.ttl["sed"] = -1
+    assert cache.get("sed", "0 0") is None
+    assert cache.prune() == 1
+
+    cache.ttl["sed"] = 1000
+    for i in range(3):
+        cache.set("sed", i, list(range(100)))
+    cache.get("sed", 0)
+    size = cache.stats()["sed"]["size"]
+    cache.prune(max_size=size - 1)
+    assert cache.stats()["sed"]["entries"] == 2
+    cache.clear()
+    assert cache.stats() == {}
+
+
+def test_survey_wrong_executor():
+    with pytest.raises(ValueError, match="executor"):
+        survey(["WR104"], executor="gpu")
+
+
+def test_http_get():
+    import asyncio
+    import functools
+    import http.server
+    import threading
+
+    from previs.aio import http_get
+    from previs.sed import _read_sed
+
+    handler = functools.partial(
+        http.server.SimpleHTTPRequestHandler, directory=str(TEST_DATA_DIR)
+    )
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    try:
+        url = "http://127.0.0.1:%i/sed_altair.vot" % server.server_address[1]
+        sed = _read_sed(asyncio.run(http_get(url)))
+    finally:
+        server.shutdown()
+    assert len(sed["wl"]) == 8
+
+    # Connection dropped before the end of the body.
+    class Truncated(http.server.BaseHTTPRequestHandler):
+        def do_GET(self):
+            self.send_response(200)
+            if "chunked" in self.path:
+                self.send_header("Transfer-Encoding", "chunked")
+                self.end_headers()
+                self.wfile.write(b"a\r\n01234")
+            else:
+                self.send_header("Content-Length", "100")
+                self.end_headers()
+                self.wfile.write(b"0123456789")
+
+        def log_message(self, *args):
+            pass
+
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), Truncated)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    try:
+        for path in ["length", "chunked"]:
+            url = "http://127.0.0.1:%i/%s" % (server.server_address[1], path)
+            with pytest.raises(OSError, match="Incomplete response"):
+                asyncio.run(http_get(url))
+    finally:
+        server.shutdown()
+
+
+def test_asurvey(tmpdir, monkeypatch):
+    import asyncio
+
+    import previs.aio
+    from previs.aio import asurvey
+
+    hosts = []
+
+    async def fake_asearch(star, *args):
+        hosts.extend(previs.aio._semaphores[asyncio.get_running_loop()])
+        if star == "C":
+            raise ValueError("C not in Simbad!")
+        return None if star == "D" else {"Name": star}
+
+    monkeypatch.setattr(previs.aio, "check_servers_response", lambda: {})
+    monkeypatch.setattr(previs.aio, "get_limits", lambda *args: None)
+    monkeypatch.setattr(previs.aio, "resolve_simbad", lambda s: dict.fromkeys(s))
+    monkeypatch.setattr(previs.aio, "resolve_gaia", lambda r: dict.fromkeys(r))
+    monkeypatch.setattr(previs.aio, "_asearch", fake_asearch)
+
+    output = tmpdir / "survey.jsonl"
+    out = asyncio.run(asurvey(["A", "C", "D"], output=output))
+    assert out == {"A": {"Name": "A"}, "D": None}
+    assert load(output) == out
+    assert set(hosts) == {previs.aio.SIMBAD_HOST, previs.aio.VIZIER_HOST}
+
+
+def test_gaia_field():
+    from astropy.table import MaskedColumn
+    from astropy.table import Table
+
+    from previs.core import _gaia_field
+    from previs.core import GAIA_COLUMNS
+
+    n = 4
+    tab = Table({col: np.ones(n) for col in GAIA_COLUMNS.values()})
+    tab["_r"] = [30.0, 1.5, 50.0, 10.0]
+    tab["_r"].unit = "arcsec"
+    tab["Gmag"] = MaskedColumn(
+        [11.0, 16.0, 14.0, 0.0], mask=[False, False, False, True]
+    )
+    tab["RA_ICRS"] = [1.0, 2.0, 3.0, 4.0]
+
+    gaia = _gaia_field(tab)
+    assert gaia["star"]["Gmag"] == 16.0
+    assert gaia["star"]["RA"] == 2.0
+    assert gaia["guiding"] == [[[1.0, 1.0, 11.0]], [[3.0, 1.0, 14.0]]]
+
+    tab["_r"] = [30.0, 3.0, 50.0, 10.0]
+    assert _gaia_field(tab)["star"] == {}
+    assert _gaia_field(None) == {"star": {}, "guiding": [[], []]}
+
+
+def test_resolve_gaia(monkeypatch):
+    from astropy.table import Table
+
+    import previs.core
+    from previs.core import GAIA_COLUMNS
+    from previs.core import resolve_gaia
+
+    class FakeVizier:
+        def __init__(self, **kwargs):
+            pass
+
+        def query_region(self, coords, radius, catalog):
+            tab = Table({col: np.ones(3) for col in GAIA_COLUMNS.values()})
+            tab["_q"] = [1, 1, 3]
+            tab["_r"] = [1.5, 0.5, 1.0]
+            tab["_r"].unit = "arcsec"
+            tab["Gmag"] = [10.0, 11.0, 12.0]
+            return {catalog: tab}
+
+    monkeypatch.setattr(previs.core, "Vizier", FakeVizier)
+    monkeypatch.setattr(previs.core, "get_cache", lambda: None)
+    records = {
+        name: {"ra": 10.0 * i, "dec": -20.0} for i, name in enumerate(["A", "B", "C"])
+    }
+    records["D"] = None
+    astrometry = resolve_gaia(records)
+    assert astrometry["A"]["Gmag"] == 11.0
+    assert astrometry["B"] == {}
+    assert astrometry["C"]["Gmag"] == 12.0
+    assert astrometry["D"] is None
+
+
+def test_resolve_gaia_source_id(monkeypatch):
+    from astropy.table import Table
+
+    import previs.core
+    from previs.core import gaia_dr2_id
+    from previs.core import GAIA_COLUMNS
+    from previs.core import resolve_gaia
+
+    calls = []
+
+    class FakeVizier:
+        def __init__(self, **kwargs):
+            pass
+
+        def query_constraints(self, catalog, Source):
+            calls.append(Source)
+            tab = Table({col: np.ones(1) for col in GAIA_COLUMNS.values()})
+            tab["Source"] = [123]
+            tab["Gmag"] = [9.0]
+            return {catalog: tab}
+
+        def query_region(self, coords, radius, catalog):
+            calls.append(len(coords))
+            tab = Table({col: np.ones(1) for col in GAIA_COLUMNS.values()})
+            tab["_q"] = [1]
+            tab["_r"] = [0.5]
+            tab["_r"].unit = "arcsec"
+            tab["Gmag"] = [11.0]
+            return {catalog: tab}
+
+    monkeypatch.setattr(previs.core, "Vizier", FakeVizier)
+    monkeypatch.setattr(previs.core, "get_cache", lambda: None)
+    records = {
+        "A": {"ra": 10.0, "dec": -20.0, "ids": "HD 1|Gaia DR2 123"},
+        "B": {"ra": 20.0, "dec": -20.0, "ids": "HD 2|Gaia DR2 456"},
+        "C": {"ra": 30.0, "dec": -20.0, "ids": "HD 3"},
+    }
+    assert gaia_dr2_id(records["A"]) == "123"
+    assert gaia_dr2_id(records["C"]) is None
+    astrometry = resolve_gaia(records)
+    # A is found by source_id, B (unknown id) and C fall back to the cone.
+    assert calls == ["=,123,456", 2]
+    assert astrometry["A"]["Gmag"] == 9.0
+    assert astrometry["B"] == {}
+    assert astrometry["C"]["Gmag"] == 11.0
+
+
+@pytest.mark.parametrize("fmt", ["tabledata", "binary", "binary2"])
+def test_parse_votable(fmt):
+    import io
+
+    import astropy.io.votable as vo
+
+    from previs.sed import parse_votable
+    from previs.sed import SED_COLUMNS
+
+    raw = (TEST_DATA_DIR / "sed_altair.vot").read_bytes()
+    ref = vo.parse_single_table(io.BytesIO(raw)).to_table()
+    votable = vo.from_table(ref)
+    votable.get_first_table().format = fmt
+    buffer = io.BytesIO()
+    votable.to_xml(buffer)
+
+    tab = parse_votable(buffer.getvalue(), SED_COLUMNS)
+    assert tab["sed_flux"].dtype == np.float32
+    assert list(tab["_tabname"]) == list(ref["_tabname"])
+    for col in ["sed_freq", "sed_flux", "sed_eflux"]:
+        assert np.allclose(tab[col], ref[col].filled(np.nan), equal_nan=True)
+
+    # Streamed from a file object (e.g. the HTTP response of getSed).
+    buffer.seek(0)
+    streamed = parse_votable(buffer, SED_COLUMNS)
+    assert np.array_equal(streamed["sed_flux"], tab["sed_flux"], equal_nan=True)
+
+
+def test_seds2mag():
+    from previs.sed import sed2mag
+    from previs.sed import seds2mag
+
+    bands = ["B", "V", "R", "J", "H", "K", "L", "M", "N"]
+    stored = load(small_survey_file)
+    seds = [stored[star]["SED"] for star in stored]
+    seds.append({"wl": [2.0, 2.179, 2.179, 2.5], "Flux": [1.0, 2.0, 3.0, 4.0]})
+    seds.append(None)
+    mag = seds2mag(*stack_seds(seds), bands)
+    assert mag.shape == (len(seds), len(bands))
+    for i, sed in enumerate(seds[:-1]):
+        ref = np.array(sed2mag(sed, bands))
+        assert np.array_equal(mag[i], ref, equal_nan=True)
+    assert mag[-2, 5] == -2.5 * np.log10(3.0 / 655)
+    assert np.all(np.isnan(mag[-1]))
+
+    # One point: the flux is only known at its wavelength (as interp1d).
+    mag = sed2mag({"wl": [2.179], "Flux": [2.0]}, ["H", "K", "L"])
+    assert np.isnan(mag[0]) and np.isnan(mag[2])
+    assert mag[1] == -2.5 * np.log10(2.0 / 655)
+
+
+def test_synthetic_mags():
+    from previs import filters
+
+    names = filters.filter_names()
+    assert "WISE_W1" in names and "MATISSE_N" in names
+    W, F0 = filters.filter_matrix()
+    assert W.shape == (len(names), len(filters.WL_GRID))
+    assert np.allclose(W.sum(axis=1), 1)
+
+    # A flat SED gives the same flux in all the filters.
+    flat = {"wl": [0.2, 50.0], "Flux": [10.0, 10.0]}
+    short = {"wl": [1.0, 3.0], "Flux": [10.0, 10.0]}
+    mag = filters.synthetic_mags(*stack_seds([flat, short]))
+    assert np.allclose(mag[0], -2.5 * np.log10(10.0 / F0))
+    k = names.index("K")
+    assert np.isclose(mag[1, k], mag[0, k])
+    assert np.isnan(mag[1, names.index("N")])
+
+    filters.register_filter("test", [2.0, 2.2, 2.4], [0, 1, 0], 1.0)
+    try:
+        assert np.isclose(filters.sed2synmag(flat, ["test"])["test"], -2.5)
+    finally:
+        del filters._FILTERS["test"]
+        filters._matrices.clear()
+
+
+def test_fit_blackbody():
+    from previs.fit import fill_missing_mags
+    from previs.fit import fit_blackbody
+    from previs.fit import log_blackbody
+    from previs.fit import refine_emcee
+
+    wl = np.geomspace(0.4, 2.4, 12)
+    sed = {"wl": list(wl), "Flux": list(10 ** (log_blackbody(wl, 9000) - 16))}
+    sed["Err"] = [0.02 * f for f in sed["Flux"]]
+    survey = {
+        "A": {"Mag": {"magK": 1.0, "magL": np.nan}, "SED": sed},
+        "B": {"Mag": {"magL": 2.0}, "SED": {"wl": [1.0], "Flux": [1.0]}},
+        "NOSED": None,
+    }
+    out = fill_missing_mags(survey)
+    assert out["NOSED"] is None
+    fit = out["A"]["Mag_fit"]
+    assert abs(fit["T"] - 9000) / 9000 < 0.03
+    ref = -2.5 * (log_blackbody(3.547, 9000) - 16 - np.log10(276))
+    assert abs(fit["magL"] - ref) < 3 * fit["e_magL"] + 0.01
+    assert out["A"]["Mag"]["magL"] == fit["magL"]
+    assert np.isnan(survey["A"]["Mag"]["magL"])
+    assert out["B"]["Mag"]["magL"] == 2.0 and np.isnan(out["B"]["Mag_fit"]["T"])
+
+    wl, flux, offsets = stack_seds([sed])
+    grid = fit_blackbody(wl, flux, sed["Err"], offsets)
+    mcmc = refine_emcee(wl, flux, sed["Err"], offsets, grid, n_step=200, max_workers=1)
+    assert abs(mcmc["T"][0] - 9000) / 9000 < 0.03
+    assert abs(mcmc["mag"][0, 0] - ref) < 0.05
+
+
+def test_instrument_limits():
+    from previs.instr import gravity_limit
+    from previs.instr import instrument_limits
+    from previs.instr import limits_view
+
+    with open(small_survey_file) as ofile:
+        stored = json.load(ofile)
+    stars = list(stored)
+    mag = {k: [stored[s]["Mag"][k] for s in stars] for k in stored[stars[0]]["Mag"]}
+    ins = instrument_limits(mag, source="ESO")
+    assert ins["MATISSE"]["AT"]["noft"]["L"]["LR"].shape == (len(stars),)
+    for i, star in enumerate(stars):
+        view = limits_view(ins, i)
+        for key in ["PIONIER", "MATISSE", "GRAVITY"]:
+            assert view[key] == stored[star]["Ins"][key]
+
+    # Limits of the magnitude ranges and missing magnitudes.
+    assert gravity_limit(11, -4)["AT"]["K"] == {"MR": False, "HR": True}
+    assert gravity_limit(11, -4)["V_cond"] == "AT"
+    assert gravity_limit(np.nan, -4.01)["AT"]["K"] == {"MR": False, "HR": False}
+    assert gravity_limit(np.nan, 9)["V_cond"] == "TooFaint"
+    assert gravity_limit(16, 9)["UT"]["K"] == {"MR": True, "HR": True}
+
+
+def test_limits_registry(tmpdir, monkeypatch):
+    import previs.instr
+    from previs.instr import clear_limits
+    from previs.instr import get_limits
+    from previs.instr import limit_ESO_matisse_web
+    from previs.instr import matisse_limit
+
+    calls = []
+
+    def fake_web(check, period=None):
+        calls.append(check)
+        return limit_ESO_matisse_web(check=False)
+
+    monkeypatch.setenv("PREVIS_LIMITS_DIR", str(tmpdir))
+    clear_limits()
+    monkeypatch.setattr(previs.instr, "limit_ESO_matisse_web", fake_web)
+    for _ in range(3):
+        matisse_limit(2, 2, 2, 2)
+    assert calls == [False]
+    for _ in range(3):
+        matisse_limit(2, 2, 2, 2, check=True)
+    assert calls == [False, True]
+    assert get_limits()["ut"]["ft"]["L"] == ()
+    assert len(get_limits("consortium")["ut"]["ft"]["L"]) == 3
+    clear_limits()
+
+
+def test_limits_store(tmpdir, monkeypatch):
+    import functools
+    import http.server
+    import threading
+
+    import previs.instr
+    from previs.instr import clear_limits
+    from previs.instr import get_limits
+    from previs.instr import limit_commissioning_matisse
+    from previs.instr import load_snapshot
+    from previs.instr import refresh_eso_limits
+    from previs.instr import stored_periods
+
+    www = Path(tmpdir) / "www"
+    www.mkdir()
+    (www / "inst.html").write_text("<html></html>")
+    monkeypatch.setenv("PREVIS_LIMITS_DIR", str(Path(tmpdir) / "limits"))
+    parsed = []
+
+    def fake_parse(html):
+        parsed.append(html)
+        return limit_commissioning_matisse()
+
+    monkeypatch.setattr(previs.instr, "_parse_eso_matisse", fake_parse)
+
+    handler = functools.partial(
+        http.server.SimpleHTTPRequestHandler, directory=str(www)
+    )
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    try:
+        url = "http://127.0.0.1:%i/inst.html" % server.server_address[1]
+        assert stored_periods() == ["P105"]
+        snapshot = refresh_eso_limits(url, period="P120")
+        assert snapshot["last_modified"] is not None
+        # Not modified: the page is not downloaded again.
+        refresh_eso_limits(url, period="P121")
+    finally:
+        server.shutdown()
+
+    assert len(parsed) == 1
+    assert stored_periods() == ["P105", "P120", "P121"]
+    assert load_snapshot()["limits"] == limit_commissioning_matisse()
+    assert load_snapshot("P105")["limits"]["ut"]["ft"]["L"] == []
+
+    clear_limits()
+    assert get_limits(period="P120") == get_limits("commissioning")
+    with pytest.raises(ValueError):
+        get_limits(period="P99")
+    clear_limits()
+
+
+def test_rescore():
+    from previs import rescore
+    from previs.table import _coord_deg
+
+    assert _coord_deg("05 55 10.3053 +07 24 25.430")[1] == pytest.approx(7.40706, 1e-4)
+    assert _coord_deg("10 00 00 -00 30 00") == (150.0, -0.5)
+    assert _coord_deg("150.0 -20.5") == (150.0, -20.5)
+
+    stored = load(small_survey_file)
+    new = rescore(stored)
+    for star in stored:
+        assert new[star]["Observability"] == stored[star]["Observability"]
+        for key in ["PIONIER", "MATISSE", "GRAVITY"]:
+            assert new[star]["Ins"][key] == stored[star]["Ins"][key]
+        assert new[star]["Mag"] is stored[star]["Mag"]
+
+    high = rescore(stored, min_elev=80)
+    assert not high["Altair"]["Observability"]["VLTI"]
+    assert stored["Altair"]["Observability"]["VLTI"]
+
+    stored["NOSED"] = None
+    assert list(rescore(stored)) == ["Altair", "Betelgeuse", "NOSED"]
+    assert rescore(stored)["NOSED"] is None
+
+
+def test_observable_probability():
+    from previs import observable_probability
+    from previs.sed import CONV_FLUX
+
+    stored = load(small_survey_file)
+    out = observable_probability(stored, n_samples=50, seed=1)
+    for star in stored:
+        p = out[star]["P_ins"]
+        assert p["PIONIER"]["H"] in [0.0, 1.0]
+        assert "V_cond" not in p["GRAVITY"]
+        assert set(out[star]["Mag_err"]) == set(stored[star]["Mag"]) - {"magG"}
+    stored["NOSED"] = None
+    assert observable_probability(stored, n_samples=5)["NOSED"] is None
+
+    # magH at the PIONIER limit (H = 9) with a 10% error on the flux.
+    F0 = CONV_FLUX["H"]["F0"]
+    flux = F0 * 10 ** (-9 / 2.5)
+    sed = {"wl": [1.5, 1.654, 1.8], "Flux": [flux] * 3, "Err": [0.1 * flux] * 3}
+    data = dict(stored["Altair"], SED=sed)
+    data["Mag"] = dict(data["Mag"], magH=9.0)
+    out = observable_probability({"A": data}, n_samples=4000, seed=1)
+    assert abs(out["A"]["P_ins"]["PIONIER"]["H"] - 0.5) < 0.05
+    assert abs(out["A"]["Mag_err"]["magH"] - 0.1086) < 0.01
+    assert out["A"]["Mag_err"]["magK"] < 1e-10
+
+
+def test_survey_table(tmpdir):
+    from previs import count_survey
+    from previs import rescore
+    from previs import SurveyTable
+
+    stored = load(small_survey_file)
+    for data in stored.values():
+        data["Guiding_star"] = {"VLTI": data["Guiding_star"], "CHARA": True}
+    stored = rescore(stored)
+    stored["Betelgeuse"]["Guiding_star"]["VLTI"] = [[[88.8, 7.4, 11.0]], []]
+
+    table = SurveyTable.from_dict(stored)
+    assert len(table) == 2
+    assert table["Mag.magK"].dtype == float
+    assert table["Ins.MATISSE.UT.ft.N.LR"].dtype == bool
+    assert "Ins.MATISSE.UT.ft.N.LR" in table.modes
+    assert json.dumps(table.to_dict(), sort_keys=True) == json.dumps(
+        stored, sort_keys=True
+    )
+    row = json.dumps(table.row(1), sort_keys=True)
+    assert row == json.dumps(stored["Betelgeuse"], sort_keys=True)
+    assert table.take(table["Mag.magK"] < 0).stars == ["Betelgeuse"]
+    assert table.to_pandas().loc["Altair", "Mag.magK"] == table["Mag.magK"][0]
+    assert count_survey(table) == count_survey(stored)
+
+    save(table, tmpdir / "table.json")
+    loaded = load(tmpdir / "table.json", as_table=True)
+    assert loaded.to_dict().keys() == stored.keys()
+    assert np.array_equal(loaded["Ins.PIONIER.H"], table["Ins.PIONIER.H"])
+
+    # Stars without result (None) are kept in all the formats.
+    stored["NOSED"] = None
+    table = SurveyTable.from_dict(stored)
+    assert len(table) == 3 and list(table.valid) == [True, True, False]
+    assert "Ins.PIONIER.H" in table.modes
+    dumped = json.dumps(stored, sort_keys=True)
+    assert json.dumps(table.to_dict(), sort_keys=True) == dumped
+    assert table.row("NOSED") is None
+    assert table.query("not PIONIER.H").stars == ["Betelgeuse"]
+    assert table.query().stars == ["Altair", "Betelgeuse"]
+    assert list(table.to_pandas().index) == ["Altair", "Betelgeuse"]
+    assert count_survey(table) == count_survey(stored)
+    stored["Betelgeuse"] = dict(stored["Betelgeuse"], Simbad=False)
+    assert count_survey(stored)["unavailable"] == ["Betelgeuse"]
+    stored["Betelgeuse"] = table.row("Betelgeuse")
+    save(table, tmpdir / "table.pvs")
+    assert json.dumps(load(tmpdir / "table.pvs"), sort_keys=True) == dumped
+    assert load(tmpdir / "table.pvs", as_table=True).stars == list(stored)
+
+
+def test_survey_binary(tmpdir):
+    from previs import SurveyTable
+
+    stored = load(small_survey_file)
+    del stored["Altair"]["Gaia_dr2"]
+    # Guiding stars of a faint target (lists of different lengths).
+    guid = [[[88.8, 7.4, 11.0], [88.9, 7.5, 12.0]], [[88.7, 7.3, 13.0]]]
+    stored["Betelgeuse"]["Guiding_star"] = guid
+    save(stored, tmpdir / "survey.pvs")
+    with pytest.raises(FileExistsError):
+        save(stored, tmpdir / "survey.pvs")
+
+    table = load(tmpdir / "survey.pvs", as_table=True)
+    assert isinstance(table, SurveyTable)
+    assert table.stars == list(stored)
+    assert not table["Mag.magK"].flags.writeable
+    assert table.query("magK < 0").stars == ["Betelgeuse"]
+    assert json.dumps(load(tmpdir / "survey.pvs"), sort_keys=True) == json.dumps(
+        stored, sort_keys=True
+    )
+    with pytest.raises(ValueError):
+        save(stored["Altair"], tmpdir / "star.pvs")
+
+
+def test_survey_jsonl(tmpdir):
+    from previs.utils import open_jsonl
+    from previs.utils import write_jsonl
+
+    stored = load(small_survey_file)
+    output = tmpdir / "survey.jsonl"
+    ofile, done = open_jsonl(output)
+    assert done == {}
+    write_jsonl(ofile, "Altair", stored["Altair"])
+    write_jsonl(ofile, "NOSED", None)  # search without result
+    ofile.write('{"star": "Betelgeuse", "da')  # interrupted survey
+    ofile.close()
+
+    with pytest.raises(FileExistsError):
+        open_jsonl(output)
+    ofile, done = open_jsonl(output, resume=True)
+    assert list(done) == ["Altair"]  # NOSED is searched again
+    write_jsonl(ofile, "Betelgeuse", stored["Betelgeuse"])
+    ofile.close()
+
+    stored["NOSED"] = None
+    assert json.dumps(load(output), sort_keys=True) == json.dumps(
+        stored, sort_keys=True
+    )
+
+
+def test_iter_results(tmpdir, monkeypatch):
+    import time
+
+    import previs.core
+    from previs import iter_results
+
+    def fake_task(star, simbad, gaia, limits):
+        time.sleep({"A": 0.3, "B": 0.0, "C": 0.1, "D": 0.0}[star])
+        if star == "C":
+            return star, None, "C not in Simbad!"
+        if star == "D":
+            return star, None, None  # no SED found
+        return star, {"Name": star}, None
+
+    monkeypatch.setattr(previs.core, "check_servers_response", lambda: {})
+    monkeypatch.setattr(previs.core, "get_limits", lambda **kw: None)
+    monkeypatch.setattr(previs.core, "resolve_simbad", lambda s: dict.fromkeys(s))
+    monkeypatch.setattr(previs.core, "resolve_gaia", lambda r: dict.fromkeys(r))
+    monkeypatch.setattr(previs.core, "_survey_task", fake_task)
+
+    results = list(iter_results(["A", "B", "C"], max_workers=3))
+    assert [star for star, _ in results] == ["B", "A"]
+    assert list(survey(["A", "B", "C"], max_workers=3)) == ["A", "B"]
+
+    output = tmpdir / "survey.jsonl"
+    for star, data in iter_results(["A", "B"], max_workers=1, output=output):
+        break
+    assert list(load(output)) == ["A"]
+    results = iter_results(["A", "B"], output=output, resume=True)
+    assert [star for star, _ in results] == ["A", "B"]
+
+    output = tmpdir / "survey_none.jsonl"
+    out = survey(["A", "D", "B"], max_workers=3, output=output)
+    assert out == {"A": {"Name": "A"}, "D": None, "B": {"Name": "B"}}
+    assert load(output) == {"A": {"Name": "A"}, "D": None, "B": {"Name": "B"}}
+    # The stars without result are searched again when the survey is resumed.
+    searched = []
+    monkeypatch.setattr(
+        previs.core,
+        "_survey_task",
+        lambda star, *args: searched.append(star) or (star, {"Name": star}, None),
+    )
+    resumed = survey(["A", "D", "B"], output=output, resume=True)
+    assert searched == ["D"]
+    assert resumed == {"A": {"Name": "A"}, "D": {"Name": "D"}, "B": {"Name": "B"}}
+    assert load(output) == resumed
+
+    # Stopping the loop terminates the pool of processes.
+    results = iter_results(["A", "B", "C"], executor="processes", max_workers=1)
+    for star, data in results:
+        break
+    results.close()
+    assert previs.core._pool is None
+
+
+def test_survey_worker(monkeypatch):
+    import pickle
+
+    import previs.core
+
+    data = load(small_survey_file)["Altair"]
+    monkeypatch.setattr(
+        previs.core, "_survey_task", lambda star, *args: (star, data, None)
+    )
+    raw = previs.core._survey_worker(("Altair", None, None))
+    assert isinstance(raw, bytes)
+    star, result, error = pickle.loads(raw)
+    assert json.dumps(result, sort_keys=True) == json.dumps(data, sort_keys=True)
+
+
+def test_star_set():
+    from previs.utils import StarSet
+
+    stars = np.array(["A", "B", "C", "D", "E", "F", "G", "H", "I"])
+    a = StarSet.from_mask([1, 1, 0, 0, 1, 0, 0, 0, 1], stars)
+    b = StarSet.from_mask([0, 1, 1, 0, 0, 0, 0, 0, 1], stars)
+    assert a == ["A", "B", "E", "I"]
+    assert len(a) == 4
+    assert (a & b) == ["B", "I"]
+    assert (a | b) == ["A", "B", "C", "E", "I"]
+    assert (a - b) == ["A", "E"]
+    assert (a ^ b) == ["A", "C", "E"]
+    assert (~a) == ["C", "D", "F", "G", "H"]
+    assert len(~a) == 5
+    with pytest.raises(ValueError):
+        a & StarSet.from_mask([1, 0], np.array(["A", "B"]))
+
+
+def test_survey_table_query():
+    from previs import SurveyTable
+
+    survey = {}
+    for i, (magL, dec, guid) in enumerate(
+        [(1.0, "-45 00 00", [[[1, 2, 3]], []]), (3.0, "-10 00 00", "Science star")]
+        + [(0.5, "+20 00 00", [[], []]), (np.nan, "-60 30 00", [[], [[1, 2, 3]]])]
+    ):
+        survey["S%i" % i] = {
+            "Coord": "10 00 00 %s" % dec,
+            "Mag": {"magL": magL, "magK": 2.0 * i},
+            "Guiding_star": {"VLTI": guid, "CHARA": True},
+            "Ins": {"CHARA": {"MIRC": {"H": i < 2}, "VEGA": {"LR": i != 0}}},
+        }
+    table = SurveyTable.from_dict(survey)
+
+    assert table.query("MIRC.H and VEGA.LR").stars == ["S1"]
+    assert table.query("magL < 2 and offaxis").stars == ["S0"]
+    assert table.query("dec < -40").stars == ["S0", "S3"]
+    assert table.query("not (magL >= 1) or magK == 4").stars == ["S2", "S3"]
+    assert table.query("magL != 1").stars == ["S1", "S2"]
+    assert table.query(order_by="magL", k=2).stars == ["S2", "S0"]
+    top = table.query("dec < 0", order_by="magK", k=2, descending=True)
+    assert top.stars == ["S3", "S1"]
+    with pytest.raises(ValueError):
+        table.query("VLTI")
+    with pytest.raises(ValueError):
+        table.query("magL <")
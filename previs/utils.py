@@ -11,12 +11,17 @@ import json
 import os
 import time
 import urllib.request
+from collections.abc import Sequence
 from pathlib import Path
 
+import numpy as np
 from numpy import bool_
 from termcolor import colored
 from termcolor import cprint
 
+from previs.table import BINARY_SUFFIX
+from previs.table import SurveyTable
+
 # on windows, colorama should help making termcolor compatible
 try:
     import colorama
@@ -86,7 +91,9 @@ def sanitize_booleans(dic):
 
 
 def save(result, result_file, overwrite=False):
-    """Save <result> data to json <result_file>"""
+    """Save <result> data to json <result_file> (<result> can be a SurveyTable).
+    If the suffix of <result_file> is .pvs, the survey is saved in the binary
+    format of SurveyTable (memory-mapped by previs.load)."""
     data_file = sanitize_survey_file(result_file)
     if data_file.exists() and not overwrite:
         raise FileExistsError(data_file)
@@ -95,6 +102,18 @@ def save(result, result_file, overwrite=False):
         # todo: logme
         os.makedirs(data_file.parent)
 
+    if data_file.suffix == BINARY_SUFFIX:
+        if not isinstance(result, SurveyTable):
+            if isinstance(result.get("Name"), str):
+                raise ValueError(
+                    "Only surveys can be saved in %s files." % BINARY_SUFFIX
+                )
+            result = SurveyTable.from_dict(result)
+        result.write(data_file)
+        return data_file
+
+    if isinstance(result, SurveyTable):
+        result = result.to_dict()
     survey_ = sanitize_booleans(result)
     with open(data_file, mode="w") as ofile:
         json.dump(survey_, ofile)
@@ -102,34 +121,174 @@ def save(result, result_file, overwrite=False):
     return data_file
 
 
-def load(result_file):
-    """Load result data from json <result_file>"""
+def load(result_file, as_table=False):
+    """Load result data from json <result_file> (as a SurveyTable if
+    <as_table> is True). The binary files (.pvs) are memory-mapped, so loading
+    them as a SurveyTable only reads the columns used."""
     survey_file = sanitize_survey_file(result_file)
+    if survey_file.suffix == ".jsonl":
+        survey = read_jsonl(survey_file)
+        return SurveyTable.from_dict(survey) if as_table else survey
+    if survey_file.suffix == BINARY_SUFFIX:
+        table = SurveyTable.read(survey_file)
+        return table if as_table else table.to_dict()
     with open(survey_file) as ofile:
         survey = json.load(ofile)
+    if as_table:
+        return SurveyTable.from_dict(survey)
     return survey
 
 
-def add_vs_mode_matisse(out, dic, star, cond_VLTI, cond_guid):
-    """Small function for count_survey. Counts MATISSE observability for each mode."""
-    for tel in ["AT", "UT"]:
-        for ft in ["noft", "ft"]:
-            for band in ["L", "N"]:
-                for res in ["LR", "HR"]:
-                    cond_ins = out[star]["Ins"]["MATISSE"][tel][ft][band][res]
-                    if cond_VLTI and cond_guid and cond_ins:
-                        dic["MATISSE"][tel][ft][band][res].append(star)
-    return dic
+def read_jsonl(result_file):
+    """Read the results written star by star by previs.survey (<output> JSON
+    Lines file). An incomplete last line (interrupted survey) is ignored."""
+    survey = {}
+    with open(result_file) as ofile:
+        for i, line in enumerate(ofile):
+            try:
+                entry = json.loads(line)
+            except json.JSONDecodeError:
+                cprint(
+                    "%s: line %i ignored (incomplete)." % (result_file, i + 1), "red"
+                )
+                continue
+            survey[entry["star"]] = entry["data"]
+    return survey
 
 
-def add_vs_mode_gravity(out, dic, star, cond_VLTI, cond_guid):
-    """Small function for count_survey. Counts GTAVITY observability for each mode."""
-    for tel in ["AT", "UT"]:
-        for res in ["MR", "HR"]:
-            cond_ins = out[star]["Ins"]["GRAVITY"][tel]["K"][res]
-            if cond_VLTI and cond_guid and cond_ins:
-                dic["GRAVITY"][tel][res].append(star)
-    return dic
+def open_jsonl(result_file, resume=False):
+    """Open the JSON Lines <result_file> where the results of a survey are
+    appended as they are found. If <resume> is True, the results already saved
+    are returned with the file (else the file must not exist). The stars saved
+    without result (null, e.g. SED not found during a network outage) are not
+    returned, so that they are searched again."""
+    path = Path(result_file)
+    done = {}
+    if path.exists():
+        if not resume:
+            raise FileExistsError("%s (use resume=True to complete it)" % path)
+        saved = read_jsonl(path)
+        done = {star: data for star, data in saved.items() if data is not None}
+        with open(path, "rb+") as ofile:
+            raw = ofile.read()
+            ofile.truncate(raw.rfind(b"\n") + 1)
+    elif not path.parent.is_dir():
+        os.makedirs(path.parent)
+    return open(path, mode="a"), done
+
+
+def write_jsonl(ofile, star, data):
+    """Append the result of one star to a JSON Lines file (see open_jsonl). The
+    stars without result (<data> is None, e.g. no SED found) are saved as null
+    (searched again if the survey is resumed)."""
+    if data is not None:
+        data = sanitize_booleans(data)
+    entry = {"star": star, "data": data}
+    ofile.write(json.dumps(entry) + "\n")
+    ofile.flush()
+
+
+_POPCOUNT = np.array([bin(i).count("1") for i in range(256)], dtype=np.int64)
+
+
+class StarSet(Sequence):
+    """Stars of a survey observable with one mode, stored as a packed bitmask
+    (one bit per star). It behaves as the list of the stars names, and
+    supports the set operations (&, |, -, ^, ~) as bitwise operations."""
+
+    def __init__(self, bits, stars):
+        self.bits = bits
+        self.stars = stars
+        self._names = None
+
+    @classmethod
+    def from_mask(cls, mask, stars):
+        return cls(np.packbits(np.asarray(mask, dtype=bool)), stars)
+
+    def mask(self):
+        """Boolean array (one value per star of the survey)."""
+        return np.unpackbits(self.bits, count=len(self.stars)).astype(bool)
+
+    @property
+    def names(self):
+        if self._names is None:
+            self._names = self.stars[self.mask()].tolist()
+        return self._names
+
+    def _same(self, other):
+        if other.stars is not self.stars and not np.array_equal(
+            other.stars, self.stars
+        ):
+            raise ValueError("The sets of stars come from different surveys.")
+        return other
+
+    def __and__(self, other):
+        other = self._same(other)
+        return StarSet(self.bits & other.bits, self.stars)
+
+    def __or__(self, other):
+        other = self._same(other)
+        return StarSet(self.bits | other.bits, self.stars)
+
+    def __sub__(self, other):
+        other = self._same(other)
+        return StarSet(self.bits & ~other.bits, self.stars)
+
+    def __xor__(self, other):
+        other = self._same(other)
+        return StarSet(self.bits ^ other.bits, self.stars)
+
+    def __invert__(self):
+        valid = np.packbits(np.ones(len(self.stars), dtype=bool))
+        return StarSet(~self.bits & valid, self.stars)
+
+    def __len__(self):
+        return int(_POPCOUNT[self.bits].sum())
+
+    def __getitem__(self, i):
+        return self.names[i]
+
+    def __eq__(self, other):
+        if isinstance(other, StarSet):
+            return np.array_equal(self.bits, other.bits)
+        return self.names == list(other)
+
+    __hash__ = None
+
+    def __repr__(self):
+        return repr(self.names)
+
+
+def _flag(table, name):
+    """Boolean column of a SurveyTable (False if the field is missing)."""
+    if name in table.modes:
+        return table.mode(name)
+    if name not in table.columns:
+        return np.zeros(len(table), dtype=bool)
+    col = table.columns[name]
+    if col.dtype != bool:
+        col = np.array([x is True for x in col], dtype=bool)
+    if name in table.missing:
+        col = col & ~table.missing[name]
+    return col
+
+
+def _guiding_star_vlti(table):
+    """Stars with a guiding star at the VLTI (or being their own guiding
+    star)."""
+    cond = np.zeros(len(table), dtype=bool)
+    for name in ["Guiding_star.VLTI", "Guiding_star"]:
+        if name not in table.columns:
+            continue
+        missing = table.missing.get(name, np.zeros(len(table), dtype=bool))
+        for i, guid in enumerate(table.columns[name]):
+            if missing[i]:
+                continue
+            if isinstance(guid, list):
+                cond[i] = (len(guid[0]) > 0) or (len(guid[1]) > 0)
+            else:
+                cond[i] = guid == "Science star"
+    return cond
 
 
 def count_survey(survey, limit="imaging"):
@@ -137,14 +296,17 @@ def count_survey(survey, limit="imaging"):
 
     Parameters:
     -----------
-    `survey`: {dict}
+    `survey`: {dict or SurveyTable}
         survey is the result from previs.search. It's generally used if
         the input of previs.search is a list of stars.
     Result:
     -------
     `dic`: {dict}
         The result contains lists of stars observable with each mode
-        and instrument considered by previs.search (See data['Ins]).
+        and instrument considered by previs.search (See data['Ins]). The
+        lists are StarSet (packed bitmasks), so they can be combined with
+        the set operations (e.g.: dic.mode("MATISSE UT ft L LR") &
+        dic.mode("GRAVITY UT MR")).
 
     """
 
@@ -153,18 +315,21 @@ def count_survey(survey, limit="imaging"):
     else:
         return SurveyClass([])
 
-    list_star = survey.keys()
-    n_star = len(list_star)
-
-    n_chara, n_vlti = 0, 0
-    for x in list_star:
-        if survey[x] is not None:
-            if survey[x]["Simbad"]:
-                if not survey[x]["SED"] is None:
-                    if survey[x]["Observability"]["VLTI"]:
-                        n_vlti += 1
-                    if survey[x]["Observability"]["CHARA"]:
-                        n_chara += 1
+    n_star = len(survey)
+    if not isinstance(survey, SurveyTable):
+        survey = SurveyTable.from_dict(survey)
+    stars = np.asarray(survey.stars)
+
+    simbad = _flag(survey, "Simbad")
+    sed = simbad.copy()
+    if "SED" in survey.columns:
+        no_sed = np.array([x is None for x in survey.columns["SED"]], dtype=bool)
+        if "SED" in survey.missing:
+            no_sed &= ~survey.missing["SED"]
+        sed &= ~no_sed
+    obs_vlti = _flag(survey, "Observability.VLTI") & simbad
+    obs_chara = _flag(survey, "Observability.CHARA") & simbad
+    n_vlti, n_chara = int(np.sum(obs_vlti & sed)), int(np.sum(obs_chara & sed))
 
     cprint("\nYour list contains %i stars:" % n_star, "cyan")
     cprint("-------------------------", "cyan")
@@ -173,107 +338,75 @@ def count_survey(survey, limit="imaging"):
         % (n_vlti, 100 * float(n_vlti) / n_star, n_chara, 100 * float(n_chara) / n_star)
     )
 
+    cond_vlti = obs_vlti & _guiding_star_vlti(survey)
+    cond_chara = obs_chara & _flag(survey, "Ins.CHARA.Guiding")
+
+    def _vlti(name):
+        return StarSet.from_mask(cond_vlti & _flag(survey, name), stars)
+
+    def _chara(name):
+        return StarSet.from_mask(cond_chara & _flag(survey, name), stars)
+
+    matisse = {}
+    for tel in ["UT", "AT"]:
+        matisse[tel] = {}
+        for ft in ["noft", "ft"]:
+            matisse[tel][ft] = {}
+            for band in ["L", "N"]:
+                matisse[tel][ft][band] = {
+                    res: _vlti("Ins.MATISSE.%s.%s.%s.%s" % (tel, ft, band, res))
+                    for res in ["LR", "HR"]
+                }
+
     dic = SurveyClass(
         {
-            "MATISSE": {
-                "UT": {
-                    "noft": {"L": {"LR": [], "HR": []}, "N": {"LR": [], "HR": []}},
-                    "ft": {"L": {"LR": [], "HR": []}, "N": {"LR": [], "HR": []}},
-                },
-                "AT": {
-                    "noft": {"L": {"LR": [], "HR": []}, "N": {"LR": [], "HR": []}},
-                    "ft": {"L": {"LR": [], "HR": []}, "N": {"LR": [], "HR": []}},
-                },
+            "MATISSE": matisse,
+            "GRAVITY": {
+                tel: {
+                    res: _vlti("Ins.GRAVITY.%s.K.%s" % (tel, res))
+                    for res in ["MR", "HR"]
+                }
+                for tel in ["UT", "AT"]
             },
-            "GRAVITY": {"UT": {"MR": [], "HR": []}, "AT": {"MR": [], "HR": []}},
-            "PIONIER": [],
-            "VISION": [],
-            "PAVO": [],
-            "CLASSIC": {"V": [], "H": [], "K": []},
-            "CLIMB": [],
-            "MYSTIC": [],
-            "MIRC": {"H": [], "K": []},
-            "VEGA": {"LR": [], "MR": [], "HR": []},
+            "PIONIER": _vlti("Ins.PIONIER.H"),
+            "VISION": _vlti("Ins.VISION.%s" % limit),
+            "PAVO": _chara("Ins.CHARA.PAVO.R"),
+            "CLASSIC": {b: _chara("Ins.CHARA.CLASSIC.%s" % b) for b in ["V", "H", "K"]},
+            "CLIMB": _chara("Ins.CHARA.CLIMB.K"),
+            "MYSTIC": _chara("Ins.CHARA.MYSTIC.K"),
+            "MIRC": {b: _chara("Ins.CHARA.MIRC.%s" % b) for b in ["H", "K"]},
+            "VEGA": {r: _chara("Ins.CHARA.VEGA.%s" % r) for r in ["LR", "MR", "HR"]},
         }
     )
 
-    list_no_simbad = []
-    for star in list_star:
-        if survey[star] is not None:
-            if survey[star]["Simbad"]:
-                if type(survey[star]["Guiding_star"]["VLTI"]) == list:
-                    if (len(survey[star]["Guiding_star"]["VLTI"][0]) > 0) or (
-                        len(survey[star]["Guiding_star"]["VLTI"][1]) > 0
-                    ):
-                        cond_guid_vlti = True
-                    else:
-                        cond_guid_vlti = False
-                elif survey[star]["Guiding_star"]["VLTI"] == "Science star":
-                    cond_guid_vlti = True
-                else:
-                    cond_guid_vlti = False
-
-                cond_VLTI = survey[star]["Observability"]["VLTI"]
-                cond_CHARA = survey[star]["Observability"]["CHARA"]
-                cond_tilt = survey[star]["Ins"]["CHARA"]["Guiding"]
-                dic = add_vs_mode_matisse(survey, dic, star, cond_VLTI, cond_guid_vlti)
-                dic = add_vs_mode_gravity(survey, dic, star, cond_VLTI, cond_guid_vlti)
-
-                cond_ins = survey[star]["Ins"]["PIONIER"]["H"]
-                if cond_VLTI and cond_guid_vlti and cond_ins:
-                    dic["PIONIER"].append(star)
-
-                cond_ins = survey[star]["Ins"]["VISION"][limit]
-                if cond_VLTI and cond_guid_vlti and cond_ins:
-                    dic["VISION"].append(star)
-
-                for band in ["H", "K"]:
-                    cond_ins = survey[star]["Ins"]["CHARA"]["MIRC"][band]
-
-                    if cond_CHARA and cond_ins and cond_tilt:
-                        dic["MIRC"][band].append(star)
-
-                for res in ["LR", "HR"]:
-                    cond_ins = survey[star]["Ins"]["CHARA"]["VEGA"][res]
-                    if cond_CHARA and cond_ins and cond_tilt:
-                        dic["VEGA"][res].append(star)
-
-                for band in ["V", "H", "K"]:
-                    cond_ins = survey[star]["Ins"]["CHARA"]["CLASSIC"][band]
-                    if cond_CHARA and cond_ins and cond_tilt:
-                        dic["CLASSIC"][band].append(star)
-
-                if (
-                    cond_CHARA
-                    and survey[star]["Ins"]["CHARA"]["PAVO"]["R"]
-                    and cond_tilt
-                ):
-                    dic["PAVO"].append(star)
-
-                if (
-                    cond_CHARA
-                    and survey[star]["Ins"]["CHARA"]["MYSTIC"]["K"]
-                    and cond_tilt
-                ):
-                    dic["MYSTIC"].append(star)
-
-                if (
-                    cond_CHARA
-                    and survey[star]["Ins"]["CHARA"]["CLIMB"]["K"]
-                    and cond_tilt
-                ):
-                    dic["CLIMB"].append(star)
-            else:
-                list_no_simbad.append(star)
-
     # if list_no_simbad:
     #     cprint('Warning: some stars are not in Simbad:', 'red')
     #     print(list_no_simbad)
-    dic["unavailable"] = list_no_simbad
+    # Stars not in Simbad (the stars without result are not listed).
+    dic["unavailable"] = stars[~simbad & survey.valid].tolist()
     return dic
 
 
 class SurveyClass(dict):
+    def mode(self, path):
+        """Return the stars observable with one mode (e.g.: 'MATISSE UT ft L LR'
+        or 'PIONIER') as a StarSet."""
+        out = self
+        for key in path.split():
+            out = out[key]
+        return out
+
+    def counts(self):
+        """Return the number of stars observable with each mode (same structure
+        as the dictionnary)."""
+
+        def _count(x):
+            if isinstance(x, dict):
+                return {k: _count(v) for k, v in x.items()}
+            return len(x)
+
+        return _count(dict(self))
+
     def print_log(self):
         res = "\n".join(
             [